@@ -3,12 +3,15 @@
 try:
     py3k = False
     import SocketServer
+    import Queue
     socketserver = SocketServer
+    queue = Queue
     string_class = basestring
 
 except ImportError:
     py3k = True
     import socketserver
+    import queue
     string_class = str
 
 
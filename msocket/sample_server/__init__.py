@@ -2,11 +2,13 @@
 from __future__ import absolute_import
 
 from .logging import (
-    TCPLogServer, UnixStreamLogServer, LogConfigServer, UnixStreamLogConfigServer,
+    TCPLogServer, UnixStreamLogServer, LogConfigServer, UnixStreamLogConfigServer, BatchingSocketHandler,
     make_log_server, make_log_config_server
 )
+from .logformat import LogHandler
+from .logstore import LogStore
 
 try:
-    from .managers import SyncManager
+    from .managers import SyncManager, Batch
 except ImportError:
-    SyncManager = None
+    SyncManager = Batch = None
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Read-through cached dict proxies of `msocket.sample_server.managers.SyncManager`.
+
+``manager.CachedDict()`` creates a dict on the manager that counts its
+mutations. Its proxy fetches a copy of the whole dict on the first read
+and answers further reads locally. Every process keeps one notification
+channel to the manager, served by the manager's reactor. When the dict
+changes, its new version is pushed on that channel and the local copy is
+dropped, to be fetched again on the next read. ``max_staleness`` bounds
+how long a copy is used even without a notification, and without a
+channel every read goes to the manager.
+
+Values read from the copy are shared by the readers of the process and
+must not be modified in place.
+"""
+from __future__ import absolute_import
+
+import os
+import time
+import weakref
+import threading
+from multiprocessing.managers import BaseProxy, convert_to_error
+
+__author__ = 'fujie'
+
+
+class Versioned(object):
+    """Manager side objects whose ``version`` changes are pushed to subscribed channels."""
+    version = 0
+
+
+class VersionedDict(dict, Versioned):
+    def __init__(self, *args, **kwds):
+        dict.__init__(self, *args, **kwds)
+        self.lock = threading.RLock()
+
+    def snapshot(self):
+        with self.lock:
+            return self.version, dict(self)
+
+    def _mutate(self, method, *args):
+        with self.lock:
+            result = method(self, *args)
+            self.version += 1
+        return result
+
+    def __setitem__(self, key, value):
+        return self._mutate(dict.__setitem__, key, value)
+
+    def __delitem__(self, key):
+        return self._mutate(dict.__delitem__, key)
+
+    def clear(self):
+        return self._mutate(dict.clear)
+
+    def pop(self, *args):
+        return self._mutate(dict.pop, *args)
+
+    def popitem(self):
+        return self._mutate(dict.popitem)
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            if key in self:
+                return self[key]
+            return self._mutate(dict.setdefault, key, default)
+
+    def update(self, *args, **kwds):
+        with self.lock:
+            dict.update(self, *args, **kwds)
+            self.version += 1
+
+
+class NotifyChannel(object):
+    """
+    Connection of one process to a manager receiving ``('#NOTIFY', ident,
+    version)`` for its subscribed objects, read by a daemon thread.
+    ``#DISPOSED`` drops the subscription of a disposed object.
+    """
+    # seconds to wait for the manager to confirm a subscription
+    subscribe_timeout = 5.0
+    key = None
+
+    def __init__(self, proxy):
+        self.address = proxy._token.address
+        self.conn = proxy._Client(self.address, authkey=proxy._authkey)
+        self.conn.send((None, 'subscribe', (), {}))
+        kind, result = self.conn.recv()
+        if kind != '#RETURN':
+            self.conn.close()
+            raise convert_to_error(kind, result)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.alive = True
+        self.versions = {}
+        self.proxies = {}
+        self.subscribed = {}
+        t = threading.Thread(target=self.run, name='msocket-notify')
+        t.daemon = True
+        t.start()
+
+    def subscribe(self, proxy):
+        """Deliver notifications to ``proxy``, returns False if they cannot be."""
+        ident = proxy._id
+        with self.lock:
+            if not self.alive:
+                return False
+            self.proxies.setdefault(ident, weakref.WeakSet()).add(proxy)
+            confirmed = self.subscribed.get(ident)
+            send = confirmed is None
+            if send:
+                self.subscribed[ident] = confirmed = threading.Event()
+        if send:
+            try:
+                with self.send_lock:
+                    self.conn.send(('subscribe', ident))
+            except (IOError, OSError):
+                self.close()
+                return False
+        return confirmed.wait(self.subscribe_timeout) and self.alive
+
+    def store(self, proxy, version, data):
+        # a copy older than a notification already received is not kept
+        with self.lock:
+            if self.alive and version >= self.versions.get(proxy._id, version):
+                proxy._cache = (version, data, time.time())
+
+    def run(self):
+        try:
+            while True:
+                kind, ident, version = self.conn.recv()
+                with self.lock:
+                    if version is not None and version > self.versions.get(ident, -1):
+                        self.versions[ident] = version
+                    if kind == '#SUBSCRIBED':
+                        # gone if a #DISPOSED came first
+                        confirmed = self.subscribed.get(ident)
+                        if confirmed is not None:
+                            confirmed.set()
+                        continue
+                    if kind == '#DISPOSED':
+                        self.versions.pop(ident, None)
+                        self.subscribed.pop(ident, None)
+                    self._invalidate(ident, version)
+        except Exception:
+            # EOF, a connection error or a message that cannot be read; the
+            # copies cannot be kept up to date anymore either way
+            pass
+        self.close()
+
+    def _invalidate(self, ident, version):
+        # not inlined in run, whose frame would keep the last proxy alive
+        for proxy in self.proxies.get(ident, ()):
+            proxy._invalidate(version)
+
+    def close(self):
+        with self.lock:
+            if not self.alive:
+                return
+            self.alive = False
+            for proxies in self.proxies.values():
+                for proxy in proxies:
+                    proxy._invalidate(None)
+            for confirmed in self.subscribed.values():
+                confirmed.set()
+        with _channels_lock:
+            if _channels.get(self.key) is self:
+                del _channels[self.key]
+        self.conn.close()
+
+
+# (pid, manager address): NotifyChannel of this process
+_channels = {}
+_channels_lock = threading.Lock()
+
+
+def get_channel(proxy):
+    """The notification channel of this process to the manager of ``proxy``, None if it cannot be opened."""
+    key = (os.getpid(), proxy._token.address)
+    with _channels_lock:
+        channel = _channels.get(key)
+        if channel is not None and channel.alive:
+            return channel
+        try:
+            channel = NotifyChannel(proxy)
+        except Exception:
+            return None
+        channel.key = key
+        _channels[key] = channel
+        return channel
+
+
+class CachedDictProxy(BaseProxy):
+    _exposed_ = ('__contains__', '__delitem__', '__getitem__', '__len__', '__setitem__', 'clear', 'copy', 'get',
+                 'has_key', 'items', 'keys', 'pop', 'popitem', 'setdefault', 'update', 'values', 'snapshot')
+    # seconds a copy is used at most, None until the next notification
+    max_staleness = None
+    _cache = None
+
+    def _invalidate(self, version):
+        cache = self._cache
+        if cache is not None and (version is None or cache[0] < version):
+            self._cache = None
+
+    def _local(self):
+        """The local copy of the dict, None when reads have to go to the manager."""
+        cache = self._cache
+        if cache is not None and (self.max_staleness is None or time.time() - cache[2] < self.max_staleness):
+            return cache[1]
+        channel = get_channel(self)
+        if channel is None or not channel.subscribe(self):
+            return None
+        version, data = self._callmethod('snapshot')
+        channel.store(self, version, data)
+        return data
+
+    def _read(self, methodname, *args):
+        data = self._local()
+        if data is None:
+            return self._callmethod(methodname, args)
+        return getattr(data, methodname)(*args)
+
+    def _mutate(self, methodname, args=(), kwds={}):
+        # our own change is read back, even before its notification arrives
+        self._cache = None
+        try:
+            return self._callmethod(methodname, args, kwds)
+        finally:
+            self._cache = None
+
+    def __getitem__(self, key):
+        return self._read('__getitem__', key)
+
+    def get(self, key, default=None):
+        return self._read('get', key, default)
+
+    def __contains__(self, key):
+        return self._read('__contains__', key)
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self._read('__len__')
+
+    def __iter__(self):
+        return iter(self._read('keys'))
+
+    def keys(self):
+        return self._read('keys')
+
+    def values(self):
+        return self._read('values')
+
+    def items(self):
+        return self._read('items')
+
+    def copy(self):
+        return self._read('copy')
+
+    def __setitem__(self, key, value):
+        return self._mutate('__setitem__', (key, value))
+
+    def __delitem__(self, key):
+        return self._mutate('__delitem__', (key,))
+
+    def clear(self):
+        return self._mutate('clear')
+
+    def pop(self, *args):
+        return self._mutate('pop', args)
+
+    def popitem(self):
+        return self._mutate('popitem')
+
+    def setdefault(self, key, default=None):
+        return self._mutate('setdefault', (key, default))
+
+    def update(self, *args, **kwds):
+        return self._mutate('update', args, kwds)
@@ -0,0 +1,321 @@
+# -*- coding:utf8 -*-
+"""
+Non-pickle wire formats of the log server.
+
+A client selects a format by sending `MAGIC` followed by one format byte
+before its first record; connections starting with anything else use the
+pickle format of `logging.handlers.SocketHandler`. As a pickle stream
+starts with a 4 byte length, `MAGIC` reads as a length far above
+`LOGServerMixIn.max_record_size` and cannot be mistaken for one.
+
+Every record is still prefixed with its 4 byte big-endian length:
+
+- ``json``: the record attributes as a JSON object
+- ``compact``: a fixed binary layout, logger names, paths, function and
+  thread names are interned per connection and sent once
+"""
+from __future__ import absolute_import
+
+import json
+import time
+import socket
+import struct
+import cPickle
+import logging
+import logging.handlers
+
+__author__ = 'fujie'
+
+MAGIC = b'MSLG'
+FORMAT_PICKLE = 0
+FORMAT_JSON = 1
+FORMAT_COMPACT = 2
+FORMATS = {'pickle': FORMAT_PICKLE, 'json': FORMAT_JSON, 'compact': FORMAT_COMPACT}
+
+_length = struct.Struct('>L')
+# compact record: kind, created, levelno, name, pathname, funcName, threadName ids, lineno, process, thread
+_record = struct.Struct('>BdBHHHHIIQ')
+# compact intern entry: kind, id, followed by the utf-8 string
+_intern = struct.Struct('>BH')
+KIND_INTERN = 0
+KIND_RECORD = 1
+FLAG_EXC_TEXT = 0x80
+
+
+def _text(value):
+    if value is None:
+        return u''
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value if isinstance(value, unicode) else unicode(value)
+
+
+def record_fields(record):
+    """The attributes of ``record`` sent to the server, with the message merged with its arguments."""
+    if record.exc_info and not record.exc_text:
+        # formats the traceback into record.exc_text, like SocketHandler
+        logging.Formatter().format(record)
+    return {
+        'name': record.name,
+        'levelno': record.levelno,
+        'msg': record.getMessage(),
+        'created': record.created,
+        'msecs': record.msecs,
+        'relativeCreated': record.relativeCreated,
+        'process': record.process,
+        'processName': getattr(record, 'processName', None),
+        'thread': record.thread,
+        'threadName': record.threadName,
+        'pathname': record.pathname,
+        'filename': record.filename,
+        'module': record.module,
+        'lineno': record.lineno,
+        'funcName': record.funcName,
+        'exc_text': record.exc_text,
+    }
+
+
+def _finish(fields):
+    fields['levelname'] = logging.getLevelName(fields['levelno'])
+    fields['args'] = None
+    fields['exc_info'] = None
+    return fields
+
+
+class PickleCodec(object):
+    format = FORMAT_PICKLE
+
+    def encode(self, record):
+        # same as SocketHandler.makePickle
+        if record.exc_info and not record.exc_text:
+            logging.Formatter().format(record)
+        fields = dict(record.__dict__)
+        fields['msg'] = record.getMessage()
+        fields['args'] = None
+        fields['exc_info'] = None
+        data = cPickle.dumps(fields, 1)
+        return _length.pack(len(data)) + data
+
+    def decode(self, data):
+        return cPickle.loads(data)
+
+    def is_control(self, data):
+        return False
+
+
+class JSONCodec(object):
+    format = FORMAT_JSON
+
+    def encode(self, record):
+        data = json.dumps(record_fields(record), separators=(',', ':'))
+        return _length.pack(len(data)) + data
+
+    def decode(self, data):
+        return _finish(json.loads(data))
+
+    def is_control(self, data):
+        return False
+
+
+class CompactCodec(object):
+    """
+    Stateful: one instance per connection and direction, since strings are
+    interned in the order they are first sent.
+    """
+    format = FORMAT_COMPACT
+    max_interned = 0xffff
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def _id(self, value, out):
+        value = _text(value)
+        ident = self.ids.get(value)
+        if ident is None:
+            if len(self.strings) >= self.max_interned:
+                # table full, start over; the peer overwrites the ids as they are redefined
+                self.ids.clear()
+                del self.strings[:]
+            ident = len(self.strings)
+            self.strings.append(value)
+            self.ids[value] = ident
+            data = value.encode('utf-8')
+            body = _intern.pack(KIND_INTERN, ident) + data
+            out.append(_length.pack(len(body)) + body)
+        return ident
+
+    def encode(self, record):
+        out = []
+        name = self._id(record.name, out)
+        pathname = self._id(record.pathname, out)
+        func = self._id(record.funcName, out)
+        thread_name = self._id(record.threadName, out)
+        if record.exc_info and not record.exc_text:
+            logging.Formatter().format(record)
+        kind = KIND_RECORD
+        msg = _text(record.getMessage()).encode('utf-8')
+        tail = msg
+        if record.exc_text:
+            kind |= FLAG_EXC_TEXT
+            tail = _length.pack(len(msg)) + msg + _text(record.exc_text).encode('utf-8')
+        body = _record.pack(kind, record.created, record.levelno & 0xff, name, pathname, func, thread_name,
+                            record.lineno or 0, record.process or 0, (record.thread or 0) & 0xffffffffffffffff)
+        body += tail
+        out.append(_length.pack(len(body)) + body)
+        return b''.join(out)
+
+    def is_control(self, data):
+        """True for an intern entry, which must not be dropped: later records refer to it."""
+        return data[:1] == chr(KIND_INTERN)
+
+    def decode(self, data):
+        """Return the record attributes, or None for an intern entry."""
+        kind = ord(data[0])
+        if kind == KIND_INTERN:
+            ident = _intern.unpack_from(data)[1]
+            value = data[_intern.size:].decode('utf-8')
+            strings = self.strings
+            if ident == len(strings):
+                strings.append(value)
+            else:
+                strings[ident] = value
+            return None
+
+        (kind, created, levelno, name, pathname, func, thread_name,
+         lineno, process, thread) = _record.unpack_from(data)
+        strings = self.strings
+        offset = _record.size
+        exc_text = None
+        if kind & FLAG_EXC_TEXT:
+            size = _length.unpack_from(data, offset)[0]
+            offset += 4
+            msg = data[offset:offset + size].decode('utf-8')
+            exc_text = data[offset + size:].decode('utf-8')
+        else:
+            msg = data[offset:].decode('utf-8')
+        pathname = strings[pathname]
+        filename = pathname.replace('\\', '/').rpartition('/')[2]
+        return _finish({
+            'name': strings[name],
+            'levelno': levelno,
+            'msg': msg,
+            'created': created,
+            'msecs': (created - int(created)) * 1000,
+            'process': process,
+            'thread': thread,
+            'threadName': strings[thread_name],
+            'pathname': pathname,
+            'filename': filename,
+            'module': filename.rpartition('.')[0] or filename,
+            'lineno': lineno,
+            'funcName': strings[func],
+            'exc_text': exc_text,
+        })
+
+
+CODECS = {
+    FORMAT_PICKLE: PickleCodec,
+    FORMAT_JSON: JSONCodec,
+    FORMAT_COMPACT: CompactCodec,
+}
+
+
+def connect(host, port=None, format='compact', timeout=1):
+    """
+    Connect to a log server and announce ``format``, returns ``(socket, codec)``.
+    ``port`` None connects to the Unix socket ``host``.
+    """
+    format_id = FORMATS[format]
+    if port is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(host)
+        except socket.error:
+            sock.close()
+            raise
+    else:
+        sock = socket.create_connection((host, port), timeout)
+    if format_id != FORMAT_PICKLE:
+        sock.sendall(MAGIC + chr(format_id))
+    # a new connection starts with an empty intern table
+    return sock, CODECS[format_id]()
+
+
+class LogHandler(logging.handlers.SocketHandler):
+    """
+    `SocketHandler` speaking the ``json`` or ``compact`` format to a log
+    server. ``port`` None connects to the Unix socket ``host``.
+    """
+
+    def __init__(self, host, port=None, format='compact'):
+        if format not in ('json', 'compact'):
+            raise ValueError("unknown format %r" % format)
+        logging.handlers.SocketHandler.__init__(self, host, port)
+        self.format = format
+        self.codec = None
+
+    def makeSocket(self, timeout=1):
+        sock, self.codec = connect(self.host, self.port, self.format, timeout)
+        return sock
+
+    def emit(self, record):
+        try:
+            self.acquire()
+            try:
+                if self.sock is None:
+                    self.createSocket()
+                if self.sock is None:
+                    return
+                try:
+                    self.sock.sendall(self.codec.encode(record))
+                except Exception:
+                    self.sock.close()
+                    self.sock = None
+                    raise
+            finally:
+                self.release()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+def benchmark(count=20000):
+    """Print the per-record decode cost of every format."""
+    record = logging.LogRecord('msocket.benchmark', logging.INFO, __file__, 42,
+                               'request %s took %.3f ms', ('/index.html', 12.5), None, 'handle')
+    fields = dict(record.__dict__)
+    fields['msg'] = record.getMessage()
+    fields['args'] = None
+    pickled = cPickle.dumps(fields, 1)
+    samples = [(FORMAT_PICKLE, 'pickle', [pickled] * count)]
+    for format_id in (FORMAT_JSON, FORMAT_COMPACT):
+        codec = CODECS[format_id]()
+        frames = []
+        for _ in range(count):
+            data = codec.encode(record)
+            while data:
+                size = _length.unpack_from(data)[0]
+                frames.append(data[4:4 + size])
+                data = data[4 + size:]
+        name = [k for k, v in FORMATS.items() if v == format_id][0]
+        samples.append((format_id, name, frames))
+
+    print("%-8s %10s %12s %12s" % ('format', 'bytes', 'decode us', '+record us'))
+    for format_id, name, frames in samples:
+        decode = CODECS[format_id]().decode
+        size = sum(len(f) for f in frames) / float(count)
+        started = time.time()
+        decoded = [decode(frame) for frame in frames]
+        decoding = time.time() - started
+        started = time.time()
+        for fields in decoded:
+            if fields is not None:
+                logging.makeLogRecord(fields)
+        building = time.time() - started
+        print("%-8s %10.1f %12.2f %12.2f" % (name, size, decoding / count * 1e6, (decoding + building) / count * 1e6))
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,18 +1,23 @@
 # -*- coding:utf8 -*-
 from __future__ import absolute_import
 
+import errno
 import socket
 import struct
+import time
 import cPickle
+import functools
 import logging
-import Queue
 import threading
+import collections
 from logging.config import RESET_ERROR, dictConfig, fileConfig
 
 from ..compat import socketserver, address_type
 from msocket import server
+from .logformat import MAGIC, CODECS, FORMATS, connect
 
 LOG_SERVERS = {}
+LOG_DATAGRAM_SERVERS = {}
 LOG_CONFIG_SERVERS = {}
 
 
@@ -60,26 +65,168 @@ class LoggingConfigRequestHandler(socketserver.StreamRequestHandler):
 
 
 class LogWriter(object):
-    def __init__(self):
+    """
+    Unpickles and handles received log records on ``threads`` writer threads.
+
+    Records are sharded by source (the connection they came from, or the
+    logger name), so the records of one source are handled in order by a
+    single thread. Each thread takes up to ``batch_size`` records per wakeup.
+
+    Each shard holds at most ``queue_size`` records, when it is full the
+    ``policy`` applies:
+
+    - ``block``: wait for room (back pressure on the senders). A caller
+      passing ``on_drain`` is never blocked: its records are queued anyway
+      and ``on_drain()`` is called once the shard is below ``queue_size``
+      again, the log servers stop reading the source socket meanwhile
+    - ``drop_oldest``: discard the oldest queued record
+    - ``sample``: keep one in ``sample_rate`` new records, replacing the oldest
+
+    Control entries of a stateful codec (see ``is_control`` in `logformat`)
+    are never dropped.
+
+    With a ``sink`` (e.g. `logstore.LogStore`) each batch is passed to
+    ``sink.extend([(record, log_name), ...])`` instead of being handled by
+    the local loggers.
+    """
+    policies = ('block', 'drop_oldest', 'sample')
+
+    def __init__(self, threads=1, queue_size=10000, policy='block', batch_size=256, sample_rate=10, sink=None):
+        if policy not in self.policies:
+            raise ValueError("unknown policy %r" % policy)
         self.stop = False
-        self.queue = Queue.Queue()
-        writer_thread = threading.Thread(target=self.writer)
-        writer_thread.daemon = True
-        writer_thread.start()
-        self.writer_thread = writer_thread
-
-    def write_log(self, chunk, log_name=None):
-        self.queue.put((chunk, log_name))
-
-    def writer(self):
-        queue = self.queue
-        while not self.stop:
-            data = queue.get()
-            if data:
-                chunk, log_name = data
-                obj = self.unPickle(chunk)
-                record = logging.makeLogRecord(obj)
-                self.handleLogRecord(record, log_name)
+        self.queue_size = queue_size
+        self.policy = policy
+        self.batch_size = batch_size
+        self.sample_rate = sample_rate
+        self.sink = sink
+        self.started = time.time()
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+        self.counter_lock = threading.Lock()
+        self.shards = []
+        self.writer_threads = []
+        for i in range(max(1, threads)):
+            # records, condition, on_drain callbacks, sampling counter
+            shard = (collections.deque(), threading.Condition(threading.Lock()), [], [0])
+            self.shards.append(shard)
+            writer_thread = threading.Thread(target=self.writer, args=shard, name='log-writer-%d' % i)
+            writer_thread.daemon = True
+            writer_thread.start()
+            self.writer_threads.append(writer_thread)
+        self.writer_thread = self.writer_threads[0]
+
+    def write_log(self, chunk, log_name=None, source=None, codec=None, on_drain=None):
+        return self.write_logs((chunk,), log_name, source, codec, on_drain)
+
+    def write_logs(self, chunks, log_name=None, source=None, codec=None, on_drain=None):
+        """
+        Queue encoded records of one ``source``, sharding by ``log_name`` when
+        it is None. ``codec`` decodes them (see `logformat`), pickles by default.
+
+        Returns False when the shard is full under the ``block`` policy and
+        ``on_drain`` will be called, True otherwise.
+        """
+        shards = self.shards
+        items, cond, drain_callbacks, overflowed = shards[hash(source if source is not None else log_name) % len(shards)]
+        dropped = 0
+        with cond:
+            for chunk in chunks:
+                if len(items) >= self.queue_size:
+                    if self.policy == 'block':
+                        if on_drain is None:
+                            cond.notify_all()
+                            while len(items) >= self.queue_size and not self.stop:
+                                cond.wait()
+                    elif codec is not None and codec.is_control(chunk):
+                        # e.g. a compact format intern entry, the records after it depend on it
+                        pass
+                    elif self.policy == 'drop_oldest':
+                        dropped += self._drop_oldest(items)
+                    else:
+                        overflowed[0] += 1
+                        if overflowed[0] % self.sample_rate:
+                            dropped += 1
+                            continue
+                        dropped += self._drop_oldest(items)
+                items.append((chunk, log_name, codec))
+            stalled = on_drain is not None and len(items) >= self.queue_size and self.policy == 'block'
+            if stalled:
+                drain_callbacks.append(on_drain)
+            cond.notify_all()
+        with self.counter_lock:
+            self.received += len(chunks)
+            self.dropped += dropped
+        return not stalled
+
+    @staticmethod
+    def _drop_oldest(items):
+        """Discard the oldest record of ``items``, keeping the control entries queued ahead of it."""
+        kept = []
+        dropped = 0
+        while items:
+            item = items.popleft()
+            codec = item[2]
+            if codec is None or not codec.is_control(item[0]):
+                dropped = 1
+                break
+            kept.append(item)
+        items.extendleft(reversed(kept))
+        return dropped
+
+    def writer(self, items, cond, drain_callbacks, overflowed):
+        batch_size = self.batch_size
+        while True:
+            with cond:
+                while not items and not self.stop:
+                    cond.wait()
+                if not items:
+                    return
+                n = min(len(items), batch_size)
+                batch = [items.popleft() for _ in range(n)]
+                # wake producers blocked on a full shard
+                cond.notify_all()
+                drained = ()
+                if drain_callbacks and len(items) < self.queue_size:
+                    drained = drain_callbacks[:]
+                    del drain_callbacks[:]
+
+            for on_drain in drained:
+                try:
+                    on_drain()
+                except Exception:
+                    server.logger.exception("Error resuming a log source")
+
+            written = errors = 0
+            sink = self.sink
+            records = []
+            for chunk, log_name, codec in batch:
+                try:
+                    obj = self.unPickle(chunk) if codec is None else codec.decode(chunk)
+                    if obj is None:
+                        # not a record, e.g. a compact format intern entry
+                        continue
+                    record = logging.makeLogRecord(obj)
+                    if sink is not None:
+                        records.append((record, log_name))
+                        continue
+                    self.handleLogRecord(record, log_name)
+                    written += 1
+                except Exception:
+                    errors += 1
+            if records:
+                try:
+                    sink.extend(records)
+                    written += len(records)
+                except Exception:
+                    errors += len(records)
+            with self.counter_lock:
+                self.written += written
+                self.errors += errors
+                self.batches += 1
 
     def unPickle(self, data):
         return cPickle.loads(data)
@@ -96,14 +243,295 @@ class LogWriter(object):
         # cycles and network bandwidth!
         logger.handle(record)
 
+    def queued(self):
+        return sum(len(shard[0]) for shard in self.shards)
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        with self.counter_lock:
+            return {
+                'received': self.received,
+                'written': self.written,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'batches': self.batches,
+                'queued': self.queued(),
+                'records_per_second': self.written / elapsed if elapsed > 0 else 0.0,
+            }
+
     def shutdown(self):
+        """Stop the writer threads once the queued records are handled."""
         self.stop = True
-        self.queue.put(None)
+        for _, cond, drain_callbacks, _ in self.shards:
+            with cond:
+                drained = drain_callbacks[:]
+                del drain_callbacks[:]
+                cond.notify_all()
+            for on_drain in drained:
+                try:
+                    on_drain()
+                except Exception:
+                    pass
+
+
+class BatchingSocketHandler(logging.Handler):
+    """
+    Client handler shipping records to a log server from a background thread.
+
+    `emit` only queues a copy of the record. The sender thread encodes
+    queued records (``compact`` format by default, see `logformat`) and
+    writes them with a single ``sendall`` once ``batch_size`` records are
+    queued or ``flush_interval`` seconds passed. While the server is
+    unreachable it reconnects with exponential backoff, keeping at most
+    ``spill_size`` records and discarding the oldest beyond that.
+    Records of a failed write are sent again, so a connection lost
+    mid-batch can deliver some of them twice.
+    Records that cannot be encoded are reported with `handleError` and dropped.
+    """
+
+    def __init__(self, host, port=None, format='compact', batch_size=256, flush_interval=0.2,
+                 spill_size=10000, max_backoff=30.0):
+        if format not in FORMATS:
+            raise ValueError("unknown format %r" % format)
+        logging.Handler.__init__(self)
+        self.host = host
+        self.port = port
+        self.format = format
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_size = spill_size
+        self.max_backoff = max_backoff
+        self.sock = None
+        self.codec = None
+        self.pending = collections.deque()
+        self.cond = threading.Condition(threading.Lock())
+        self.closing = False
+        self.sent = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.sender_thread = threading.Thread(target=self.sender, name='log-sender')
+        self.sender_thread.daemon = True
+        self.sender_thread.start()
+
+    def prepare(self, record):
+        """Copy of ``record`` with the message merged and the traceback formatted, safe to encode later."""
+        if record.exc_info and not record.exc_text:
+            logging.Formatter().format(record)
+        fields = dict(record.__dict__)
+        fields['msg'] = record.getMessage()
+        fields['args'] = None
+        fields['exc_info'] = None
+        return logging.makeLogRecord(fields)
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+            return
+        pending = self.pending
+        with self.cond:
+            if len(pending) >= self.spill_size:
+                pending.popleft()
+                self.dropped += 1
+            pending.append(record)
+            if len(pending) >= self.batch_size:
+                self.cond.notify()
+
+    def flush(self):
+        with self.cond:
+            self.cond.notify()
+
+    def sender(self):
+        pending = self.pending
+        cond = self.cond
+        backoff = 0
+        retry_at = 0
+        while True:
+            with cond:
+                if backoff:
+                    # emit notifies on every record once a batch is queued,
+                    # keep waiting until the next attempt is due
+                    while not self.closing:
+                        delay = retry_at - time.time()
+                        if delay <= 0:
+                            break
+                        cond.wait(delay)
+                elif len(pending) < self.batch_size and not self.closing:
+                    cond.wait(self.flush_interval)
+                if not pending:
+                    if self.closing:
+                        return
+                    continue
+                batch = list(pending)[:self.batch_size]
+
+            try:
+                if self.sock is None:
+                    self.sock, self.codec = connect(self.host, self.port, self.format)
+                encode = self.codec.encode
+                encoded = []
+                failed = []
+                for record in batch:
+                    try:
+                        encoded.append(encode(record))
+                    except Exception:
+                        failed.append(record)
+                        self.handleError(record)
+                if failed:
+                    self.discard(failed)
+                    # a stateful codec may have interned strings that were never sent
+                    self.sock.close()
+                    self.sock = None
+                    continue
+                self.sock.sendall(b''.join(encoded))
+            except (socket.error, IOError):
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                self.reconnects += 1
+                backoff = min(self.max_backoff, (backoff or self.flush_interval) * 2)
+                retry_at = time.time() + backoff
+                if self.closing:
+                    return
+                continue
+            backoff = 0
+
+            with cond:
+                # the oldest records may have been dropped meanwhile, what is
+                # left of the batch is still at the front
+                sent = set(map(id, batch))
+                while pending and id(pending[0]) in sent:
+                    pending.popleft()
+                self.sent += len(batch)
+
+    def discard(self, records):
+        """Remove ``records`` that cannot be encoded from the queue."""
+        failed = set(map(id, records))
+        with self.cond:
+            kept = [record for record in self.pending if id(record) not in failed]
+            self.dropped += len(self.pending) - len(kept)
+            self.pending.clear()
+            self.pending.extend(kept)
+
+    def close(self, timeout=5.0):
+        """Send what is queued (waiting at most ``timeout`` seconds) and disconnect."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.sender_thread.join(timeout)
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        logging.Handler.close(self)
+
+
+class RecordTooLarge(ValueError):
+    pass
+
+
+class RecordDecoder(object):
+    """
+    Incremental decoder of length prefixed records read from a non-blocking
+    socket.
+
+    Data is received with ``recv_into`` straight into a reusable buffer,
+    which only grows to hold a record larger than ``buffer_size``.
+    """
+    header = struct.Struct('>L')
+
+    def __init__(self, buffer_size=64 * 1024, max_record_size=16 * 1024 * 1024):
+        self.buffer_size = buffer_size
+        self.max_record_size = max_record_size
+        self.buffer = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
+        # wire format announced by the peer, None until the first bytes arrived
+        self.format = None
+
+    def recv(self, sock):
+        """
+        Read what is available from ``sock`` and return the complete records.
+        Returns None at EOF, raises `RecordTooLarge` for an oversized record.
+        """
+        buf = self.buffer
+        if self.end == len(buf):
+            self._make_room(len(buf) if self.start else len(buf) * 2)
+            buf = self.buffer
+        try:
+            n = sock.recv_into(memoryview(buf)[self.end:])
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise
+        if not n:
+            return None
+        self.end += n
+        return self.records()
+
+    def records(self):
+        records = []
+        buf = self.buffer
+        unpack = self.header.unpack_from
+        start, end = self.start, self.end
+        if self.format is None:
+            if end - start < len(MAGIC) + 1 and buf[start:end] == MAGIC[:end - start]:
+                return records
+            if buf[start:start + len(MAGIC)] == MAGIC:
+                self.format = buf[start + len(MAGIC)]
+                start += len(MAGIC) + 1
+            else:
+                self.format = 0
+        while end - start >= 4:
+            size = unpack(buf, start)[0]
+            if size > self.max_record_size:
+                raise RecordTooLarge(size)
+            if end - start - 4 < size:
+                if start + 4 + size > len(buf):
+                    # make room for the rest of this record
+                    self.start = start
+                    self._make_room(4 + size)
+                    return records
+                break
+            records.append(bytes(buf[start + 4:start + 4 + size]))
+            start += 4 + size
+        if start == end:
+            start = end = 0
+        self.start, self.end = start, end
+        return records
+
+    def _make_room(self, size):
+        """Move the pending bytes to the front of a buffer of at least ``size`` bytes."""
+        pending = self.end - self.start
+        buf = self.buffer
+        if size > len(buf):
+            new = bytearray(size)
+            new[:pending] = buf[self.start:self.end]
+            self.buffer = new
+        elif self.start:
+            buf[:pending] = buf[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def shrink(self):
+        """Drop a buffer grown for a large record once nothing is pending."""
+        if self.end == 0 and len(self.buffer) > self.buffer_size:
+            self.buffer = bytearray(self.buffer_size)
 
 
 class LOGServerMixIn(server.ExternalReactorMixIn):
     log_name = None
     writer = None
+    # records announcing a larger size close the connection
+    max_record_size = 16 * 1024 * 1024
+    recv_buffer_size = 64 * 1024
+    # see LogWriter
+    writer_threads = 1
+    writer_queue_size = 10000
+    writer_policy = 'block'
+    writer_sink = None
+    # accept clients sending pickles, only the json and compact formats are safe to expose
+    allow_pickle = True
 
     def shutdown_request(self, request):
         pass
@@ -111,6 +539,9 @@ class LOGServerMixIn(server.ExternalReactorMixIn):
     def dispatch(self, sock):
         if sock is self.socket:
             request, client_address = self.get_request()
+            request.setblocking(0)
+            request.log_decoder = RecordDecoder(self.recv_buffer_size, self.max_record_size)
+            request.log_codec = None
             self.get_reactor().add_server(self, request)
         else:
             request = sock
@@ -119,7 +550,8 @@ class LOGServerMixIn(server.ExternalReactorMixIn):
     def get_writer(self):
         writer = self.writer
         if writer is None:
-            writer = LogWriter()
+            writer = LogWriter(self.writer_threads, self.writer_queue_size, self.writer_policy,
+                               sink=self.writer_sink)
             LOGServerMixIn.writer = writer
         return writer
 
@@ -128,19 +560,81 @@ class LOGServerMixIn(server.ExternalReactorMixIn):
         Handle multiple requests - each expected to be a 4-byte length,
         followed by the LogRecord in pickle format. Logs the record
         according to whatever policy is configured locally.
+
+        Never blocks: whatever is available is read and every complete
+        record is queued, a partial record waits for the next call.
         """
-        chunk = sock.recv(4)
-        if len(chunk) < 4:
+        decoder = sock.log_decoder
+        try:
+            records = decoder.recv(sock)
+        except RecordTooLarge, e:
+            server.logger.warning("Closing %s: log record of %d bytes exceeds %d",
+                                  sock, e.args[0], decoder.max_record_size)
+            records = None
+        except socket.error, e:
+            if e.args[0] != RESET_ERROR:
+                server.logger.warning("Closing %s: %s", sock, e)
+            records = None
+
+        if records and sock.log_codec is None:
+            codec = CODECS.get(decoder.format)
+            if codec is None or (decoder.format == 0 and not self.allow_pickle):
+                server.logger.warning("Closing %s: log format %d not accepted", sock, decoder.format)
+                records = None
+            elif decoder.format:
+                # stateful, one per connection
+                sock.log_codec = codec()
+
+        if records is None:
             self.get_reactor().del_server(sock)
             sock.close()
             return
-        slen = struct.unpack('>L', chunk)[0]
-        chunk = sock.recv(slen)
-        while len(chunk) < slen:
-            chunk = chunk + sock.recv(slen - len(chunk))
+
+        if records:
+            # records of one connection stay in order
+            if not self.get_writer().write_logs(records, self.log_name, sock.fileno(), sock.log_codec,
+                                                self.drain_callback(sock)):
+                self.get_reactor().suspend(sock)
+            decoder.shrink()
+
+    def drain_callback(self, sock):
+        """``on_drain`` for `LogWriter`: resume reading ``sock`` on the reactor thread."""
+        return functools.partial(self.get_reactor().call_later, 0, self.resume_reading, sock)
+
+    def resume_reading(self, sock):
+        try:
+            self.get_reactor().resume(sock)
+        except socket.error:
+            # closed meanwhile
+            pass
+
+
+class DatagramLOGServerMixIn(LOGServerMixIn):
+    """
+    Receives ``logging.handlers.DatagramHandler`` traffic: one length
+    prefixed pickle per datagram. Datagrams carry no format negotiation, so
+    nothing is accepted without `allow_pickle`.
+    """
+
+    def dispatch(self, sock):
+        sources = {}
+        unpack = RecordDecoder.header.unpack_from
+        for data, address in sock.recv_many():
+            if len(data) < 4 or unpack(data)[0] != len(data) - 4 or len(data) - 4 > self.max_record_size:
+                continue
+            sources.setdefault(address, []).append(data[4:])
+        if not sources or not self.allow_pickle:
+            return
 
         writer = self.get_writer()
-        writer.write_log(chunk, self.log_name)
+        on_drain = self.drain_callback(sock)
+        stalled = False
+        for address, records in sources.items():
+            if not writer.write_logs(records, self.log_name, address, on_drain=on_drain):
+                stalled = True
+        if stalled:
+            # the kernel drops what does not fit in the socket buffer meanwhile
+            self.get_reactor().suspend(sock)
 
 
 class TCPLogServer(LOGServerMixIn, server.TCPServer):
@@ -148,6 +642,11 @@ class TCPLogServer(LOGServerMixIn, server.TCPServer):
         server.TCPServer.__init__(self, server_address, None, bind_and_activate)
 
 
+class UDPLogServer(DatagramLOGServerMixIn, server.UDPServer):
+    def __init__(self, server_address, bind_and_activate=True):
+        server.UDPServer.__init__(self, server_address, None, bind_and_activate)
+
+
 class LogConfigServer(server.TCPServer):
     def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
         server.TCPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
@@ -160,6 +659,12 @@ if hasattr(socket, 'AF_UNIX'):
 
     LOG_SERVERS['AF_UNIX'] = UnixStreamLogServer
 
+    class UnixDatagramLogServer(DatagramLOGServerMixIn, server.UnixDatagramServer):
+        def __init__(self, server_address, bind_and_activate=True):
+            server.UnixDatagramServer.__init__(self, server_address, None, bind_and_activate)
+
+    LOG_DATAGRAM_SERVERS['AF_UNIX'] = UnixDatagramLogServer
+
     class UnixStreamLogConfigServer(server.UnixStreamServer):
         def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
             server.UnixStreamServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
@@ -167,10 +672,13 @@ if hasattr(socket, 'AF_UNIX'):
     LOG_CONFIG_SERVERS['AF_UNIX'] = UnixStreamLogConfigServer
 
 
-def make_log_server(server_address, bind_and_activate=True):
+def make_log_server(server_address, bind_and_activate=True, datagram=False):
     family = address_type(server_address)
 
-    server_cls = LOG_SERVERS.get(family, TCPLogServer)
+    if datagram:
+        server_cls = LOG_DATAGRAM_SERVERS.get(family, UDPLogServer)
+    else:
+        server_cls = LOG_SERVERS.get(family, TCPLogServer)
     return server_cls(server_address, bind_and_activate)
 
 
@@ -0,0 +1,325 @@
+# -*- coding:utf8 -*-
+"""
+Append-only on-disk store of log records, usable as the ``sink`` of
+`LogWriter`.
+
+Records are written into memory-mapped segment files of ``segment_size``
+bytes. A new segment is started when the current one is full or older than
+``segment_age`` seconds. Every ``index_interval`` bytes a segment is cut
+into blocks. For each block, the index keeps the range of record
+timestamps, the levels present and the logger names present. Queries only
+read the blocks that can match, straight from the mapping.
+
+Layout of ``<directory>/<start in microseconds>.log``, one record after the
+other, followed by zeros::
+
+    >IdBHI  record size, created, levelno, name length, message length
+            name, message and exception text, utf-8
+
+``.idx`` next to it holds one JSON line per finished block.
+"""
+from __future__ import absolute_import
+
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+import threading
+
+__author__ = 'fujie'
+
+_header = struct.Struct('>IdBHI')
+HEADER_SIZE = _header.size
+MAX_NAME_LENGTH = 0xffff
+
+
+def _level_bit(levelno):
+    return 1 << min(max(levelno, 0) // 10, 7)
+
+
+def _utf8(value):
+    if value is None:
+        return b''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _logger_match(name, prefix):
+    return name == prefix or name.startswith(prefix + '.')
+
+
+class Block(object):
+    __slots__ = ('start', 'end', 'first', 'last', 'levels', 'loggers')
+
+    def __init__(self, start, end=None, first=None, last=None, levels=0, loggers=()):
+        self.start = start
+        self.end = start if end is None else end
+        self.first = first
+        self.last = last
+        self.levels = levels
+        self.loggers = set(loggers)
+
+    def add(self, end, created, levelno, name):
+        self.end = end
+        if self.first is None or created < self.first:
+            self.first = created
+        if self.last is None or created > self.last:
+            self.last = created
+        self.levels |= _level_bit(levelno)
+        self.loggers.add(name)
+
+    def matches(self, since, until, level, logger):
+        if self.first is None:
+            return False
+        if since is not None and self.last < since:
+            return False
+        if until is not None and self.first > until:
+            return False
+        if level is not None and not self.levels >> min(max(level, 0) // 10, 7):
+            return False
+        if logger is not None and not any(_logger_match(n, logger) for n in self.loggers):
+            return False
+        return True
+
+    def to_json(self):
+        return json.dumps({'start': self.start, 'end': self.end, 'first': self.first, 'last': self.last,
+                           'levels': self.levels, 'loggers': sorted(self.loggers)})
+
+    @classmethod
+    def from_json(cls, line):
+        d = json.loads(line)
+        return cls(d['start'], d['end'], d['first'], d['last'], d['levels'], d['loggers'])
+
+
+class Segment(object):
+    def __init__(self, path, capacity=None):
+        self.path = path
+        self.index_path = path[:-4] + '.idx'
+        self.started = int(os.path.basename(path)[:-4]) / 1e6
+        self.blocks = []
+        self.writable = capacity is not None
+        if self.writable:
+            with open(path, 'wb') as f:
+                f.truncate(capacity)
+            self.capacity = capacity
+        else:
+            self.capacity = os.path.getsize(path)
+        self.map = None
+        self.end = 0
+        self.index_file = None
+        if self.capacity:
+            with open(path, 'r+b' if self.writable else 'rb') as f:
+                access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+                self.map = mmap.mmap(f.fileno(), self.capacity, access=access)
+        if self.writable:
+            self.index_file = open(self.index_path, 'ab')
+            self.blocks.append(Block(0))
+        else:
+            self.load()
+
+    def load(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                self.blocks = [Block.from_json(line) for line in f if line.strip()]
+        self.end = self.blocks[-1].end if self.blocks else 0
+        # records written after the last indexed block, e.g. after a crash
+        block = Block(self.end)
+        for offset, size, created, levelno, name in self.scan(self.end):
+            block.add(offset + size, created, levelno, name)
+        if block.first is not None:
+            self.blocks.append(block)
+            self.end = block.end
+
+    def scan(self, offset):
+        """Yield ``(offset, size, created, levelno, name)`` of the records from ``offset``."""
+        m = self.map
+        if m is None:
+            return
+        limit = self.capacity
+        unpack = _header.unpack_from
+        while offset + HEADER_SIZE <= limit:
+            size, created, levelno, name_length, _ = unpack(m, offset)
+            if not size or offset + size > limit:
+                break
+            start = offset + HEADER_SIZE
+            yield offset, size, created, levelno, m[start:start + name_length].decode('utf-8')
+            offset += size
+
+    def append(self, data, created, levelno, name, index_interval):
+        end = self.end + len(data)
+        self.map[self.end:end] = data
+        block = self.blocks[-1]
+        block.add(end, created, levelno, name)
+        self.end = end
+        if block.end - block.start >= index_interval:
+            self.index_file.write(block.to_json() + '\n')
+            self.index_file.flush()
+            self.blocks.append(Block(end))
+
+    def seal(self):
+        """Stop writing; the file keeps its size so open readers never map past its end."""
+        if not self.writable:
+            return
+        self.writable = False
+        block = self.blocks[-1]
+        if block.first is not None:
+            self.index_file.write(block.to_json() + '\n')
+        else:
+            self.blocks.pop()
+        self.index_file.close()
+        self.index_file = None
+        self.map.flush()
+
+    def close(self):
+        self.seal()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class LogStore(object):
+    """
+    Segmented, indexed record store, see the module documentation.
+    ``max_segments`` removes the oldest segments beyond that number.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, segment_age=3600, index_interval=64 * 1024,
+                 max_segments=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.index_interval = index_interval
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = [Segment(os.path.join(directory, name))
+                         for name in sorted(os.listdir(directory)) if name.endswith('.log')]
+        self.current = None
+
+    def _rotate(self, size):
+        if self.current is not None:
+            self.current.seal()
+        started = int(time.time() * 1e6)
+        if self.segments and self.segments[-1].started * 1e6 >= started:
+            started = int(self.segments[-1].started * 1e6) + 1
+        path = os.path.join(self.directory, '%020d.log' % started)
+        self.current = Segment(path, max(self.segment_size, size))
+        self.segments.append(self.current)
+        if self.max_segments:
+            while len(self.segments) > self.max_segments:
+                self.segments.pop(0).remove()
+
+    def append(self, record, name=None):
+        self.extend([(record, name)])
+
+    def extend(self, records):
+        """Append ``[(LogRecord, name or None), ...]``, the name overriding ``record.name``."""
+        encoded = []
+        for record, name in records:
+            if name is None:
+                name = record.name
+            name = _utf8(name)
+            if len(name) > MAX_NAME_LENGTH:
+                # the header stores it in 16 bits, cut on a character boundary
+                name = name[:MAX_NAME_LENGTH].decode('utf-8', 'ignore').encode('utf-8')
+            msg = _utf8(record.getMessage())
+            exc_text = _utf8(record.exc_text)
+            size = HEADER_SIZE + len(name) + len(msg) + len(exc_text)
+            levelno = min(max(record.levelno, 0), 255)
+            try:
+                header = _header.pack(size, record.created, levelno, len(name), len(msg))
+            except struct.error:
+                # over 4GiB, drop this record only; logging it here would feed the sink again
+                continue
+            data = header + name + msg + exc_text
+            encoded.append((data, record.created, levelno, name.decode('utf-8')))
+
+        with self.lock:
+            now = time.time()
+            for data, created, levelno, name in encoded:
+                current = self.current
+                if (current is None or current.end + len(data) > current.capacity or
+                        (self.segment_age and now - current.started > self.segment_age)):
+                    self._rotate(len(data))
+                    current = self.current
+                current.append(data, created, levelno, name, self.index_interval)
+
+    def query(self, since=None, until=None, logger=None, level=None, contains=None, limit=None):
+        """
+        Yield the records matching every given condition as dicts, oldest
+        segment first: ``since``/``until`` bound ``created``, ``logger`` is
+        a logger name prefix (``"a.b"`` matches ``"a.b"`` and ``"a.b.c"``),
+        ``level`` the minimum levelno and ``contains`` a substring of the
+        message or exception text.
+        """
+        if contains is not None:
+            contains = _utf8(contains)
+        with self.lock:
+            plan = []
+            for segment in self.segments:
+                blocks = [(b.start, b.end) for b in segment.blocks
+                          if b.matches(since, until, level, logger)]
+                if blocks:
+                    plan.append((segment, blocks))
+
+        count = 0
+        for segment, blocks in plan:
+            m = segment.map
+            if m is None:
+                continue
+            try:
+                for result in self._read(m, blocks, since, until, level, logger, contains):
+                    yield result
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+            except ValueError:
+                # removed by max_segments meanwhile
+                continue
+
+    @staticmethod
+    def _read(m, blocks, since, until, level, logger, contains):
+        unpack = _header.unpack_from
+        for start, end in blocks:
+            offset = start
+            while offset + HEADER_SIZE <= end:
+                size, created, levelno, name_length, msg_length = unpack(m, offset)
+                if not size:
+                    break
+                record, offset = offset, offset + size
+                if since is not None and created < since or until is not None and created > until:
+                    continue
+                if level is not None and levelno < level:
+                    continue
+                pos = record + HEADER_SIZE
+                name = m[pos:pos + name_length].decode('utf-8')
+                if logger is not None and not _logger_match(name, logger):
+                    continue
+                pos += name_length
+                text = m[pos:offset]
+                if contains is not None and contains not in text:
+                    continue
+                yield {
+                    'created': created,
+                    'levelno': levelno,
+                    'levelname': logging.getLevelName(levelno),
+                    'name': name,
+                    'msg': text[:msg_length].decode('utf-8', 'replace'),
+                    'exc_text': text[msg_length:].decode('utf-8', 'replace') or None,
+                }
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.current = None
@@ -1,70 +1,490 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import errno
+import socket
+import collections
+import struct
+import cPickle
 import multiprocessing.managers
-from multiprocessing.managers import SyncManager as _SyncManager
+from multiprocessing import connection
+from multiprocessing.managers import SyncManager as _SyncManager, Token, convert_to_error, format_exc
 import threading
 
+from ..server import Reactor, AcceptedStreamSocket, WorkerPool, request_context, MSG_DONTWAIT
+from .cached import Versioned, VersionedDict, CachedDictProxy
+from .sharedmem import (
+    SharedSegment, SharedArray, SharedRingBuffer, SharedBufferProxy, SharedArrayProxy, SharedRingBufferProxy
+)
+
 __author__ = 'yasu'
 
+# length prefix of multiprocessing.connection messages
+_frame = struct.Struct('!I')
+
+
+class ManagerConnection(AcceptedStreamSocket):
+    '''
+    Proxy connection registered on the reactor between requests
+    '''
+
+    def __init__(self, conn, family):
+        self.connection = conn
+        sock = socket.fromfd(conn.fileno(), family, socket.SOCK_STREAM)
+        AcceptedStreamSocket.__init__(self, sock, sock.getpeername() or sock.getsockname())
+
+    def close(self):
+        self.connection.close()
+        AcceptedStreamSocket.close(self)
+
+
+class NotifyChannel(ManagerConnection):
+    '''
+    Connection pushing version changes of `Versioned` objects to a client
+    process, written without blocking
+    '''
+
+    def __init__(self, conn, family):
+        ManagerConnection.__init__(self, conn, family)
+        self.socket.setblocking(0)
+        self.inbound = bytearray()
+        self.outbound = bytearray()
+        self.write_lock = threading.Lock()
+        self.idents = set()
+        self.closed = False
+
 
 class ManagerServer(multiprocessing.managers.Server):
+    '''
+    Manager server on a reactor.
+
+    Idle proxy connections are polled by the reactor instead of holding a
+    thread each; a request is served on a pool of ``pool_size`` threads,
+    together with the requests pipelined behind it on the same connection.
+    When every pool thread is busy requests wait for one. If the pool then
+    finishes nothing for ``stall_interval`` seconds (e.g. every thread is
+    blocked in ``Queue.get`` or ``Event.wait``) the waiting requests get a
+    thread of their own, at most ``max_overflow_threads`` at a time, so
+    blocked calls do not starve the calls that would release them.
+
+    Objects are created and reference counted under one of
+    ``lock_stripes`` locks chosen by ident rather than a global lock, so a
+    slow factory only delays calls for the same ident.
+
+    A request with the method name ``#batch`` carries a list of calls and
+    is answered with ``('#BATCH', [reply, ...])`` in the same order, see
+    `Batch`.
+
+    A connection opened with ``subscribe`` becomes a `NotifyChannel`: the
+    client sends ``('subscribe', ident)`` on it and receives
+    ``('#NOTIFY', ident, version)`` whenever a call changes the
+    ``version`` of that `Versioned` object, and ``('#DISPOSED', ident,
+    None)`` when it is gone, see `CachedDictProxy`.
+    '''
     manager = multiprocessing.managers.SyncManager
+    pool_size = 16
+    pool = None
+    busy = 0
+    # threads started beyond the pool while it is stalled
+    max_overflow_threads = 64
+    overflow = 0
+    stall_interval = 0.1
+    # requests completed by the pool, to tell a stalled pool from a busy one
+    completed = 0
+    stall_timer = None
+    # locks of the object table, an ident always maps to the same one
+    lock_stripes = 64
+    public = multiprocessing.managers.Server.public + ['subscribe']
+    # a notification channel this far behind is closed
+    max_notify_buffer = 1024 * 1024
+
+    def __init__(self, registry, address, authkey, serializer):
+        multiprocessing.managers.Server.__init__(self, registry, address, authkey, serializer)
+        self.stripes = [threading.RLock() for _ in range(self.lock_stripes)]
+        # (func, args) waiting for a pool thread
+        self.pending = collections.deque()
+        # ident: Event of the objects being created
+        self.creating = {}
+        # ident: NotifyChannels subscribed to it
+        self.subscribers = {}
+        self.notify_lock = threading.Lock()
 
     @property
     def socket(self):
         return self.listener._listener._socket
 
+    def get_reactor(self):
+        reactor = getattr(self, '__reactor__', None)
+        if reactor is None:
+            # first called by dispatch, kept for the pool threads
+            reactor = request_context.reactor
+            setattr(self, '__reactor__', reactor)
+        return reactor
+
+    def serve_forever(self):
+        '''
+        Run the server on a reactor of its own, e.g. in the process of `SyncManager.start`
+        '''
+        multiprocessing.managers.current_process()._manager_server = self
+        reactor = Reactor()
+        setattr(self, '__reactor__', reactor)
+        reactor.add_server(self)
+        try:
+            reactor.run()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.stop = 999
+            self.listener.close()
+
     def dispatch(self, sock):
         '''
-        Run the server forever
+        Accept a connection or serve a ready proxy connection
         '''
 
         multiprocessing.managers.current_process()._manager_server = self
 
+        if isinstance(sock, NotifyChannel):
+            self.read_subscriptions(sock)
+            return
+
+        if sock is not self.socket:
+            self.get_reactor().suspend(sock)
+            self.submit(self.serve_ready, sock)
+            return
+
         c = self.listener.accept()
-        t = threading.Thread(target=self.handle_request, args=(c, ))
-        t.daemon = True
-        t.start()
+        self.submit(self.handle_request, c)
 
-    def server_close(self):
-        pass
+    def submit(self, func, *args):
+        with self.mutex:
+            if self.pool is None:
+                self.pool = WorkerPool(self.pool_size, name='manager')
+            if self.busy >= self.pool_size:
+                self.pending.append((func, args))
+                if self.stall_timer is None:
+                    self.stall_timer = self.get_reactor().call_later(
+                        self.stall_interval, self._check_stall, self.completed)
+                return
+            self.busy += 1
+        self.pool.submit(self._run_pooled, func, args)
 
-    def create(self, c, typeid, *args, **kwds):
+    def _run_pooled(self, func, args):
+        try:
+            func(*args)
+        finally:
+            with self.mutex:
+                self.completed += 1
+                task = self.pending.popleft() if self.pending else None
+                if task is None:
+                    self.busy -= 1
+            if task is not None:
+                self.pool.submit(self._run_pooled, *task)
+
+    def _check_stall(self, completed):
+        """Reactor timer: start overflow threads if the pool finished nothing since ``completed``."""
+        tasks = []
+        with self.mutex:
+            self.stall_timer = None
+            if self.completed == completed:
+                while self.pending and self.overflow < self.max_overflow_threads:
+                    tasks.append(self.pending.popleft())
+                    self.overflow += 1
+            if self.pending:
+                self.stall_timer = self.get_reactor().call_later(
+                    self.stall_interval, self._check_stall, self.completed)
+        for func, args in tasks:
+            t = threading.Thread(target=self._run_overflow, args=(func, args))
+            t.daemon = True
+            t.start()
+
+    def _run_overflow(self, func, args):
+        try:
+            func(*args)
+        finally:
+            with self.mutex:
+                self.overflow -= 1
+
+    def handle_request(self, c):
         '''
-        Create a new shared object and return its id
+        Handle a new connection, handing proxy connections over to the reactor
         '''
-        self.mutex.acquire()
         try:
-            ident = kwds.pop("ident", None)
-            if ident is not None:
-                ident = "%s_%s" % (typeid, ident)
+            connection.deliver_challenge(c, self.authkey)
+            connection.answer_challenge(c, self.authkey)
+            request = c.recv()
+            ignore, funcname, args, kwds = request
+        except Exception:
+            try:
+                c.send(('#TRACEBACK', format_exc()))
+            except Exception:
+                pass
+            c.close()
+            return
+
+        if funcname not in ('accept_connection', 'subscribe'):
+            return self._handle_request(c, request)
+
+        try:
+            c.send(('#RETURN', None))
+        except Exception:
+            c.close()
+            return
+        if funcname == 'subscribe':
+            sock = NotifyChannel(c, self.socket.family)
+        else:
+            sock = ManagerConnection(c, self.socket.family)
+        self.get_reactor().add_listener(self, sock)
 
-            callable, exposed, method_to_typeid, proxytype = \
-                self.registry[typeid]
+    def subscribe(self, c):
+        '''
+        Turn the connection into a notification channel, see handle_request
+        '''
+
+    def read_subscriptions(self, sock):
+        try:
+            data = sock.socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b''
+        if not data:
+            self.close_channel(sock)
+            return
+
+        inbound = sock.inbound
+        inbound.extend(data)
+        while len(inbound) >= _frame.size:
+            end = _frame.size + _frame.unpack_from(inbound)[0]
+            if len(inbound) < end:
+                break
+            kind, ident = cPickle.loads(bytes(inbound[_frame.size:end]))
+            del inbound[:end]
+            with self.notify_lock:
+                if kind == 'subscribe':
+                    self.subscribers.setdefault(ident, set()).add(sock)
+                    sock.idents.add(ident)
+                elif kind == 'unsubscribe':
+                    self.subscribers.get(ident, set()).discard(sock)
+                    sock.idents.discard(ident)
+            if kind == 'subscribe':
+                entry = self.id_to_obj.get(ident)
+                version = entry[0].version if entry and isinstance(entry[0], Versioned) else None
+                self.send_notification(sock, ('#SUBSCRIBED', ident, version))
+
+    def notify(self, ident, version):
+        with self.notify_lock:
+            channels = list(self.subscribers.get(ident, ()))
+        for sock in channels:
+            self.send_notification(sock, ('#NOTIFY', ident, version))
 
-            if ident is None or ident not in self.id_to_obj:
-                if callable is None:
-                    assert len(args) == 1 and not kwds
-                    obj = args[0]
-                else:
-                    obj = callable(*args, **kwds)
+    def send_notification(self, sock, message):
+        data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+        data = _frame.pack(len(data)) + data
+        with sock.write_lock:
+            if sock.closed:
+                return
+            outbound = sock.outbound
+            if not outbound:
+                try:
+                    sent = sock.socket.send(data, MSG_DONTWAIT)
+                except socket.error as e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        sent = None
+                    else:
+                        sent = 0
+                if sent == len(data):
+                    return
+                if sent is not None:
+                    outbound.extend(data[sent:])
+                    self.get_reactor().set_writable(self, sock)
+                    return
+            elif len(outbound) + len(data) <= self.max_notify_buffer:
+                outbound.extend(data)
+                return
+        self.close_channel(sock)
 
-                if not ident:
-                    ident = '%x' % id(obj)  # convert to string because xmlrpclib
+    def dispatch_write(self, sock):
+        with sock.write_lock:
+            outbound = sock.outbound
+            try:
+                sent = sock.socket.send(outbound, MSG_DONTWAIT)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                sent = None
+            if sent is not None:
+                del outbound[:sent]
+                if not outbound:
+                    self.get_reactor().set_writable(self, sock, False)
+                return
+        self.close_channel(sock)
 
+    def close_channel(self, sock):
+        with sock.write_lock:
+            if sock.closed:
+                return
+            sock.closed = True
+        with self.notify_lock:
+            for ident in sock.idents:
+                channels = self.subscribers.get(ident)
+                if channels is not None:
+                    channels.discard(sock)
+                    if not channels:
+                        del self.subscribers[ident]
+        self.get_reactor().del_listener(sock)
+        sock.close()
+
+    def _handle_request(self, c, request):
+        ignore, funcname, args, kwds = request
+        try:
+            assert funcname in self.public, '%r unrecognized' % funcname
+            func = getattr(self, funcname)
+            msg = ('#RETURN', func(c, *args, **kwds))
+        except Exception:
+            msg = ('#TRACEBACK', format_exc())
+        try:
+            c.send(msg)
+        except Exception:
+            try:
+                c.send(('#TRACEBACK', format_exc()))
+            except Exception:
+                pass
+        c.close()
+
+    def serve_ready(self, sock):
+        '''
+        Serve the requests available on a proxy connection, replies are sent in order
+        '''
+        conn = sock.connection
+        try:
+            while not self.stop:
+                msg = self.handle_call(conn, conn.recv())
+                try:
+                    conn.send(msg)
+                except (IOError, OSError):
+                    raise
+                except Exception:
+                    conn.send(('#UNSERIALIZABLE', format_exc()))
+                if not conn.poll():
+                    break
+        except (EOFError, IOError, OSError):
+            self.get_reactor().del_listener(sock)
+            sock.close()
+            return
+        self.get_reactor().resume(sock)
+
+    def handle_call(self, conn, request):
+        '''
+        Run one proxy method call and return the reply, like serve_client
+        '''
+        methodname = obj = ident = None
+        args, kwds = (), {}
+        try:
+            ident, methodname, args, kwds = request
+            if methodname == '#batch':
+                return '#BATCH', [self.handle_call(conn, call) for call in args]
+
+            obj, exposed, gettypeid = self.id_to_obj[ident]
+            if methodname not in exposed:
+                raise AttributeError('method %r of %r object is not in exposed=%r' %
+                                     (methodname, type(obj), exposed))
+
+            function = getattr(obj, methodname)
+            version = obj.version if isinstance(obj, Versioned) else None
+            try:
+                res = function(*args, **kwds)
+            except Exception, e:
+                return '#ERROR', e
+            if version is not None and obj.version != version:
+                self.notify(ident, obj.version)
+
+            typeid = gettypeid and gettypeid.get(methodname, None)
+            if typeid:
+                rident, rexposed = self.create(conn, typeid, res)
+                token = Token(typeid, self.address, rident)
+                return '#PROXY', (rexposed, token)
+            return '#RETURN', res
+
+        except AttributeError:
+            if methodname is None:
+                return '#TRACEBACK', format_exc()
+            try:
+                fallback_func = self.fallback_mapping[methodname]
+                return '#RETURN', fallback_func(self, conn, ident, obj, *args, **kwds)
+            except Exception:
+                return '#TRACEBACK', format_exc()
+
+        except Exception:
+            return '#TRACEBACK', format_exc()
+
+    def server_close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def _stripe(self, ident):
+        return self.stripes[hash(ident) % len(self.stripes)]
+
+    def create(self, c, typeid, *args, **kwds):
+        '''
+        Create a new shared object and return its id.
+
+        The factory runs without any lock held; ``ident`` names an object to
+        get or create, concurrent calls for the same name wait for the first
+        one and share its object.
+        '''
+        ident = kwds.pop("ident", None)
+        if ident is not None:
+            ident = "%s_%s" % (typeid, ident)
+
+        callable, exposed, method_to_typeid, proxytype = \
+            self.registry[typeid]
+
+        while ident is not None:
+            with self._stripe(ident):
+                entry = self.id_to_obj.get(ident)
+                if entry is not None:
+                    return self._register(c, typeid, ident, entry[0], exposed, method_to_typeid)
+                pending = self.creating.get(ident)
+                if pending is None:
+                    self.creating[ident] = pending = threading.Event()
+                    break
+            # another thread is creating it, its object is used unless it fails
+            pending.wait()
+
+        try:
+            if callable is None:
+                assert len(args) == 1 and not kwds
+                obj = args[0]
             else:
-                obj = self.id_to_obj[ident][0]
+                obj = callable(*args, **kwds)
+        except:
+            if ident is not None:
+                with self._stripe(ident):
+                    del self.creating[ident]
+                pending.set()
+            raise
 
-            if exposed is None:
-                exposed = multiprocessing.managers.public_methods(obj)
-            if method_to_typeid is not None:
-                assert type(method_to_typeid) is dict
-                exposed = list(exposed) + list(method_to_typeid)
+        if ident is None:
+            # convert to string because xmlrpclib only has 32 bit signed integers
+            return self._register(c, typeid, '%x' % id(obj), obj, exposed, method_to_typeid)
+        try:
+            return self._register(c, typeid, ident, obj, exposed, method_to_typeid)
+        finally:
+            with self._stripe(ident):
+                del self.creating[ident]
+            pending.set()
+
+    def _register(self, c, typeid, ident, obj, exposed, method_to_typeid):
+        if exposed is None:
+            exposed = multiprocessing.managers.public_methods(obj)
+        if method_to_typeid is not None:
+            assert type(method_to_typeid) is dict
+            exposed = list(exposed) + list(method_to_typeid)
 
-            # only has 32 bit signed integers
-            multiprocessing.managers.util.debug('%r callable returned object with id %r', typeid, ident)
+        multiprocessing.managers.util.debug('%r callable returned object with id %r', typeid, ident)
 
+        with self._stripe(ident):
             self.id_to_obj[ident] = (obj, set(exposed), method_to_typeid)
             if ident not in self.id_to_refcount:
                 self.id_to_refcount[ident] = 0
@@ -73,10 +493,31 @@ class ManagerServer(multiprocessing.managers.Server):
             # object for it can be created.  The caller of create()
             # is responsible for doing a decref once the Proxy object
             # has been created.
-            self.incref(c, ident)
-            return ident, tuple(exposed)
-        finally:
-            self.mutex.release()
+            self.id_to_refcount[ident] += 1
+        return ident, tuple(exposed)
+
+    def incref(self, c, ident):
+        with self._stripe(ident):
+            self.id_to_refcount[ident] += 1
+
+    def decref(self, c, ident):
+        with self._stripe(ident):
+            assert self.id_to_refcount[ident] >= 1
+            self.id_to_refcount[ident] -= 1
+            if self.id_to_refcount[ident]:
+                return
+            # released after the lock, the object's destructor may be slow too
+            entry = self.id_to_obj.pop(ident)
+            del self.id_to_refcount[ident]
+        with self.notify_lock:
+            channels = self.subscribers.pop(ident, ())
+            for sock in channels:
+                sock.idents.discard(ident)
+        # the ident may be reused by the next object, clients subscribe again
+        for sock in channels:
+            self.send_notification(sock, ('#DISPOSED', ident, None))
+        multiprocessing.managers.util.debug('disposing of obj with id %r', ident)
+        del entry
 
 
 class SyncManager(_SyncManager):
@@ -89,3 +530,82 @@ class SyncManager(_SyncManager):
         assert self._state.value == multiprocessing.managers.State.INITIAL
         return self._Server(self._registry, self._address,
                             self._authkey, self._serializer)
+
+
+SyncManager.register('CachedDict', VersionedDict, CachedDictProxy)
+SyncManager.register('SharedBuffer', SharedSegment, SharedBufferProxy)
+SyncManager.register('SharedArray', SharedArray, SharedArrayProxy)
+SyncManager.register('SharedRingBuffer', SharedRingBuffer, SharedRingBufferProxy)
+
+
+def _rebuild_proxy(proxy, result):
+    # same as BaseProxy._callmethod for a '#PROXY' reply
+    exposed, token = result
+    proxytype = proxy._manager._registry[token.typeid][-1]
+    token.address = proxy._token.address
+    new_proxy = proxytype(token, proxy._serializer, manager=proxy._manager,
+                          authkey=proxy._authkey, exposed=exposed)
+    conn = proxy._Client(token.address, authkey=proxy._authkey)
+    multiprocessing.managers.dispatch(conn, None, 'decref', (token.id,))
+    return new_proxy
+
+
+class Batch(object):
+    '''
+    Proxy method calls sent to a `ManagerServer` in one message, results
+    are returned in order::
+
+        batch = Batch()
+        batch.call(shared_dict, 'get', 'a')
+        batch.call(shared_dict, '__setitem__', 'b', 1)
+        batch.call(shared_list, 'append', 2)
+        a, _, _ = batch.execute()
+
+    Every proxy must belong to the same manager. The batch uses the calling
+    thread's connection of the first proxy.
+    '''
+
+    def __init__(self):
+        self.calls = []
+
+    def call(self, proxy, methodname, *args, **kwds):
+        if self.calls and proxy._token.address != self.calls[0][0]._token.address:
+            raise ValueError("proxies of different managers in one batch")
+        self.calls.append((proxy, methodname, args, kwds))
+        return len(self.calls) - 1
+
+    def __len__(self):
+        return len(self.calls)
+
+    def execute(self, raise_errors=True):
+        '''
+        Send the queued calls and return their results. With ``raise_errors``
+        False failed calls give their exception instead of raising it.
+        '''
+        calls, self.calls = self.calls, []
+        if not calls:
+            return []
+        proxy = calls[0][0]
+        try:
+            conn = proxy._tls.connection
+        except AttributeError:
+            proxy._connect()
+            conn = proxy._tls.connection
+
+        conn.send(('0', '#batch', [(p._id, m, a, k) for p, m, a, k in calls], {}))
+        kind, replies = conn.recv()
+        if kind != '#BATCH':
+            raise convert_to_error(kind, replies)
+
+        results = []
+        for (p, _, _, _), (kind, result) in zip(calls, replies):
+            if kind == '#RETURN':
+                results.append(result)
+            elif kind == '#PROXY':
+                results.append(_rebuild_proxy(p, result))
+            else:
+                error = convert_to_error(kind, result)
+                if raise_errors:
+                    raise error
+                results.append(error)
+        return results
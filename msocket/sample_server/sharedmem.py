@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory objects of `msocket.sample_server.managers.SyncManager`.
+
+The data of these objects lives in a file under ``/dev/shm`` (or the
+temporary directory) that every process on the host maps. The manager
+only names the segment, removes it when the last proxy is gone and
+provides a lock with a condition, so reads and writes through a proxy
+neither pickle nor copy the data over the manager connection. Clients
+must therefore run on the manager's host.
+
+    buf = manager.SharedBuffer(1 << 20)
+    buf[0:5] = b'hello'
+    view = buf.view()           # writable memoryview of the segment
+
+    arr = manager.SharedArray('d', 1000)
+    with arr:                   # lock held by the manager
+        arr[0] += 1.5
+
+    ring = manager.SharedRingBuffer(1 << 20)
+    ring.put(b'record')
+    ring.get(timeout=1)
+"""
+from __future__ import absolute_import
+
+import os
+import time
+import mmap
+import struct
+import ctypes
+import tempfile
+import threading
+import multiprocessing.util
+from multiprocessing.managers import BaseProxy
+from multiprocessing.sharedctypes import typecode_to_type
+from Queue import Full, Empty
+
+__author__ = 'fujie'
+
+SHM_DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class SharedSegment(object):
+    """Manager side of a shared-memory object: the segment file and its lock."""
+
+    def __init__(self, size, data=None):
+        if size <= 0:
+            raise ValueError("size must be positive")
+        fd, self.path = tempfile.mkstemp(prefix='msocket-', dir=SHM_DIRECTORY)
+        try:
+            os.ftruncate(fd, size)
+            if data:
+                os.write(fd, data)
+        finally:
+            os.close(fd)
+        self.size = size
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # removes the file when the manager drops the object or exits
+        multiprocessing.util.Finalize(self, _unlink, args=(self.path,), exitpriority=0)
+
+    def info(self):
+        return self.path, self.size
+
+    # a plain Lock, the manager may release it on another thread than it was acquired on
+    def acquire(self, blocking=True):
+        return self.lock.acquire(blocking)
+
+    def release(self):
+        self.lock.release()
+
+    def wait(self, timeout=None):
+        self.condition.wait(timeout)
+
+    def notify_all(self):
+        self.condition.notify_all()
+
+
+class SharedArray(SharedSegment):
+    def __init__(self, typecode, size_or_initializer):
+        self.typecode = typecode
+        ctype = typecode_to_type.get(typecode, typecode)
+        if isinstance(size_or_initializer, (int, long)):
+            self.length = size_or_initializer
+            data = None
+        else:
+            self.length = len(size_or_initializer)
+            data = buffer((ctype * self.length)(*size_or_initializer))
+        SharedSegment.__init__(self, max(ctypes.sizeof(ctype) * self.length, 1), data)
+
+    def info(self):
+        return self.path, self.size, self.typecode, self.length
+
+
+class SegmentProxy(BaseProxy):
+    """Maps the segment on first use; the lock is the manager's."""
+    _exposed_ = ('info', 'acquire', 'release', 'wait', 'notify_all')
+    _map = None
+
+    def _segment(self):
+        if self._map is None:
+            info = self._callmethod('info')
+            path, size = info[:2]
+            with open(path, 'r+b') as f:
+                self._map = mmap.mmap(f.fileno(), size)
+            self._setup(info)
+        return self._map
+
+    def _setup(self, info):
+        pass
+
+    def acquire(self, blocking=True):
+        return self._callmethod('acquire', (blocking,))
+
+    def release(self):
+        return self._callmethod('release')
+
+    def __enter__(self):
+        return self._callmethod('acquire')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self._callmethod('release')
+
+    def wait(self, timeout=None):
+        """Wait for `notify_all` with the lock held, like `threading.Condition.wait`."""
+        return self._callmethod('wait', (timeout,))
+
+    def notify_all(self):
+        return self._callmethod('notify_all')
+
+    def close(self):
+        """Unmap the segment in this process; it is mapped again when used."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class SharedBufferProxy(SegmentProxy):
+    def view(self):
+        """Writable `memoryview` of the whole segment."""
+        m = self._segment()
+        return memoryview((ctypes.c_char * len(m)).from_buffer(m))
+
+    def __len__(self):
+        return len(self._segment())
+
+    def __getitem__(self, key):
+        return self._segment()[key]
+
+    def __setitem__(self, key, value):
+        self._segment()[key] = value
+
+
+class SharedArrayProxy(SegmentProxy):
+    _array = None
+
+    def _setup(self, info):
+        path, size, typecode, length = info
+        ctype = typecode_to_type.get(typecode, typecode)
+        self._array = (ctype * length).from_buffer(self._map)
+
+    @property
+    def array(self):
+        """The segment as a ctypes array."""
+        self._segment()
+        return self._array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    def __setitem__(self, key, value):
+        self.array[key] = value
+
+    def close(self):
+        self._array = None
+        SegmentProxy.close(self)
+
+
+# head and tail, total bytes written and read
+_ring_header = struct.Struct('=QQ')
+_record_length = struct.Struct('=I')
+
+
+class SharedRingBuffer(SharedSegment):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        SharedSegment.__init__(self, _ring_header.size + capacity)
+
+    def info(self):
+        return self.path, self.size, self.capacity
+
+
+class SharedRingBufferProxy(SegmentProxy):
+    """
+    Queue of byte strings in a ring of ``capacity`` bytes. `put` and `get`
+    copy the record straight into and out of the segment while holding the
+    manager's lock; each record takes 4 bytes more than its length.
+    """
+    capacity = None
+
+    def _setup(self, info):
+        self.capacity = info[2]
+
+    def _copy_in(self, m, position, data):
+        capacity = self.capacity
+        offset = _ring_header.size
+        start = position % capacity
+        first = min(len(data), capacity - start)
+        m[offset + start:offset + start + first] = data[:first]
+        if first < len(data):
+            m[offset:offset + len(data) - first] = data[first:]
+
+    def _copy_out(self, m, position, length):
+        capacity = self.capacity
+        offset = _ring_header.size
+        start = position % capacity
+        first = min(length, capacity - start)
+        data = m[offset + start:offset + start + first]
+        if first < length:
+            data += m[offset:offset + length - first]
+        return data
+
+    def _wait(self, deadline, exception):
+        if deadline is None:
+            self.wait()
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise exception
+        self.wait(remaining)
+
+    def put(self, data, block=True, timeout=None):
+        m = self._segment()
+        size = _record_length.size + len(data)
+        if size > self.capacity:
+            raise ValueError("record of %d bytes does not fit in the ring" % len(data))
+        deadline = None if timeout is None else time.time() + timeout
+        with self:
+            while True:
+                head, tail = _ring_header.unpack_from(m)
+                if self.capacity - (head - tail) >= size:
+                    break
+                if not block:
+                    raise Full
+                self._wait(deadline, Full)
+            self._copy_in(m, head, _record_length.pack(len(data)) + data)
+            _ring_header.pack_into(m, 0, head + size, tail)
+            self.notify_all()
+
+    def get(self, block=True, timeout=None):
+        m = self._segment()
+        deadline = None if timeout is None else time.time() + timeout
+        with self:
+            while True:
+                head, tail = _ring_header.unpack_from(m)
+                if head != tail:
+                    break
+                if not block:
+                    raise Empty
+                self._wait(deadline, Empty)
+            length = _record_length.unpack(self._copy_out(m, tail, _record_length.size))[0]
+            data = self._copy_out(m, tail + _record_length.size, length)
+            _ring_header.pack_into(m, 0, head, tail + _record_length.size + length)
+            self.notify_all()
+        return data
+
+    def put_nowait(self, data):
+        return self.put(data, False)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        """Bytes in use, record lengths included."""
+        head, tail = _ring_header.unpack_from(self._segment())
+        return head - tail
@@ -2,14 +2,30 @@
 from __future__ import absolute_import
 
 import os
+import fcntl
 import socket
 import select
 import errno
 import time
+import heapq
+import signal
+import itertools
+import struct
 import threading
 import logging
 
-from .compat import string_class, socketserver
+from .compat import string_class, socketserver, queue
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
 
 logger = logging.getLogger("msocket.server")
 __author__ = 'fujie'
@@ -97,12 +113,14 @@ class SocketWrapper(object):
 class StreamSocket(SocketWrapper):
     socket_type = socket.SOCK_STREAM
 
-    def __init__(self, server_address, address_family=socket.AF_INET, request_queue_size=5, allow_reuse_address=False):
+    def __init__(self, server_address, address_family=socket.AF_INET, request_queue_size=5, allow_reuse_address=False,
+                 socket_options=()):
         SocketWrapper.__init__(self, server_address)
 
         self.allow_reuse_address = allow_reuse_address
         self.socket = socket.socket(address_family, self.socket_type)
         self.request_queue_size = request_queue_size
+        self.socket_options = socket_options
 
     def server_bind(self):
         if self._bind:
@@ -110,6 +128,11 @@ class StreamSocket(SocketWrapper):
         _socket = self.socket
         if self.allow_reuse_address:
             _socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        for level, option, value in self.socket_options:
+            # TCP level options (e.g. TCP_NODELAY, inherited by accepted sockets) do not apply to Unix sockets
+            if level == socket.IPPROTO_TCP and _socket.family not in (socket.AF_INET, socket.AF_INET6):
+                continue
+            _socket.setsockopt(level, option, value)
         _socket.bind(self.server_address)
         self.server_address = _socket.getsockname()
         self._bind = True
@@ -127,7 +150,180 @@ class StreamSocket(SocketWrapper):
         return request, client_address
 
 
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+MSG_TRUNC = getattr(socket, 'MSG_TRUNC', 0)
+_libc = _recvmmsg = _sendfile = None
+
+if ctypes is not None and hasattr(socket, 'AF_UNIX'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+    except OSError:
+        _libc = None
+if _libc is not None:
+    _recvmmsg = getattr(_libc, 'recvmmsg', None)
+    # Python 2 has no os.sendfile; the 64 bit offset variant exists on 32 bit platforms too
+    _sendfile = getattr(_libc, 'sendfile64', None) or getattr(_libc, 'sendfile', None)
+
+if _sendfile is not None:
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+
+def _libc_sendfile(out_fd, in_fd, offset, count):
+    """``os.sendfile`` of Python 3 on top of ``sendfile(2)``, raises OSError."""
+    position = ctypes.c_int64(offset)
+    sent = _sendfile(out_fd, in_fd, ctypes.byref(position), count)
+    if sent < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return sent
+
+
+# None where neither is available
+sendfile = getattr(os, 'sendfile', None) or (_libc_sendfile if _sendfile is not None else None)
+
+if _recvmmsg is not None:
+    class _iovec(ctypes.Structure):
+        _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+    class _msghdr(ctypes.Structure):
+        _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                    ('msg_iov', ctypes.POINTER(_iovec)), ('msg_iovlen', ctypes.c_size_t),
+                    ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                    ('msg_flags', ctypes.c_int)]
+
+    class _mmsghdr(ctypes.Structure):
+        _fields_ = [('msg_hdr', _msghdr), ('msg_len', ctypes.c_uint)]
+
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+
+_SOCKADDR_SIZE = 128
+_unpack_family = struct.Struct('=H').unpack_from
+_unpack_port = struct.Struct('!H').unpack_from
+_unpack_flowinfo = struct.Struct('!I').unpack_from
+_unpack_scope = struct.Struct('=I').unpack_from
+
+
+def _parse_sockaddr(raw, length):
+    """Python address of a raw ``struct sockaddr`` as returned by ``recvfrom``."""
+    if length < 2:
+        return None
+    family = _unpack_family(raw)[0]
+    if family == socket.AF_INET:
+        return socket.inet_ntop(socket.AF_INET, raw[4:8]), _unpack_port(raw, 2)[0]
+    if family == socket.AF_INET6:
+        return (socket.inet_ntop(socket.AF_INET6, raw[8:24]), _unpack_port(raw, 2)[0],
+                _unpack_flowinfo(raw, 4)[0], _unpack_scope(raw, 24)[0])
+    path = raw[2:length]
+    if path[:1] != b'\0':
+        path = path.split(b'\0', 1)[0]
+    return path
+
+
+class _MMsgBatch(object):
+    """Preallocated ``recvmmsg`` arguments for ``size`` datagrams of up to ``buffer_size`` bytes."""
+
+    def __init__(self, size, buffer_size):
+        self.size = size
+        self.buffers = [ctypes.create_string_buffer(buffer_size) for _ in range(size)]
+        self.names = [ctypes.create_string_buffer(_SOCKADDR_SIZE) for _ in range(size)]
+        self.iovecs = (_iovec * size)()
+        self.msgs = (_mmsghdr * size)()
+        for i in range(size):
+            self.iovecs[i].iov_base = ctypes.cast(self.buffers[i], ctypes.c_void_p)
+            self.iovecs[i].iov_len = buffer_size
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(self.names[i], ctypes.c_void_p)
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self, fd):
+        """Return ``([(data, address), ...], truncated)``, truncated datagrams are left out."""
+        msgs = self.msgs
+        for i in range(self.size):
+            msgs[i].msg_hdr.msg_namelen = _SOCKADDR_SIZE
+        n = _recvmmsg(fd, msgs, self.size, MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return [], 0
+            raise socket.error(err, os.strerror(err))
+        result = []
+        truncated = 0
+        for i in range(n):
+            msg = msgs[i]
+            hdr = msg.msg_hdr
+            if hdr.msg_flags & MSG_TRUNC:
+                truncated += 1
+                continue
+            namelen = hdr.msg_namelen
+            result.append((ctypes.string_at(self.buffers[i], msg.msg_len),
+                           _parse_sockaddr(ctypes.string_at(self.names[i], namelen), namelen)))
+        return result, truncated
+
+
+class DatagramSocket(StreamSocket):
+    """
+    Bound datagram socket. `recv_many` drains up to ``batch_size`` pending
+    datagrams per call, with one ``recvmmsg`` system call where available
+    and a non-blocking ``recvfrom_into`` loop otherwise, both into buffers
+    allocated once. Datagrams larger than ``buffer_size`` are dropped and
+    counted in ``truncated``.
+    """
+    socket_type = socket.SOCK_DGRAM
+    truncated = 0
+
+    def __init__(self, server_address, address_family=socket.AF_INET, allow_reuse_address=False,
+                 socket_options=(), batch_size=64, buffer_size=65536):
+        StreamSocket.__init__(self, server_address, address_family, 0, allow_reuse_address, socket_options)
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self._batch = None
+        self._buffer = None
+
+    def server_activate(self):
+        if self._activate:
+            return
+        self.socket.setblocking(0)
+        self._activate = True
+
+    def recv_many(self):
+        """Return ``[(data, address), ...]`` of the datagrams available right now."""
+        if _recvmmsg is not None:
+            if self._batch is None:
+                self._batch = _MMsgBatch(self.batch_size, self.buffer_size)
+            result, truncated = self._batch.recv(self.socket.fileno())
+            if truncated:
+                self.truncated += truncated
+            return result
+
+        if self._buffer is None:
+            self._buffer = bytearray(self.buffer_size)
+        buf = self._buffer
+        recvfrom_into = self.socket.recvfrom_into
+        result = []
+        while len(result) < self.batch_size:
+            try:
+                # with MSG_TRUNC the real size of a longer datagram is returned
+                n, address = recvfrom_into(buf, 0, MSG_DONTWAIT | MSG_TRUNC)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            if n > len(buf):
+                self.truncated += 1
+                continue
+            result.append((bytes(buf[:n]), address))
+        return result
+
+
 class AcceptedStreamSocket(SocketWrapper):
+    tls = False
+    # waiting on the reactor for the next request of a keep-alive connection, see ThreadPoolMixIn
+    parked = False
+    keepalive_timer = None
+
     def __init__(self, request, client_address):
         server_address = request.getsockname()
         SocketWrapper.__init__(self, server_address)
@@ -135,6 +331,7 @@ class AcceptedStreamSocket(SocketWrapper):
         self._bind = True
         self._activate = True
         self.socket = request
+        self.accepted = time.time()
 
     def accept(self):
         return self, self.client_address
@@ -155,6 +352,75 @@ class AcceptedStreamSocket(SocketWrapper):
         return "<%s(%s) at %d>" % (self.__class__.__name__, address, self.fileno())
 
 
+# kernel TLS (linux/tls.h), the ULP OpenSSL attaches with OP_ENABLE_KTLS
+SOL_TLS = 282
+TLS_TX = 1
+TLS_RX = 2
+if ssl is not None:
+    OP_NO_TICKET = getattr(ssl, 'OP_NO_TICKET', 0x4000)
+    # OpenSSL 3.0+ only, ignored by OpenSSL builds without kTLS support
+    OP_ENABLE_KTLS = getattr(ssl, 'OP_ENABLE_KTLS', 0x8 if ssl.OPENSSL_VERSION_INFO >= (3, 0) else 0)
+
+
+def ktls_enabled(sock, direction=TLS_TX):
+    """Whether the kernel encrypts (``TLS_TX``) or decrypts (``TLS_RX``) the records of ``sock``."""
+    try:
+        sock.getsockopt(SOL_TLS, direction, 64)
+    except (socket.error, AttributeError):
+        return False
+    return True
+
+
+def make_tls_context(certfile, keyfile=None, alpn_protocols=('http/1.1',), session_tickets=True, ktls=True,
+                     ciphers=None):
+    """
+    Server side ``ssl.SSLContext`` for the ``tls_context`` of a server.
+
+    Sessions are resumed from OpenSSL's server session cache or, with
+    ``session_tickets``, from tickets encrypted with keys of the context.
+    A context created before forking gives every worker the same ticket
+    keys, so a session resumes on whichever worker accepts it. ``ktls``
+    lets OpenSSL hand the record layer to the kernel when both support it,
+    see `ktls_enabled`.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION | ssl.OP_CIPHER_SERVER_PREFERENCE
+    context.options |= getattr(ssl, 'OP_SINGLE_DH_USE', 0) | getattr(ssl, 'OP_SINGLE_ECDH_USE', 0)
+    if not session_tickets:
+        context.options |= OP_NO_TICKET
+    if ktls and OP_ENABLE_KTLS:
+        context.options |= OP_ENABLE_KTLS
+    if ciphers:
+        context.set_ciphers(ciphers)
+    context.load_cert_chain(certfile, keyfile)
+    if alpn_protocols and getattr(ssl, 'HAS_ALPN', False):
+        context.set_alpn_protocols(list(alpn_protocols))
+    return context
+
+
+class AcceptedTLSSocket(AcceptedStreamSocket):
+    """Accepted connection in an ``ssl.SSLSocket``, with the parameters `TLSHandshake` negotiated."""
+    tls = True
+    version = None
+    cipher = None
+    alpn_protocol = None
+    session_reused = False
+    ktls_send = False
+    handshake_time = None
+
+    def handshake_done(self, session_reused=False):
+        _socket = self.socket
+        # native strings, for WSGI environ values
+        self.version = str(_socket.version())
+        self.cipher = _socket.cipher()
+        if getattr(ssl, 'HAS_ALPN', False):
+            protocol = _socket.selected_alpn_protocol()
+            self.alpn_protocol = str(protocol) if protocol else None
+        self.session_reused = session_reused
+        self.ktls_send = ktls_enabled(_socket, TLS_TX)
+        self.handshake_time = time.time() - self.accepted
+
+
 def make_poller():
     if select.select.__module__ != 'select':
         return SelectPoller()
@@ -168,9 +434,11 @@ def make_poller():
 class SelectPoller(object):
     def __init__(self):
         self._fds = []
+        self._wfds = []
 
     def release(self):
         self._fds = []
+        self._wfds = []
 
     def register(self, fd):
         if not isinstance(fd, int):
@@ -183,6 +451,16 @@ class SelectPoller(object):
             fd = fd.fileno()
         if fd in self._fds:
             self._fds.remove(fd)
+        if fd in self._wfds:
+            self._wfds.remove(fd)
+
+    def set_writable(self, fd, writable):
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+        if writable and fd not in self._wfds:
+            self._wfds.append(fd)
+        elif not writable and fd in self._wfds:
+            self._wfds.remove(fd)
 
     def poll(self, poll_interval):
         if not self._fds:
@@ -197,10 +475,30 @@ class SelectPoller(object):
                 return []
             raise
 
+    def poll_events(self, poll_interval):
+        """Return ``[(fd, readable, writable), ...]``."""
+        if not self._fds and not self._wfds:
+            time.sleep(poll_interval)
+            return []
+
+        try:
+            r, w, x = select.select(self._fds, self._wfds, [], poll_interval)
+        except (OSError, IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        w = set(w)
+        events = [(fd, True, fd in w) for fd in r]
+        events.extend((fd, False, True) for fd in w.difference(r))
+        return events
+
 
 class PollPoller(object):
     try:
         mask = select.POLLIN | select.POLLPRI
+        write_mask = select.POLLOUT
+        # hang-ups and errors are reported as readable so the owner sees EOF
+        error_mask = select.POLLHUP | select.POLLERR
         poller = select.poll
     except AttributeError:
         pass
@@ -230,6 +528,12 @@ class PollPoller(object):
         except IOError:
             pass
 
+    def set_writable(self, fd, writable):
+        try:
+            self._poller.modify(fd, (self.mask | self.write_mask) if writable else self.mask)
+        except IOError:
+            pass
+
     def poll(self, poll_interval):
         try:
             events = self._poller.poll(poll_interval * self.interval_scale)
@@ -240,10 +544,24 @@ class PollPoller(object):
             if e.args[0] != errno.EINTR:
                 raise
 
+    def poll_events(self, poll_interval):
+        """Return ``[(fd, readable, writable), ...]``."""
+        try:
+            events = self._poller.poll(poll_interval * self.interval_scale)
+        except (OSError, IOError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        read_mask = self.mask | self.error_mask
+        write_mask = self.write_mask
+        return [(fd, bool(event & read_mask), bool(event & write_mask)) for fd, event in events]
+
 
 class EPollPoller(PollPoller):
     try:
         mask = select.EPOLLIN | select.EPOLLPRI
+        write_mask = select.EPOLLOUT
+        error_mask = select.EPOLLHUP | select.EPOLLERR
         poller = select.epoll
     except AttributeError:
         pass
@@ -256,10 +574,19 @@ class EPollPoller(PollPoller):
 class Reactor(object):
     def __init__(self):
         self._servers = {}
+        self._writers = {}
+        # heap of [when, seq, callback, args], see call_later
+        self._timers = []
+        self._timer_seq = itertools.count()
         self.lock = threading.Lock()
         self.__shutdown_request = False
         self.__is_shut_down = threading.Event()
         self.__poller = make_poller()
+        # self-pipe, lets other threads interrupt a poll to apply changes
+        self.__waker = os.pipe()
+        for fd in self.__waker:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.__poller.register(self.__waker[0])
 
     def sockets(self):
         return sorted([sock for _, sock in self._servers.values()], key=lambda s: s.fileno())
@@ -294,13 +621,16 @@ class Reactor(object):
 
         return self.add_listener(server, sock)
 
-    def del_listener(self, sock):
-        fd = sock.fileno()
+    def del_listener(self, sock, fd=None):
+        """Stop polling ``sock``; pass the ``fd`` it was added with if it may be closed already."""
+        if fd is None:
+            fd = sock.fileno()
         if fd in self._servers:
             with self.lock:
                 self._servers.pop(fd, None)
+                self._writers.pop(fd, None)
                 try:
-                    self.__poller.unregister(sock)
+                    self.__poller.unregister(fd)
                 except IOError:
                     pass
                 if isinstance(sock, AcceptedStreamSocket):
@@ -318,15 +648,117 @@ class Reactor(object):
             sock = server.socket
             return self.del_listener(sock)
 
+    def suspend(self, sock):
+        """
+        Stop polling a registered ``sock`` without unregistering it, e.g.
+        while another thread reads from it. Safe to call from any thread.
+        """
+        with self.lock:
+            if sock.fileno() in self._servers:
+                self.__poller.unregister(sock)
+
+    def resume(self, sock):
+        """Poll a `suspend` ed ``sock`` again. Safe to call from any thread."""
+        fd = sock.fileno()
+        with self.lock:
+            if fd not in self._servers:
+                return
+            self.__poller.register(sock)
+            if fd in self._writers:
+                self.__poller.set_writable(fd, True)
+        self.wakeup()
+
+    def set_writable(self, server, sock, writable=True):
+        """
+        Start or stop watching ``sock`` for write readiness. While enabled,
+        ``server.dispatch_write(sock)`` is called whenever it can be written to.
+        Safe to call from any thread.
+        """
+        fd = sock.fileno()
+        with self.lock:
+            if writable:
+                if fd not in self._servers or fd in self._writers:
+                    return
+                self._writers[fd] = (server, sock)
+            elif self._writers.pop(fd, None) is None:
+                return
+            self.__poller.set_writable(fd, writable)
+        self.wakeup()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run ``callback(*args)`` on the reactor thread after ``delay`` seconds.
+        Safe to call from any thread, returns a handle for `cancel_timer`.
+        """
+        timer = [time.time() + delay, next(self._timer_seq), callback, args]
+        with self.lock:
+            heapq.heappush(self._timers, timer)
+            earliest = self._timers[0] is timer
+        if earliest:
+            self.wakeup()
+        return timer
+
+    @staticmethod
+    def cancel_timer(timer):
+        if timer is not None:
+            # removed lazily when it comes due
+            timer[2] = None
+
+    def _run_timers(self):
+        """Run due timers, return the delay until the next one (or None)."""
+        timers = self._timers
+        while True:
+            now = time.time()
+            with self.lock:
+                if not timers:
+                    return None
+                if timers[0][0] > now:
+                    return timers[0][0] - now
+                _, _, callback, args = heapq.heappop(timers)
+            if callback is not None:
+                try:
+                    callback(*args)
+                except Exception:
+                    logger.exception("Unhandled error in timer %r", callback)
+
+    def wakeup(self):
+        try:
+            os.write(self.__waker[1], b'x')
+        except (OSError, IOError, ValueError):
+            pass
+
     def run(self, poll_interval=0.5):
         self.__is_shut_down.clear()
         request_context.reactor = self
         try:
             poller = self.__poller
+            waker = self.__waker[0]
             while not self.__shutdown_request:
-                r = poller.poll(poll_interval)
+                timeout = poll_interval
+                if self._timers:
+                    delay = self._run_timers()
+                    if delay is not None and delay < timeout:
+                        timeout = delay
+                events = poller.poll_events(timeout)
+
+                for fd, readable, writable in events:
+                    if fd == waker:
+                        try:
+                            while os.read(waker, 4096):
+                                pass
+                        except (OSError, IOError):
+                            pass
+                        continue
+
+                    if writable:
+                        writer = self._writers.get(fd)
+                        if writer is not None:
+                            writer[0].dispatch_write(writer[1])
+                        elif not readable:
+                            poller.set_writable(fd, False)
+                    if not readable:
+                        continue
 
-                for fd in r:
                     server = self._servers.get(fd)
                     if server is None:
                         poller.unregister(fd)
@@ -342,15 +774,352 @@ class Reactor(object):
 
     def server_close(self):
         self.__poller.release()
+        waker, self.__waker = self.__waker, (-1, -1)
+        for fd in waker:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def stop(self):
+        """Make `run` return, leaving the reactor open to be run again or shut down."""
+        self.__shutdown_request = True
+        self.wakeup()
 
     def shutdown(self):
         if not self.__shutdown_request:
             self.__shutdown_request = True
+            self.wakeup()
             # self.__is_shut_down.wait()
             self.server_close()
 
 
+class WorkerPool(object):
+    """
+    Fixed number of daemon threads running submitted callables in FIFO order.
+
+    Threads are started lazily by the first `submit`. ``queue_size`` bounds
+    the backlog; `submit` blocks while it is full.
+    """
+
+    def __init__(self, size, name='worker', queue_size=0):
+        self.size = size
+        self.name = name
+        self.queue = queue.Queue(queue_size)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.size:
+                t = threading.Thread(target=self._worker, name='%s-%d' % (self.name, len(self.threads)))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, func, *args):
+        if len(self.threads) < self.size:
+            self.start()
+        self.queue.put((func, args))
+
+    def try_submit(self, func, *args):
+        """Like `submit`, but return False instead of blocking when the backlog is full."""
+        if len(self.threads) < self.size:
+            self.start()
+        try:
+            self.queue.put_nowait((func, args))
+        except queue.Full:
+            return False
+        return True
+
+    def saturated(self):
+        """Whether submitted callables are waiting for a thread."""
+        return self.queue.qsize() > 0
+
+    def _worker(self):
+        _queue = self.queue
+        while True:
+            item = _queue.get()
+            if item is None:
+                break
+            func, args = item
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Unhandled error in %s", threading.current_thread().name)
+
+    def shutdown(self, wait=False):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+        if wait:
+            for t in threads:
+                t.join()
+
+
+class ThreadPoolMixIn:
+    """
+    Like `socketserver.ThreadingMixIn`, but runs requests on a bounded `WorkerPool`.
+
+    Between the requests of a keep-alive connection its handler parks it on
+    the reactor (`park_connection`), so a pool thread serves one request at
+    a time rather than a whole connection. At most ``pool_queue_size``
+    requests wait for a thread, connections arriving beyond that are closed.
+    """
+    pool_size = 16
+    pool_queue_size = 1024
+    pool = None
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+            request_context.close_connection = True
+        if request_context.close_connection:
+            self.release_connection(request)
+        self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if self.pool is None:
+            self.pool = WorkerPool(self.pool_size, name=self.__class__.__name__, queue_size=self.pool_queue_size)
+        if not self.pool.try_submit(self.process_request_thread, request, client_address):
+            logger.warning("%d requests waiting for a thread, closing %s", self.pool_queue_size, request)
+            self.release_connection(request)
+            self.close_request(request)
+
+    def pool_saturated(self):
+        return self.pool is not None and self.pool.saturated()
+
+    def park_connection(self, sock, timeout=None):
+        """
+        Watch the keep-alive connection ``sock`` on the reactor until its next
+        request arrives (see `resume_connection`), closing it after
+        ``timeout`` idle seconds. Returns False when there is no reactor.
+        """
+        reactor = getattr(self, '__reactor__', None)
+        if reactor is None or not isinstance(sock, AcceptedStreamSocket):
+            return False
+        if timeout:
+            sock.keepalive_timer = reactor.call_later(timeout, self.expire_connection, sock)
+        sock.parked = True
+        # registered once, then only resumed, see resume_connection
+        reactor.add_listener(self, sock)
+        reactor.resume(sock)
+        return True
+
+    def resume_connection(self, sock):
+        """Reactor side: a parked connection is readable, serve it on the pool."""
+        reactor = self.get_reactor()
+        sock.parked = False
+        reactor.cancel_timer(sock.keepalive_timer)
+        sock.keepalive_timer = None
+        reactor.suspend(sock)
+        self.process_request(sock, sock.client_address)
+
+    def expire_connection(self, sock):
+        if not sock.parked:
+            return
+        sock.parked = False
+        sock.keepalive_timer = None
+        self.release_connection(sock)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.close_request(sock)
+
+    def release_connection(self, sock):
+        """Forget a connection that was parked before it is closed."""
+        reactor = getattr(self, '__reactor__', None)
+        if reactor is not None and isinstance(sock, AcceptedStreamSocket):
+            try:
+                reactor.del_listener(sock)
+            except socket.error:
+                pass
+
+
+class Prefork(object):
+    """
+    Run ``target`` in ``workers`` forked processes.
+
+    Listening sockets created before `run` are shared by every worker. Dead
+    workers are respawned until SIGTERM/SIGINT is received, which is then
+    forwarded to the workers.
+
+    With a ``reactor`` the master runs it on its main thread meanwhile and
+    reaps the workers from a timer, so no other thread of the master can
+    hold a lock while a worker is forked.
+    """
+    # seconds between checks for exited workers when running a reactor
+    reap_interval = 0.2
+
+    def __init__(self, workers, target, reactor=None):
+        self.workers = workers
+        self.target = target
+        self.reactor = reactor
+        self.children = set()
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            self.target()
+        except KeyboardInterrupt:
+            pass
+        except:
+            logger.exception("Worker %d failed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.workers):
+            self.spawn()
+        logger.info("Started %d workers", self.workers)
+
+        if self.reactor is not None:
+            self.reactor.call_later(self.reap_interval, self.reap)
+            self.reactor.run()
+            return
+
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            self.children.discard(pid)
+            if not self.stopping:
+                logger.warning("Worker %d exited with status %d, respawning", pid, status)
+                time.sleep(0.1)
+                self.spawn()
+
+    def reap(self):
+        """Reactor timer: respawn exited workers, stop the reactor once all are gone after `stop`."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    self.children.clear()
+                    break
+                raise
+            if not pid:
+                break
+            self.children.discard(pid)
+            if not self.stopping:
+                logger.warning("Worker %d exited with status %d, respawning", pid, status)
+                self.reactor.call_later(0.1, self.respawn)
+        if self.stopping and not self.children:
+            self.reactor.stop()
+            return
+        self.reactor.call_later(self.reap_interval, self.reap)
+
+    def respawn(self):
+        if not self.stopping:
+            self.spawn()
+
+
+class TLSHandshake(object):
+    """
+    Server side handshake of an accepted connection, driven by the reactor
+    without blocking; the connection is handed to ``server.process_request``
+    once it completes.
+    """
+
+    def __init__(self, server, request, client_address):
+        self.server = server
+        self.client_address = client_address
+        self.reactor = server.get_reactor()
+        self.context = server.tls_context
+        _socket = request.socket
+        _socket.setblocking(0)
+        tls_socket = self.context.wrap_socket(_socket, server_side=True, do_handshake_on_connect=False)
+        self.sock = AcceptedTLSSocket(tls_socket, request.client_address)
+        self.sock.accepted = request.accepted
+        self.timer = None
+        self.session_reused = False
+
+    def start(self):
+        self.timer = self.reactor.call_later(self.server.tls_handshake_timeout, self.abort, 'timed out')
+        self.reactor.add_listener(self, self.sock)
+        self.dispatch(self.sock)
+
+    def dispatch(self, sock):
+        # the reactor runs every handshake step of a context, so the change of its hit counter
+        # is this one's; the session is looked up by the step reading the ClientHello, not the last one
+        hits = self.context.session_stats()['hits']
+        try:
+            sock.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self.reactor.set_writable(self, sock, False)
+            return
+        except ssl.SSLWantWriteError:
+            self.reactor.set_writable(self, sock)
+            return
+        except (ssl.SSLError, socket.error), e:
+            self.abort(e)
+            return
+        finally:
+            if self.context.session_stats()['hits'] > hits:
+                self.session_reused = True
+        self.finish(self.session_reused)
+
+    dispatch_write = dispatch
+
+    def finish(self, session_reused):
+        self.reactor.cancel_timer(self.timer)
+        self.reactor.del_listener(self.sock)
+        sock, client_address, server = self.sock, self.client_address, self.server
+        sock.socket.setblocking(1)
+        sock.handshake_done(session_reused)
+        if server.verify_request(sock, client_address):
+            try:
+                server.process_request(sock, client_address)
+            except:
+                server.handle_error(sock, client_address)
+                server.shutdown_request(sock)
+        else:
+            server.shutdown_request(sock)
+
+    def abort(self, reason):
+        self.reactor.cancel_timer(self.timer)
+        logger.debug("TLS handshake with %s failed: %s", self.sock, reason)
+        self.reactor.del_listener(self.sock)
+        self.sock.close()
+
+
 class ExternalReactorMixIn:
+    # ssl.SSLContext terminating TLS on the listening socket, see make_tls_context
+    tls_context = None
+    # seconds a client has to complete the handshake
+    tls_handshake_timeout = 10.0
+
     def get_reactor(self):
         """
         :rtype: Reactor
@@ -358,9 +1127,25 @@ class ExternalReactorMixIn:
         return self.__reactor__
 
     def dispatch(self, sock):
+        if getattr(sock, 'parked', False):
+            # the next request of a keep-alive connection, see ThreadPoolMixIn
+            return self.resume_connection(sock)
         setattr(self, '_socket', sock)
+        if self.tls_context is not None:
+            return self.start_tls()
         return self._handle_request_noblock()
 
+    def start_tls(self):
+        try:
+            request, client_address = self.get_request()
+        except socket.error:
+            return
+        try:
+            TLSHandshake(self, request, client_address).start()
+        except (ssl.SSLError, socket.error), e:
+            logger.debug("TLS setup for %s failed: %s", request, e)
+            request.close()
+
     def get_request(self):
         if hasattr(self, '_socket'):
             request, client_address = self._socket.accept()
@@ -417,6 +1202,18 @@ class MultiSocketServer(object):
             setattr(server, '__reactor__', self.reactor)
             self.servers.append(server)
 
+    def reset_reactor(self, reactor=None):
+        """
+        Move every server to a new reactor, e.g. in a forked worker process so
+        it does not share the parent's epoll instance.
+        """
+        old = self.reactor
+        self.reactor = reactor or Reactor()
+        for server in self.servers:
+            self.reactor.add_server(server)
+            setattr(server, '__reactor__', self.reactor)
+        old.server_close()
+
     def run(self, poll_interval=0.5):
         logger.info("Start serving")
         self.reactor.run(poll_interval)
@@ -425,12 +1222,15 @@ class MultiSocketServer(object):
         logger.info("Server stopping")
         for server in reversed(self.servers):
             if hasattr(server, 'server_close'):
-                server.server_close()
+                # unregister while the descriptor is still open
                 self.reactor.del_server(server)
+                server.server_close()
         self.reactor.shutdown()
 
 
 class TCPServer(ExternalReactorMixIn, socketserver.TCPServer):
+    socket_options = ()
+
     def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
         socketserver.TCPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate=False)
         self.socket.close()
@@ -440,7 +1240,7 @@ class TCPServer(ExternalReactorMixIn, socketserver.TCPServer):
             self.address_family = info[0]
 
         self.socket = StreamSocket(server_address, self.address_family, self.request_queue_size,
-                                   self.allow_reuse_address)
+                                   self.allow_reuse_address, self.socket_options)
         if bind_and_activate:
             self.server_bind()
             self.server_activate()
@@ -458,6 +1258,59 @@ class ForkingTCPServer(socketserver.ForkingMixIn, TCPServer):
     pass
 
 
+class UDPServer(ExternalReactorMixIn, socketserver.UDPServer):
+    """
+    Datagram server on a `Reactor`. Every readiness event handles all
+    datagrams `DatagramSocket.recv_many` returns, each as a
+    ``(data, socket)`` request like `socketserver.UDPServer`.
+    """
+    socket_options = ()
+    batch_size = 64
+    max_packet_size = 65536
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
+        socketserver.UDPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate=False)
+        self.socket.close()
+
+        if self.address_family == socket.AF_INET or self.address_family == socket.AF_INET6:
+            info = socket.getaddrinfo(server_address[0], None)[0]
+            self.address_family = info[0]
+
+        self.socket = DatagramSocket(server_address, self.address_family, self.allow_reuse_address,
+                                     self.socket_options, self.batch_size, self.max_packet_size)
+        if bind_and_activate:
+            self.server_bind()
+            self.server_activate()
+
+    def server_bind(self):
+        if isinstance(self.server_address, string_class):
+            if self.allow_reuse_address and not self.server_address.startswith("\0"):
+                if os.path.exists(self.server_address):
+                    os.unlink(self.server_address)
+
+        self.socket.server_bind()
+        self.server_address = self.socket.server_address
+
+    def server_activate(self):
+        self.socket.server_activate()
+
+    def dispatch(self, sock):
+        for data, client_address in sock.recv_many():
+            if not client_address:
+                client_address = (sock.server_address, 0)
+            request = (data, sock)
+            if self.verify_request(request, client_address):
+                try:
+                    self.process_request(request, client_address)
+                except:
+                    self.handle_error(request, client_address)
+                    self.shutdown_request(request)
+
+
+class ThreadingUDPServer(socketserver.ThreadingMixIn, UDPServer):
+    pass
+
+
 class ThreadingTCPServer(socketserver.ThreadingMixIn, TCPServer):
     pass
 
@@ -474,3 +1327,12 @@ if hasattr(socket, 'AF_UNIX'):
 
     class ForkingUnixStreamServer(socketserver.ForkingMixIn, UnixStreamServer):
         pass
+
+
+    class UnixDatagramServer(UDPServer):
+        address_family = socket.AF_UNIX
+        allow_reuse_address = True
+
+
+    class ThreadingUnixDatagramServer(socketserver.ThreadingMixIn, UnixDatagramServer):
+        pass
@@ -0,0 +1,360 @@
+# -*- coding:utf8 -*-
+from __future__ import absolute_import
+
+import os
+import errno
+import socket
+import struct
+import logging
+import threading
+
+from ..server import StreamSocket, AcceptedStreamSocket, request_context, MSG_DONTWAIT
+from .framing import message_payload, OPCODE_BINARY
+
+__author__ = 'fujie'
+
+logger = logging.getLogger("msocket.server.bus")
+
+# payload length, flags, topic length
+_header = struct.Struct('!IBH')
+HEADER_SIZE = _header.size
+FLAG_BINARY = 0x01
+FLAG_TOPIC = 0x02
+
+ENVIRON_KEY = 'MSOCKET_WEBSOCKET_BUS'
+
+
+def encode_record(topic, message, binary=False):
+    """
+    Encode a broadcast (``topic`` None) or a publication to ``topic`` as one
+    bus record: a 7 byte header, the topic and the message payload.
+    """
+    opcode, payload = message_payload(message, binary)
+    flags = FLAG_BINARY if opcode == OPCODE_BINARY else 0
+    if topic is None:
+        topic = b''
+    else:
+        flags |= FLAG_TOPIC
+        if not isinstance(topic, bytes):
+            topic = topic.encode('utf-8')
+    return _header.pack(len(payload), flags, len(topic)) + topic + payload
+
+
+def complete_records(buf):
+    """Length of the complete records at the start of ``buf``."""
+    offset = 0
+    end = len(buf)
+    while end - offset >= HEADER_SIZE:
+        length, _, topic_length = _header.unpack_from(buf, offset)
+        size = HEADER_SIZE + topic_length + length
+        if end - offset < size:
+            break
+        offset += size
+    return offset
+
+
+def decode_records(buf, end):
+    """Yield ``(topic, payload, binary)`` of the complete records in ``buf[:end]``."""
+    offset = 0
+    while offset < end:
+        length, flags, topic_length = _header.unpack_from(buf, offset)
+        offset += HEADER_SIZE
+        topic = None
+        if flags & FLAG_TOPIC:
+            topic = bytes(buf[offset:offset + topic_length]).decode('utf-8')
+        offset += topic_length
+        yield topic, bytes(buf[offset:offset + length]), bool(flags & FLAG_BINARY)
+        offset += length
+
+
+def parse_address(address):
+    """Unix socket path of ``unix:/path``, ``/path``, ``unix:@name`` or ``@name`` (abstract namespace)."""
+    if address.startswith('unix:'):
+        address = address[5:]
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    return address
+
+
+class _Endpoint(object):
+    """Non-blocking buffered writes of bus connections, flushed by the reactor."""
+
+    # a peer this far behind is disconnected
+    max_buffer = 16 * 1024 ** 2
+    recv_size = 256 * 1024
+
+    reactor = None
+
+    def _setup(self, sock):
+        sock.outbound = bytearray()
+        sock.inbound = bytearray()
+        sock.write_lock = threading.Lock()
+
+    def _write(self, sock, data):
+        """Send ``data`` to ``sock`` without blocking, returns False if the connection was dropped."""
+        with sock.write_lock:
+            outbound = sock.outbound
+            if not outbound:
+                try:
+                    sent = sock.socket.send(data, MSG_DONTWAIT)
+                except socket.error as e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        logger.debug("Failed to write to %s: %r", sock, e)
+                        self.disconnect(sock)
+                        return False
+                    sent = 0
+                if sent == len(data):
+                    return True
+                data = memoryview(data)[sent:]
+                self.reactor.set_writable(self, sock)
+            if len(outbound) + len(data) > self.max_buffer:
+                logger.warning("Dropping bus connection %s, %d bytes behind", sock, len(outbound))
+                self.disconnect(sock)
+                return False
+            outbound.extend(data)
+        return True
+
+    def dispatch_write(self, sock):
+        with sock.write_lock:
+            outbound = sock.outbound
+            try:
+                sent = sock.socket.send(outbound, MSG_DONTWAIT)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.disconnect(sock)
+                return
+            del outbound[:sent]
+            if not outbound:
+                self.reactor.set_writable(self, sock, False)
+
+    def _read(self, sock):
+        """Receive into ``sock.inbound``, returns the length of its complete records or None on EOF."""
+        try:
+            data = sock.socket.recv(self.recv_size)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            data = b''
+        if not data:
+            self.disconnect(sock)
+            return None
+        inbound = sock.inbound
+        inbound.extend(data)
+        return complete_records(inbound)
+
+    def disconnect(self, sock):
+        """Hook called once ``sock`` failed or reached EOF; subclasses drop and close it."""
+        pass
+
+
+class BroadcastHub(_Endpoint):
+    """
+    Relay of bus records between processes, listening on a Unix socket of a
+    `Reactor` (see `parse_address`).
+
+    Whatever a connected `WebSocketBus` writes is forwarded to every other
+    connection, in batches of the complete records read per wakeup.
+    """
+
+    def __init__(self, address, reactor=None):
+        self.address = address = parse_address(address)
+        if not address.startswith("\0") and os.path.exists(address):
+            os.unlink(address)
+        self.socket = StreamSocket(address, socket.AF_UNIX, request_queue_size=128,
+                                   allow_reuse_address=True)
+        self.socket.server_bind()
+        self.socket.server_activate()
+        self.socket.setblocking(0)
+        self.peers = {}
+        if reactor is not None:
+            self.start(reactor)
+
+    def start(self, reactor):
+        self.reactor = reactor
+        reactor.add_listener(self, self.socket)
+
+    def dispatch(self, sock):
+        if sock is self.socket:
+            try:
+                request, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            request.setblocking(0)
+            peer = AcceptedStreamSocket(request, client_address or self.address)
+            self._setup(peer)
+            self.peers[peer.fileno()] = peer
+            self.reactor.add_listener(self, peer)
+            return
+
+        end = self._read(sock)
+        if not end:
+            return
+        inbound = sock.inbound
+        batch = bytes(inbound[:end])
+        del inbound[:end]
+        for peer in list(self.peers.values()):
+            if peer is not sock:
+                self._write(peer, batch)
+
+    def disconnect(self, sock):
+        if self.peers.pop(sock.fileno(), None) is None:
+            return
+        self.reactor.del_listener(sock)
+        sock.close()
+
+    def detach(self):
+        """Close the hub's descriptors in a forked child, leaving the parent's hub running."""
+        for peer in list(self.peers.values()):
+            peer.socket.close()
+        self.socket.socket.close()
+        if self.reactor is not None:
+            self.reactor.server_close()
+
+    def server_close(self):
+        for peer in list(self.peers.values()):
+            self.disconnect(peer)
+        if self.reactor is not None:
+            self.reactor.del_listener(self.socket)
+        self.socket.close()
+        address = self.address
+        if not address.startswith("\0") and os.path.exists(address):
+            os.unlink(address)
+
+
+class WebSocketBus(_Endpoint):
+    """
+    Connection of one process's `WebSocketManager` to a `BroadcastHub`.
+
+    With ``manager.bus`` set, `WebSocketManager.broadcast` and
+    `WebSocketManager.publish` also reach the connections of every other
+    process on the hub. Each message is encoded once into a bus record,
+    records queued during one reactor iteration are written together, and
+    the receiving process encodes the websocket frame once for all of its
+    clients.
+
+    ``address`` defaults to the ``MSOCKET_WEBSOCKET_BUS`` environment
+    variable, set by ``msocket.wsgi.server`` with ``--websocket-bus``.
+    """
+
+    # seconds between attempts to reach the hub
+    reconnect_delay = 1.0
+    # seconds records are collected before they are written, 0 writes on the next reactor iteration
+    flush_delay = 0
+
+    def __init__(self, manager, address=None):
+        if address is None:
+            address = os.environ.get(ENVIRON_KEY)
+        if not address:
+            raise ValueError("no bus address given")
+        self.manager = manager
+        self.address = parse_address(address)
+        self.sock = None
+        self.lock = threading.Lock()
+        self.pending = []
+        self.flush_timer = None
+        self.reconnect_timer = None
+        self.closed = False
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        manager.bus = self
+
+    def start(self, reactor):
+        """Connect on ``reactor``; called by the manager for its first connection."""
+        with self.lock:
+            if self.reactor is not None:
+                return
+            self.reactor = reactor
+        self.connect()
+
+    def connect(self):
+        self.reconnect_timer = None
+        if self.closed:
+            return
+        _socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            _socket.connect(self.address)
+        except socket.error as e:
+            _socket.close()
+            logger.warning("Cannot reach websocket bus %r: %s", self.address, e)
+            self.reconnect_timer = self.reactor.call_later(self.reconnect_delay, self.connect)
+            return
+        _socket.setblocking(0)
+        sock = AcceptedStreamSocket(_socket, self.address)
+        self._setup(sock)
+        self.sock = sock
+        self.reactor.add_listener(self, sock)
+
+    def forward(self, topic, message, binary=False):
+        """Queue ``message`` for the other processes, returns False if the hub is unreachable."""
+        if self.reactor is None:
+            reactor = getattr(request_context, 'reactor', None)
+            if reactor is None:
+                self.dropped += 1
+                return False
+            self.start(reactor)
+        if self.sock is None:
+            self.dropped += 1
+            return False
+        record = encode_record(topic, message, binary)
+        with self.lock:
+            self.pending.append(record)
+            if self.flush_timer is not None:
+                return True
+            self.flush_timer = self.reactor.call_later(self.flush_delay, self.flush)
+        return True
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.flush_timer = None
+        sock = self.sock
+        if not pending:
+            return
+        if sock is None:
+            self.dropped += len(pending)
+            return
+        if self._write(sock, b''.join(pending)):
+            self.sent += len(pending)
+        else:
+            self.dropped += len(pending)
+
+    def dispatch(self, sock):
+        end = self._read(sock)
+        if not end:
+            return
+        inbound = sock.inbound
+        manager = self.manager
+        for topic, payload, binary in decode_records(inbound, end):
+            self.received += 1
+            try:
+                if topic is None:
+                    manager.broadcast(payload, binary, local=True)
+                else:
+                    manager.publish(topic, payload, binary, local=True)
+            except Exception:
+                logger.exception("Error while delivering a bus message")
+        del inbound[:end]
+
+    def disconnect(self, sock):
+        if self.sock is not sock:
+            return
+        self.sock = None
+        self.reactor.del_listener(sock)
+        sock.close()
+        if not self.closed:
+            logger.warning("Lost websocket bus %r, reconnecting", self.address)
+            self.reconnect_timer = self.reactor.call_later(self.reconnect_delay, self.connect)
+
+    def close(self):
+        self.closed = True
+        if self.reactor is None:
+            return
+        self.reactor.cancel_timer(self.reconnect_timer)
+        self.reactor.cancel_timer(self.flush_timer)
+        self.flush()
+        if self.sock is not None:
+            self.disconnect(self.sock)
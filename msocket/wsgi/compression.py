@@ -0,0 +1,158 @@
+# -*- coding:utf8 -*-
+from __future__ import absolute_import
+
+import zlib
+import threading
+import collections
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__author__ = 'fujie'
+
+
+class DeflateEncoder(object):
+    wbits = zlib.MAX_WBITS
+
+    def __init__(self, level=6):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, self.wbits)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class GzipEncoder(DeflateEncoder):
+    wbits = 16 + zlib.MAX_WBITS
+
+
+class BrotliEncoder(object):
+    def __init__(self, level=6):
+        # brotli quality is 0-11, zlib levels 0-9 are used as is
+        self._compressor = brotli.Compressor(quality=min(11, max(0, level)))
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+ENCODERS = collections.OrderedDict()
+if brotli is not None:
+    ENCODERS['br'] = BrotliEncoder
+ENCODERS['gzip'] = GzipEncoder
+ENCODERS['deflate'] = DeflateEncoder
+
+
+def negotiate(accept_encoding, encodings=None):
+    """
+    Choose a content coding from an Accept-Encoding header value.
+
+    Highest q-value wins, ties are broken by the order of ``encodings``
+    (defaults to the available encoders, best compression first).
+    """
+    if encodings is None:
+        encodings = ENCODERS
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+
+    best, best_q = None, 0.0
+    for name in encodings:
+        q = accepted.get(name, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def compress(encoding, data, level=6):
+    encoder = ENCODERS[encoding](level)
+    return b"".join([encoder.compress(d) for d in data] + [encoder.finish()])
+
+
+class CompressedIterator(object):
+    """
+    Compress an iterable response body on the fly.
+
+    Every block yielded by the application is flushed, so streaming responses
+    reach the client as they are produced.
+    """
+
+    def __init__(self, result, encoding, level=6):
+        self.result = result
+        self.encoder = ENCODERS[encoding](level)
+
+    def __iter__(self):
+        encoder = self.encoder
+        for data in self.result:
+            if not data:
+                continue
+            data = encoder.compress(data) + encoder.flush()
+            if data:
+                yield data
+        data = encoder.finish()
+        if data:
+            yield data
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+
+class CompressionCache(object):
+    """LRU cache of compressed bodies keyed by (ETag, encoding, request target)."""
+
+    def __init__(self, max_size=32 * 1024 ** 2, max_entry_size=1024 ** 2):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.size = 0
+        self.lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._entries[key] = data
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_entry_size:
+            return
+        with self.lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self.size = 0
@@ -0,0 +1,155 @@
+# -*- coding:utf8 -*-
+from __future__ import absolute_import
+
+import zlib
+import threading
+
+from .framing import frame_header, ProtocolError
+
+__author__ = 'fujie'
+
+EXTENSION_NAME = 'permessage-deflate'
+_TAIL = b'\x00\x00\xff\xff'
+
+
+def parse_extensions(header):
+    """
+    Parse a Sec-WebSocket-Extensions value into ``[(name, {param: value}), ...]``.
+    Parameters without a value map to None.
+    """
+    offers = []
+    if not header:
+        return offers
+    for offer in header.split(','):
+        parts = [p.strip() for p in offer.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            if not part:
+                continue
+            key, sep, value = part.partition('=')
+            params[key.strip().lower()] = value.strip().strip('"') if sep else None
+        offers.append((parts[0].lower(), params))
+    return offers
+
+
+def _window_bits(value, default=15):
+    if value is None:
+        return default
+    bits = int(value)
+    if not 8 <= bits <= 15:
+        raise ValueError(bits)
+    return bits
+
+
+class PerMessageDeflate(object):
+    """
+    Negotiated permessage-deflate (RFC 7692) state of one connection.
+
+    Without context takeover a fresh zlib context is used for every message,
+    which keeps no memory between messages and makes compressed output
+    identical for every connection with the same parameters (see `key`).
+    """
+
+    def __init__(self, server_no_context_takeover=True, client_no_context_takeover=False,
+                 server_max_window_bits=15, client_max_window_bits=15, level=6, mem_level=8):
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        # zlib does not support raw deflate streams with an 8 bit window
+        self.server_max_window_bits = max(9, server_max_window_bits)
+        self.client_max_window_bits = client_max_window_bits
+        self.level = level
+        self.mem_level = mem_level
+        self.lock = threading.Lock()
+        self._compressor = None
+        self._decompressor = None
+
+    @property
+    def key(self):
+        """Identifies connections producing byte-identical compressed frames, None with context takeover."""
+        if not self.server_no_context_takeover:
+            return None
+        return self.server_max_window_bits, self.level, self.mem_level
+
+    @property
+    def memory(self):
+        """Approximate memory held between messages, per the zlib documentation."""
+        size = 0
+        if not self.server_no_context_takeover:
+            size += (1 << (self.server_max_window_bits + 2)) + (1 << (self.mem_level + 9))
+        if not self.client_no_context_takeover:
+            size += 1 << 15
+        return size
+
+    def response_header(self):
+        params = [EXTENSION_NAME]
+        if self.server_no_context_takeover:
+            params.append('server_no_context_takeover')
+        if self.client_no_context_takeover:
+            params.append('client_no_context_takeover')
+        if self.server_max_window_bits < 15:
+            params.append('server_max_window_bits=%d' % self.server_max_window_bits)
+        if self.client_max_window_bits < 15:
+            params.append('client_max_window_bits=%d' % self.client_max_window_bits)
+        return '; '.join(params)
+
+    def compress(self, data):
+        compressor = self._compressor
+        if compressor is None:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.server_max_window_bits, self.mem_level)
+            if not self.server_no_context_takeover:
+                self._compressor = compressor
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(_TAIL):
+            data = data[:-4]
+        return data or b'\x00'
+
+    def decompress(self, data, max_size=None):
+        decompressor = self._decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-15)
+            if not self.client_no_context_takeover:
+                self._decompressor = decompressor
+        try:
+            if max_size:
+                result = decompressor.decompress(data + _TAIL, max_size)
+                if decompressor.unconsumed_tail:
+                    raise ProtocolError("message too big", 1009)
+                return result
+            return decompressor.decompress(data + _TAIL)
+        except zlib.error as e:
+            raise ProtocolError("invalid compressed data: %s" % e, 1007)
+
+    def encode_frame(self, opcode, payload):
+        data = self.compress(payload)
+        return frame_header(len(data), opcode, rsv1=True) + data
+
+    @classmethod
+    def negotiate(cls, header, server_no_context_takeover=True, client_no_context_takeover=False,
+                  level=6, mem_level=8):
+        """
+        Accept the first acceptable permessage-deflate offer of ``header``.
+        Returns a `PerMessageDeflate` or None.
+        """
+        for name, params in parse_extensions(header):
+            if name != EXTENSION_NAME:
+                continue
+            try:
+                server_bits = _window_bits(params.get('server_max_window_bits'))
+                if 'client_max_window_bits' in params:
+                    client_bits = _window_bits(params['client_max_window_bits'])
+                else:
+                    client_bits = 15
+            except ValueError:
+                continue
+            if server_bits < 9:
+                continue
+            unknown = set(params) - {'server_no_context_takeover', 'client_no_context_takeover',
+                                     'server_max_window_bits', 'client_max_window_bits'}
+            if unknown:
+                continue
+            return cls(server_no_context_takeover or 'server_no_context_takeover' in params,
+                       client_no_context_takeover or 'client_no_context_takeover' in params,
+                       server_bits, client_bits, level, mem_level)
+        return None
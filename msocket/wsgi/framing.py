@@ -0,0 +1,280 @@
+# -*- coding:utf8 -*-
+from __future__ import absolute_import
+
+import struct
+import binascii
+
+from ..compat import py3k
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = 'fujie'
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xa
+
+_pack_B = struct.Struct('!BB').pack
+_pack_H = struct.Struct('!BBH').pack
+_pack_Q = struct.Struct('!BBQ').pack
+_unpack_H = struct.Struct('!H').unpack_from
+_unpack_Q = struct.Struct('!Q').unpack_from
+
+# below this size the per-call overhead of numpy outweighs its speed
+NUMPY_UNMASK_THRESHOLD = 2048
+
+if py3k:
+    text_type = str
+else:
+    text_type = unicode
+
+
+def frame_header(length, opcode, fin=True, rsv1=False):
+    """Header of an unmasked (server to client) frame carrying ``length`` bytes."""
+    first = opcode | (0x80 if fin else 0) | (0x40 if rsv1 else 0)
+    if length < 126:
+        return _pack_B(first, length)
+    if length < 0x10000:
+        return _pack_H(first, 126, length)
+    return _pack_Q(first, 127, length)
+
+
+def message_payload(message, binary=False):
+    """
+    Return ``(opcode, payload bytes)`` for ``message``, which may be text,
+    bytes or a ws4py ``Message``.
+    """
+    opcode = getattr(message, 'opcode', None)
+    if opcode is not None:
+        data = message.data
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        return opcode, bytes(data)
+    if isinstance(message, text_type):
+        return OPCODE_TEXT if not binary else OPCODE_BINARY, message.encode('utf-8')
+    if isinstance(message, (bytearray, memoryview)):
+        message = bytes(message)
+    return (OPCODE_BINARY if binary else OPCODE_TEXT), message
+
+
+def encode_frame(message, binary=False):
+    """
+    Build a complete unmasked frame. Server to client frames are not masked,
+    so the result is byte-identical for every client and can be shared.
+    """
+    opcode, payload = message_payload(message, binary)
+    return frame_header(len(payload), opcode) + payload
+
+
+def split_frame(frame):
+    """
+    Return ``(fin, opcode, payload)`` of one complete unmasked frame as built
+    by `encode_frame` or ws4py, or None if ``frame`` is not exactly one frame.
+    """
+    frame = bytes(frame)
+    if len(frame) < 2:
+        return None
+    first, length = bytearray(frame[:2])
+    if length & 0x80:
+        return None
+    length &= 0x7f
+    pos = 2
+    if length == 126:
+        length = _unpack_H(frame, 2)[0]
+        pos = 4
+    elif length == 127:
+        length = _unpack_Q(frame, 2)[0]
+        pos = 10
+    if len(frame) != pos + length:
+        return None
+    return bool(first & 0x80), first & 0x0f, frame[pos:]
+
+
+def encode_close(code=1000, reason=''):
+    if isinstance(reason, text_type):
+        reason = reason.encode('utf-8')
+    payload = struct.pack('!H', code) + reason
+    return frame_header(len(payload), OPCODE_CLOSE) + payload
+
+
+def is_control_frame(frame):
+    return bytearray(frame[:1])[0] & 0x08 == 0x08
+
+
+def _unmask_int(mask, data):
+    """XOR the whole payload as one big integer instead of byte by byte."""
+    length = len(data)
+    key = (bytes(mask) * (length // 4 + 1))[:length]
+    if py3k:
+        value = int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')
+        return value.to_bytes(length, 'big')
+    value = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(key), 16)
+    return binascii.unhexlify('%0*x' % (length * 2, value))
+
+
+def _unmask_numpy(mask, data):
+    length = len(data)
+    words, tail = divmod(length, 8)
+    out = numpy.frombuffer(bytes(data), dtype=numpy.uint8).copy()
+    if words:
+        key = numpy.frombuffer(bytes(mask) * 2, dtype=numpy.uint64)[0]
+        body = out[:words * 8].view(numpy.uint64)
+        numpy.bitwise_xor(body, key, out=body)
+    if tail:
+        key = numpy.frombuffer(bytes(mask) * 2, dtype=numpy.uint8)[:tail]
+        numpy.bitwise_xor(out[words * 8:], key, out=out[words * 8:])
+    return out.tobytes()
+
+
+def unmask(mask, data):
+    """Apply the 4 byte client ``mask`` to ``data`` (bytes, bytearray or memoryview)."""
+    if not data:
+        return b""
+    if numpy is not None and len(data) >= NUMPY_UNMASK_THRESHOLD:
+        return _unmask_numpy(mask, data)
+    return _unmask_int(mask, data)
+
+
+class ProtocolError(Exception):
+    def __init__(self, message, code=1002):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class Message(object):
+    """Minimal stand-in for ws4py messages when ws4py is not importable."""
+
+    def __init__(self, opcode, data=b""):
+        self.opcode = opcode
+        self.data = data
+        self.is_binary = opcode == OPCODE_BINARY
+        self.is_text = opcode == OPCODE_TEXT
+        self.completed = True
+
+    def __len__(self):
+        return len(self.data)
+
+    def __str__(self):
+        return self.data
+
+
+class FrameParser(object):
+    """
+    Incremental parser of client to server frames.
+
+    `feed` takes whatever was read from the socket and returns every complete
+    ``(opcode, payload, rsv1)`` it contains. Fragmented messages are reassembled
+    and returned with the opcode of their first frame, control frames are
+    returned as soon as they arrive even between fragments.
+    """
+
+    def __init__(self, max_message_size=None, require_mask=True, allow_rsv1=False):
+        self.max_message_size = max_message_size
+        self.require_mask = require_mask
+        self.allow_rsv1 = allow_rsv1
+        self.buffer = bytearray()
+        self._fragments = []
+        self._fragment_opcode = None
+        self._fragment_rsv1 = False
+        self._fragment_size = 0
+
+    def feed(self, data):
+        buf = self.buffer
+        buf.extend(data)
+        frames = []
+        offset = 0
+        end = len(buf)
+        while True:
+            header = self._parse_header(buf, offset, end)
+            if header is None:
+                break
+            fin, rsv1, opcode, mask, start, length = header
+            if end - start < length:
+                break
+            payload = buf[start:start + length]
+            offset = start + length
+            if mask is not None:
+                payload = unmask(mask, payload)
+            else:
+                payload = bytes(payload)
+            message = self._frame(fin, rsv1, opcode, payload)
+            if message is not None:
+                frames.append(message)
+        if offset:
+            del buf[:offset]
+        return frames
+
+    def _parse_header(self, buf, offset, end):
+        if end - offset < 2:
+            return None
+        first, second = buf[offset], buf[offset + 1]
+        fin = bool(first & 0x80)
+        rsv1 = bool(first & 0x40)
+        if first & 0x30 or (rsv1 and not self.allow_rsv1):
+            raise ProtocolError("reserved bits set")
+        opcode = first & 0x0f
+        masked = second & 0x80
+        length = second & 0x7f
+        pos = offset + 2
+        if length == 126:
+            if end - pos < 2:
+                return None
+            length = _unpack_H(buf, pos)[0]
+            pos += 2
+        elif length == 127:
+            if end - pos < 8:
+                return None
+            length = _unpack_Q(buf, pos)[0]
+            pos += 8
+
+        if opcode & 0x08:
+            if length > 125 or not fin or rsv1:
+                raise ProtocolError("invalid control frame")
+        elif self.max_message_size is not None and self._fragment_size + length > self.max_message_size:
+            raise ProtocolError("message too big", 1009)
+
+        mask = None
+        if masked:
+            if end - pos < 4:
+                return None
+            mask = bytes(buf[pos:pos + 4])
+            pos += 4
+        elif self.require_mask:
+            raise ProtocolError("unmasked client frame")
+        return fin, rsv1, opcode, mask, pos, length
+
+    def _frame(self, fin, rsv1, opcode, payload):
+        if opcode & 0x08:
+            if opcode not in (OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG):
+                raise ProtocolError("unknown opcode %d" % opcode)
+            return opcode, payload, False
+
+        if opcode == OPCODE_CONTINUATION:
+            if self._fragment_opcode is None or rsv1:
+                raise ProtocolError("unexpected continuation frame")
+        elif opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            if self._fragment_opcode is not None:
+                raise ProtocolError("expected continuation frame")
+            if fin:
+                return opcode, payload, rsv1
+            self._fragment_opcode = opcode
+            self._fragment_rsv1 = rsv1
+        else:
+            raise ProtocolError("unknown opcode %d" % opcode)
+
+        self._fragments.append(payload)
+        self._fragment_size += len(payload)
+        if not fin:
+            return None
+        message = (self._fragment_opcode, b"".join(self._fragments), self._fragment_rsv1)
+        self._fragments = []
+        self._fragment_opcode = None
+        self._fragment_rsv1 = False
+        self._fragment_size = 0
+        return message
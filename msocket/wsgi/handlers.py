@@ -1,7 +1,10 @@
 # -*- coding:utf8 -*-
 from __future__ import absolute_import
 
+import sys
 import socket
+import select
+import time
 import errno
 import logging
 from wsgiref.handlers import SimpleHandler as _SimpleHandler
@@ -9,23 +12,265 @@ from wsgiref.simple_server import (
     WSGIRequestHandler as _WSGIRequestHandler)
 import wsgiref.util
 
-from ..server import make_poller, request_context
+from ..server import make_poller, request_context, sendfile as _sendfile
+from . import compression as _compression
+from .timing import RequestTiming
 
 logger = logging.getLogger("msocket.server.handler")
 wsgiref.util._hoppish = {}.__contains__
 
 
+class RequestEntityTooLarge(IOError):
+    pass
+
+
+class InputStream(object):
+    """
+    Bounded, streaming ``wsgi.input``.
+
+    - Never reads past the request body, so an unread body can not be
+      mistaken for the next keep-alive request.
+    - Decodes ``Transfer-Encoding: chunked`` bodies incrementally.
+    - Sends ``100 Continue`` on the first read when the client asked for it,
+      so applications rejecting a request never receive the body.
+    - Raises `RequestEntityTooLarge` once more than ``max_size`` bytes would
+      be read. Applications may lower or raise ``max_size`` before reading.
+    """
+
+    max_line = 64 * 1024
+
+    def __init__(self, rfile, wfile=None, content_length=None, chunked=False, expect_continue=False,
+                 max_size=None):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.chunked = chunked
+        self.content_length = content_length
+        self.expect_continue = expect_continue
+        self.max_size = max_size
+        self.bytes_read = 0
+        self.finished = not chunked and not content_length
+        self.trailers = []
+        # remaining bytes of the current chunk, or of the whole body
+        self._remaining = 0 if chunked else (content_length or 0)
+
+    def __getattr__(self, item):
+        # ws4py digs the raw socket out of wsgi.input
+        return getattr(self.rfile, item)
+
+    def too_large(self):
+        return self.max_size is not None and self.content_length is not None and \
+            self.content_length > self.max_size
+
+    def send_continue(self):
+        if self.expect_continue:
+            self.expect_continue = False
+            if self.wfile is not None:
+                self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                self.wfile.flush()
+
+    def _check_size(self, size):
+        if self.max_size is not None and self.bytes_read + size > self.max_size:
+            raise RequestEntityTooLarge("request body exceeds %d bytes" % self.max_size)
+
+    def _next_chunk(self):
+        line = self.rfile.readline(self.max_line)
+        if not line.endswith(b"\n"):
+            raise IOError("invalid chunk header")
+        try:
+            size = int(line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise IOError("invalid chunk size %r" % line)
+        if size < 0:
+            raise IOError("invalid chunk size %r" % line)
+        if size == 0:
+            while True:
+                line = self.rfile.readline(self.max_line)
+                if not line or line in (b"\r\n", b"\n"):
+                    break
+                self.trailers.append(line)
+            self.finished = True
+        self._remaining = size
+
+    def _end_chunk(self):
+        if self.rfile.readline(self.max_line) not in (b"\r\n", b"\n"):
+            raise IOError("missing chunk terminator")
+
+    def _available(self):
+        """Return the number of bytes readable without crossing a chunk boundary."""
+        if self.finished:
+            return 0
+        if self.expect_continue:
+            self.send_continue()
+        if self._remaining == 0 and self.chunked:
+            self._next_chunk()
+        return self._remaining
+
+    def _consume(self, data):
+        self.bytes_read += len(data)
+        self._remaining -= len(data)
+        if self._remaining == 0:
+            if self.chunked:
+                self._end_chunk()
+            else:
+                self.finished = True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(64 * 1024), b""))
+
+        buf = []
+        while size > 0:
+            available = self._available()
+            if not available:
+                break
+            n = min(size, available)
+            self._check_size(n)
+            data = self.rfile.read(n)
+            if not data:
+                raise IOError("client closed connection before end of request body")
+            self._consume(data)
+            buf.append(data)
+            size -= len(data)
+            if not self.chunked:
+                break
+        return b"".join(buf)
+
+    def readline(self, size=-1):
+        buf = []
+        while size is None or size < 0 or size > 0:
+            available = self._available()
+            if not available:
+                break
+            n = available if size is None or size < 0 else min(size, available)
+            data = self.rfile.readline(min(n, self.max_line))
+            if not data:
+                raise IOError("client closed connection before end of request body")
+            self._check_size(len(data))
+            self._consume(data)
+            buf.append(data)
+            if size is not None and size > 0:
+                size -= len(data)
+            if data.endswith(b"\n"):
+                break
+        return b"".join(buf)
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def discard(self, limit):
+        """
+        Skip the unread rest of the body, reading at most ``limit`` bytes.
+
+        Returns True when the connection can be reused for the next request.
+        """
+        if self.expect_continue:
+            # the client is still waiting for permission to send the body
+            return self.finished
+        self.max_size = None
+        try:
+            while not self.finished and limit > 0:
+                data = self.read(min(limit, 64 * 1024))
+                if not data:
+                    break
+                limit -= len(data)
+        except (IOError, ValueError):
+            return False
+        return self.finished
+
+
 # noinspection PyClassHasNoInit
 class SimpleHandler(_SimpleHandler):
     http_version = '1.1'
 
+    # response compression, opt-in on subclasses
+    compression = False
+    compression_types = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                         'image/svg+xml')
+    compression_min_size = 1024
+    compression_level = 6
+    compression_encodings = tuple(_compression.ENCODERS)
+    # CompressionCache for responses with an ETag
+    compression_cache = None
+
+    def setup_compression(self):
+        """
+        Wrap the response body in a content coding negotiated from
+        Accept-Encoding. Bodies of known length are compressed at once (and
+        cached by ETag), others are compressed while streaming and sent chunked.
+        """
+        if not self.compression or self.headers_sent or self.status[:3] not in ('200', '201', '202', '203'):
+            return
+        environ = self.environ
+        headers = self.headers
+        if environ['REQUEST_METHOD'] == 'HEAD' or 'Content-Encoding' in headers or self.result_is_file():
+            return
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return
+        content_type = (headers.get('Content-Type') or '').split(';', 1)[0].strip().lower()
+        if not content_type.startswith(self.compression_types):
+            return
+
+        result = self.result
+        buffered = isinstance(result, (list, tuple))
+        if buffered:
+            size = sum(len(d) for d in result)
+        else:
+            size = headers.get('Content-Length')
+            size = int(size) if size is not None else None
+        if size is not None and size < self.compression_min_size:
+            return
+
+        encoding = _compression.negotiate(environ.get('HTTP_ACCEPT_ENCODING'), self.compression_encodings)
+        if encoding is None:
+            return
+
+        vary = headers.get('Vary')
+        if not vary:
+            headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower() and vary != '*':
+            headers['Vary'] = vary + ', Accept-Encoding'
+
+        etag = headers.get('ETag')
+        if buffered:
+            cache = self.compression_cache
+            key = None
+            if etag and cache is not None:
+                key = (etag, encoding, environ.get('PATH_INFO'), environ.get('QUERY_STRING'))
+                body = cache.get(key)
+            else:
+                body = None
+            if body is None:
+                body = _compression.compress(encoding, result, self.compression_level)
+                if key is not None:
+                    cache.put(key, body)
+            self.result = [body]
+            headers['Content-Length'] = str(len(body))
+        else:
+            del headers['Content-Length']
+            self.result = _compression.CompressedIterator(result, encoding, self.compression_level)
+
+        headers['Content-Encoding'] = encoding
+        if etag and not etag.startswith('W/'):
+            # the compressed representation is not byte-identical anymore
+            headers['ETag'] = 'W/' + etag
+
     def finish_chunked_response(self):
         if 'HTTP/1.1' <= self.environ['SERVER_PROTOCOL'] and 'Transfer-Encoding' not in self.headers:
             self.headers['Transfer-Encoding'] = 'chunked'
             try:
                 self.send_headers()
                 for data in self.result:
-                    data = "%d\r\n%s\r\n" % (len(data), data)
+                    data = "%x\r\n%s\r\n" % (len(data), data)
                     self.write(data)
                 self.write("0\r\n\r\n")
             finally:
@@ -38,6 +283,91 @@ class SimpleHandler(_SimpleHandler):
     def finish_normal_response(self):
         _SimpleHandler.finish_response(self)
 
+    def mark_first_write(self):
+        timing = self.environ.get('msocket.timing') if self.environ else None
+        if timing is not None and timing.first_write is None:
+            timing.first_write = time.time()
+
+    def write(self, data):
+        self.mark_first_write()
+        _SimpleHandler.write(self, data)
+
+    def handle_error(self):
+        if isinstance(sys.exc_info()[1], RequestEntityTooLarge):
+            # noinspection PyUnresolvedReferences
+            self.request_handler.close_connection = 1
+            if not self.headers_sent:
+                self.result = self.error_output(self.environ, self.start_response, '413 Request Entity Too Large')
+                self.finish_response()
+            return
+        _SimpleHandler.handle_error(self)
+
+    def error_output(self, environ, start_response, status=None):
+        if status is None:
+            return _SimpleHandler.error_output(self, environ, start_response)
+        body = status.encode('ascii')
+        start_response(status, [('Content-Type', 'text/plain'), ('Content-Length', str(len(body))),
+                                ('Connection', 'close')], sys.exc_info())
+        return [body]
+
+    def finish_content(self):
+        _SimpleHandler.finish_content(self)
+        # bodiless responses (304, HEAD) only write headers, which stay in the
+        # buffered wfile until the keep-alive connection is closed otherwise
+        self._flush()
+
+    def sendfile(self):
+        """
+        Send a ``wsgi.file_wrapper`` result with ``sendfile(2)`` (see
+        `msocket.server.sendfile`, through ctypes on Python 2).
+
+        Only used when the response length is known, so the body can be
+        written straight from the page cache to the socket.
+        """
+        filelike = getattr(self.result, 'filelike', None)
+        request_handler = getattr(self, 'request_handler', None)
+        if _sendfile is None or request_handler is None or not hasattr(filelike, 'fileno'):
+            return False
+        if 'Content-Length' not in self.headers:
+            return False
+
+        connection = request_handler.connection
+        if getattr(connection, 'tls', False) and not connection.ktls_send:
+            # only a kernel encrypting the records may write the file itself
+            return False
+
+        try:
+            in_fd = filelike.fileno()
+            out_fd = connection.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+
+        offset = getattr(self.result, 'offset', 0)
+        remaining = int(self.headers['Content-Length'])
+        timeout = connection.gettimeout()
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        self.mark_first_write()
+
+        while remaining > 0:
+            try:
+                sent = _sendfile(out_fd, in_fd, offset, remaining)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    _, w, _ = select.select([], [out_fd], [], timeout)
+                    if not w:
+                        raise socket.timeout('timed out')
+                    continue
+                raise
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+            self.bytes_sent += sent
+        return True
+
     def finish_response(self):
         """
         Completes the response and performs the following tasks:
@@ -50,6 +380,7 @@ class SimpleHandler(_SimpleHandler):
 
         # noinspection PyCompatibility
         try:
+            self.setup_compression()
             if hasattr(self.result, 'close') and 'Content-Length' not in self.headers:
                 self.finish_chunked_response()
             else:
@@ -60,6 +391,10 @@ class SimpleHandler(_SimpleHandler):
 
     def close(self):
         try:
+            timing = self.environ.get('msocket.timing') if self.environ else None
+            if timing is not None:
+                self.mark_first_write()
+                timing.finished = time.time()
             # noinspection PyUnresolvedReferences
             self.request_handler.log_request(
                 self.status.split(' ', 1)[0], self.bytes_sent
@@ -73,27 +408,77 @@ class WSGIKeepAlivedMixIn:
     protocol_version = "HTTP/1.1"
     wsgi_handler = SimpleHandler
     keepalive_timeout = 60
+    # maximum request body size, None for unlimited
+    max_request_body_size = None
+    # ((path prefix, max size), ...), the longest matching prefix wins
+    request_body_limits = ()
+    # unread body bytes skipped to keep the connection alive
+    max_discard_size = 64 * 1024
+    # append the RequestTiming phases (in ms) to the access log
+    log_timing = True
     resolve_ipv6_address = True
     resolve_ipv6_link_local_address = False
+    # serve h2c (prior knowledge and Upgrade), see msocket.wsgi.http2
+    http2 = True
+    # threads running the streams of all HTTP/2 connections of a server
+    http2_workers = 32
+    http2_max_concurrent_streams = 100
+    # streams of one connection running at once on the shared threads, the others wait their turn
+    http2_max_running_streams = 8
+    # seconds a stream waits for a flow-control window or its request body before it is reset
+    http2_stream_timeout = 30
+    # receive windows of a stream and of a connection
+    http2_initial_window_size = 1024 ** 2
+    http2_connection_window_size = 16 * 1024 ** 2
+    http2_max_frame_size = 16384
+    http2_max_header_list_size = 64 * 1024
 
     def handle_one_request(self):
         """Handle a single HTTP request"""
 
+        timing = self.timing = self.start_timing()
         try:
             self.raw_requestline = self.rfile.readline()
             if not self.raw_requestline:
                 self.close_connection = 1
                 return
+            timing.first_byte = time.time()
+            if self.http2 and self.raw_requestline == b'PRI * HTTP/2.0\r\n' and \
+                    not getattr(self.connection, 'tls', False):
+                from . import http2
+
+                self.close_connection = 1
+                http2.serve_prior_knowledge(self)
+                return
             if not self.parse_request():
                 # An error code has been sent, just exit
                 return
+            timing.headers_parsed = time.time()
+
+            if self.http2 and 'Upgrade' in self.headers:
+                from . import http2
+
+                if http2.is_upgrade(self) and http2.serve_upgrade(self):
+                    self.close_connection = 1
+                    return
+
+            body = self.get_request_body()
+            if body is None:
+                return
+            if body.too_large():
+                self.close_connection = 1
+                self.send_error(413)
+                return
 
+            environ = self.get_environ()
+            environ['msocket.timing'] = timing
             handler = self.wsgi_handler(
-                self.rfile, self.wfile, self.get_stderr(), self.get_environ()
+                body, self.wfile, self.get_stderr(), environ
             )
             handler.request_handler = self  # backpointer for logging
 
             def application(environ, start_response):
+                timing.app_called = time.time()
                 ret = self.server.get_app()(environ, start_response)
 
                 connection = handler.headers.get('Connection')
@@ -115,6 +500,9 @@ class WSGIKeepAlivedMixIn:
 
             handler.run(application)
 
+            if not self.close_connection and not body.discard(self.max_discard_size):
+                self.close_connection = 1
+
         except socket.timeout as e:
             # a read or a write timed out.  Discard this connection
             self.log_error("Request timed out: %r", e)
@@ -125,29 +513,109 @@ class WSGIKeepAlivedMixIn:
             self.close_connection = 1
             return
 
+    def start_timing(self):
+        """
+        Create the `RequestTiming` of the next request. The accept time is
+        only attributed to the first request of a connection.
+        """
+        started = getattr(self, 'request_started', None) or time.time()
+        self.request_started = None
+        accepted = getattr(self.request, 'accepted', None)
+        if accepted is not None:
+            self.request.accepted = None
+        return RequestTiming(accepted, started)
+
+    def log_request(self, code='-', size='-'):
+        timing = getattr(self, 'timing', None)
+        if timing is not None:
+            stats = getattr(self.server, 'timing_stats', None)
+            if stats is not None and timing.finished is not None:
+                stats.record(timing)
+            if self.log_timing:
+                self.log_message('"%s" %s %s %s', self.requestline, str(code), str(size), timing)
+                return
+        self.log_message('"%s" %s %s', self.requestline, str(code), str(size))
+
+    def handle_expect_100(self):
+        # Python 3 answers "Expect: 100-continue" while parsing the request;
+        # InputStream sends it once the application reads the body instead
+        return True
+
+    def get_request_body_limit(self, path=None):
+        if path is None:
+            path = self.path.split('?', 1)[0]
+        limit, matched = self.max_request_body_size, -1
+        for prefix, size in self.request_body_limits:
+            if len(prefix) > matched and path.startswith(prefix):
+                limit, matched = size, len(prefix)
+        return limit
+
+    def get_request_body(self):
+        """
+        Build the `InputStream` for the current request, or send an error and
+        return None when the framing headers are invalid.
+        """
+        headers = self.headers
+        chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        content_length = None
+        if not chunked:
+            try:
+                content_length = int(headers.get('Content-Length') or 0)
+                if content_length < 0:
+                    raise ValueError(content_length)
+            except ValueError:
+                self.close_connection = 1
+                self.send_error(400, "Bad Content-Length")
+                return None
+
+        expect_continue = (self.request_version >= 'HTTP/1.1' and
+                           headers.get('Expect', '').lower() == '100-continue')
+        return InputStream(self.rfile, self.wfile, content_length, chunked,
+                           expect_continue, self.get_request_body_limit())
+
     def handle(self):
         self.close_connection = 1
+        self.request_started = time.time()
         self.handle_one_request()
 
-        if self.close_connection:
-            return
-
-        if self.keepalive_timeout == 0:
-            while not self.close_connection:
-                self.handle_one_request()
-            return
-
-        poller = make_poller()
-        poller.register(self.rfile)
+        # pooled servers serve a request per thread, the reactor waits for the next one
+        park = getattr(self.server, 'park_connection', None)
+        # records already decrypted by OpenSSL do not make the socket readable
+        pending = getattr(self.connection, 'pending', None)
+        poller = None
 
         while not self.close_connection:
-            r = poller.poll(poll_interval=self.keepalive_timeout)
-            conn = [True for _ in r]
-            if conn:
+            if (pending is not None and pending()) or self.rfile_buffered():
+                ready = True
+            elif park is not None and self.park(park):
+                return
+            elif self.keepalive_timeout == 0:
+                ready = True
+            else:
+                if poller is None:
+                    poller = make_poller()
+                    poller.register(self.rfile)
+                ready = bool(list(poller.poll(poll_interval=self.keepalive_timeout)))
+            if ready:
+                self.request_started = time.time()
                 self.handle_one_request()
             else:
                 self.close_connection = 1
 
+    def rfile_buffered(self):
+        """Whether a pipelined request is already read into the rfile buffer."""
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        return rbuf is not None and len(rbuf.getvalue()) > 0
+
+    def park(self, park_connection):
+        """Hand the idle connection over to the server's reactor, see `ThreadPoolMixIn.park_connection`."""
+        self.wfile.flush()
+        if not park_connection(self.request, self.keepalive_timeout):
+            return False
+        # closed by the thread serving its last request
+        request_context.close_connection = False
+        return True
+
     def address_string(self):
         if hasattr(self, '_address_string_cache'):
             return self._address_string_cache
@@ -174,4 +642,14 @@ class WSGIRequestHandler(WSGIKeepAlivedMixIn, _WSGIRequestHandler):
     def get_environ(self):
         env = _WSGIRequestHandler.get_environ(self)
         env['REMOTE_PORT'] = self.client_address[1]
+        connection = self.connection
+        if getattr(connection, 'tls', False):
+            env['HTTPS'] = 'on'
+            env['SSL_PROTOCOL'] = connection.version
+            env['SSL_CIPHER'] = str(connection.cipher[0]) if connection.cipher else None
+            env['SSL_SESSION_RESUMED'] = 'Resumed' if connection.session_reused else 'Initial'
+            env['msocket.alpn_protocol'] = connection.alpn_protocol
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            env.pop('CONTENT_LENGTH', None)
+            env['wsgi.input_terminated'] = True
         return env
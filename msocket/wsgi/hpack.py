@@ -0,0 +1,407 @@
+# -*- coding:utf8 -*-
+"""
+HPACK (RFC 7541) header compression of `msocket.wsgi.http2`.
+
+`Decoder` accepts everything a peer may send. `Encoder` indexes repeated
+response headers in its dynamic table and Huffman codes string literals
+when that is shorter; values that change on every response, and cookies,
+are never indexed.
+"""
+from __future__ import absolute_import
+
+import binascii
+
+__author__ = 'fujie'
+
+
+class HPACKError(ValueError):
+    pass
+
+
+STATIC_TABLE = (
+    (b':authority', b''),
+    (b':method', b'GET'),
+    (b':method', b'POST'),
+    (b':path', b'/'),
+    (b':path', b'/index.html'),
+    (b':scheme', b'http'),
+    (b':scheme', b'https'),
+    (b':status', b'200'),
+    (b':status', b'204'),
+    (b':status', b'206'),
+    (b':status', b'304'),
+    (b':status', b'400'),
+    (b':status', b'404'),
+    (b':status', b'500'),
+    (b'accept-charset', b''),
+    (b'accept-encoding', b'gzip, deflate'),
+    (b'accept-language', b''),
+    (b'accept-ranges', b''),
+    (b'accept', b''),
+    (b'access-control-allow-origin', b''),
+    (b'age', b''),
+    (b'allow', b''),
+    (b'authorization', b''),
+    (b'cache-control', b''),
+    (b'content-disposition', b''),
+    (b'content-encoding', b''),
+    (b'content-language', b''),
+    (b'content-length', b''),
+    (b'content-location', b''),
+    (b'content-range', b''),
+    (b'content-type', b''),
+    (b'cookie', b''),
+    (b'date', b''),
+    (b'etag', b''),
+    (b'expect', b''),
+    (b'expires', b''),
+    (b'from', b''),
+    (b'host', b''),
+    (b'if-match', b''),
+    (b'if-modified-since', b''),
+    (b'if-none-match', b''),
+    (b'if-range', b''),
+    (b'if-unmodified-since', b''),
+    (b'last-modified', b''),
+    (b'link', b''),
+    (b'location', b''),
+    (b'max-forwards', b''),
+    (b'proxy-authenticate', b''),
+    (b'proxy-authorization', b''),
+    (b'range', b''),
+    (b'referer', b''),
+    (b'refresh', b''),
+    (b'retry-after', b''),
+    (b'server', b''),
+    (b'set-cookie', b''),
+    (b'strict-transport-security', b''),
+    (b'transfer-encoding', b''),
+    (b'user-agent', b''),
+    (b'vary', b''),
+    (b'via', b''),
+    (b'www-authenticate', b''),
+)
+_static_names = {}
+_static_pairs = {}
+for _index, (_name, _value) in enumerate(STATIC_TABLE, 1):
+    _static_names.setdefault(_name, _index)
+    _static_pairs[(_name, _value)] = _index
+
+# code lengths of the canonical Huffman code of Appendix B, symbols 0-255 and EOS
+HUFFMAN_LENGTHS = (
+    13, 23, 28, 28, 28, 28, 28, 28, 28, 24, 30, 28, 28, 30, 28, 28,
+    28, 28, 28, 28, 28, 28, 30, 28, 28, 28, 28, 28, 28, 28, 28, 28,
+    6, 10, 10, 12, 13, 6, 8, 11, 10, 10, 8, 11, 8, 6, 6, 6,
+    5, 5, 5, 6, 6, 6, 6, 6, 6, 6, 7, 8, 15, 6, 12, 10,
+    13, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7,
+    7, 7, 7, 7, 7, 7, 7, 7, 8, 7, 8, 13, 19, 13, 14, 6,
+    15, 5, 6, 5, 6, 5, 6, 6, 6, 5, 7, 7, 6, 6, 6, 5,
+    6, 7, 6, 5, 5, 6, 7, 7, 7, 7, 7, 15, 11, 14, 13, 28,
+    20, 22, 20, 20, 22, 22, 22, 23, 22, 23, 23, 23, 23, 23, 24, 23,
+    24, 24, 22, 23, 24, 23, 23, 23, 23, 21, 22, 23, 22, 23, 23, 24,
+    22, 21, 20, 22, 22, 23, 23, 21, 23, 22, 22, 24, 21, 22, 23, 23,
+    21, 21, 22, 21, 23, 22, 23, 23, 20, 22, 22, 22, 23, 22, 22, 23,
+    26, 26, 20, 19, 22, 23, 22, 25, 26, 26, 26, 27, 27, 26, 24, 25,
+    19, 21, 26, 27, 27, 26, 27, 24, 21, 21, 26, 26, 28, 27, 27, 27,
+    20, 24, 20, 21, 22, 21, 21, 23, 22, 22, 25, 25, 24, 24, 26, 23,
+    26, 27, 26, 26, 27, 27, 27, 27, 27, 28, 27, 27, 27, 27, 27, 26,
+    30,
+)
+EOS = 256
+
+
+def _huffman_codes():
+    codes = [None] * len(HUFFMAN_LENGTHS)
+    code, previous = -1, 0
+    for symbol in sorted(range(len(HUFFMAN_LENGTHS)), key=lambda s: (HUFFMAN_LENGTHS[s], s)):
+        length = HUFFMAN_LENGTHS[symbol]
+        code = (code + 1) << (length - previous)
+        previous = length
+        codes[symbol] = (code, length)
+    return codes
+
+
+def _huffman_decoder(codes):
+    """
+    Transitions of a decoder consuming 4 bits at a time: for every inner
+    node of the code tree and nibble, ``(next node, decoded bytes, failed)``.
+    """
+    tree = [[None, None]]
+    for symbol, (code, length) in enumerate(codes):
+        node = 0
+        for shift in range(length - 1, 0, -1):
+            bit = (code >> shift) & 1
+            child = tree[node][bit]
+            if child is None:
+                child = tree[node][bit] = len(tree)
+                tree.append([None, None])
+            node = child
+        # leaves are stored as -1 - symbol
+        tree[node][code & 1] = -1 - symbol
+
+    # padding is up to 7 bits of the most significant bits of EOS, all ones
+    accepting = set([0])
+    node = 0
+    for _ in range(7):
+        node = tree[node][1]
+        accepting.add(node)
+
+    table = []
+    for node in range(len(tree)):
+        row = []
+        for nibble in range(16):
+            current, out, failed = node, bytearray(), False
+            for shift in (3, 2, 1, 0):
+                current = tree[current][(nibble >> shift) & 1]
+                if current < 0:
+                    if current == -1 - EOS:
+                        failed = True
+                        break
+                    out.append(-1 - current)
+                    current = 0
+            row.append((current, bytes(out), failed))
+        table.append(row)
+    return table, accepting
+
+
+HUFFMAN_CODES = _huffman_codes()
+_decode_table, _accepting = _huffman_decoder(HUFFMAN_CODES)
+
+
+def huffman_encode(data):
+    bits = nbits = 0
+    for byte in bytearray(data):
+        code, length = HUFFMAN_CODES[byte]
+        bits = (bits << length) | code
+        nbits += length
+    padding = -nbits % 8
+    bits = (bits << padding) | ((1 << padding) - 1)
+    size = (nbits + padding) // 8
+    if not size:
+        return b''
+    return binascii.unhexlify('%0*x' % (size * 2, bits))
+
+
+def huffman_size(data):
+    return (sum(HUFFMAN_LENGTHS[byte] for byte in bytearray(data)) + 7) // 8
+
+
+def huffman_decode(data):
+    table = _decode_table
+    node = 0
+    out = []
+    for byte in bytearray(data):
+        node, decoded, failed = table[node][byte >> 4]
+        if failed:
+            raise HPACKError("EOS in a Huffman coded string")
+        if decoded:
+            out.append(decoded)
+        node, decoded, failed = table[node][byte & 0x0f]
+        if failed:
+            raise HPACKError("EOS in a Huffman coded string")
+        if decoded:
+            out.append(decoded)
+    if node not in _accepting:
+        raise HPACKError("invalid Huffman padding")
+    return b''.join(out)
+
+
+def encode_integer(value, prefix_bits, first=0):
+    """``value`` with an N-bit prefix, ``first`` holding the bits above the prefix."""
+    limit = (1 << prefix_bits) - 1
+    if value < limit:
+        return bytearray([first | value])
+    out = bytearray([first | limit])
+    value -= limit
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+def decode_integer(data, offset, prefix_bits):
+    """Return ``(value, offset after it)`` of the integer at ``data[offset]``."""
+    limit = (1 << prefix_bits) - 1
+    value = data[offset] & limit
+    offset += 1
+    if value < limit:
+        return value, offset
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise HPACKError("truncated integer")
+        byte = data[offset]
+        offset += 1
+        value += (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+        if shift > 28:
+            raise HPACKError("integer too large")
+
+
+def _entry_size(name, value):
+    return 32 + len(name) + len(value)
+
+
+class _DynamicTable(object):
+    def __init__(self, max_size):
+        self.entries = []
+        self.size = 0
+        self.max_size = max_size
+
+    def add(self, name, value):
+        size = _entry_size(name, value)
+        self.entries.insert(0, (name, value))
+        self.size += size
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_size and self.entries:
+            name, value = self.entries.pop()
+            self.size -= _entry_size(name, value)
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.evict()
+
+
+class Decoder(object):
+    """Header block decoder of one connection; ``max_table_size`` is our SETTINGS_HEADER_TABLE_SIZE."""
+
+    def __init__(self, max_table_size=4096, max_header_list_size=65536):
+        self.table = _DynamicTable(max_table_size)
+        self.max_table_size = max_table_size
+        self.max_header_list_size = max_header_list_size
+
+    def _lookup(self, index):
+        if index <= 0:
+            raise HPACKError("header index 0")
+        if index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+        index -= len(STATIC_TABLE) + 1
+        entries = self.table.entries
+        if index >= len(entries):
+            raise HPACKError("header index out of range")
+        return entries[index]
+
+    def _string(self, data, offset):
+        if offset >= len(data):
+            raise HPACKError("truncated string")
+        huffman = data[offset] & 0x80
+        length, offset = decode_integer(data, offset, 7)
+        end = offset + length
+        if end > len(data):
+            raise HPACKError("truncated string")
+        value = bytes(data[offset:end])
+        if huffman:
+            value = huffman_decode(value)
+        return value, end
+
+    def decode(self, block):
+        """Return the ``[(name, value), ...]`` of a complete header block."""
+        data = bytearray(block)
+        headers = []
+        size = 0
+        offset = 0
+        headers_seen = False
+        while offset < len(data):
+            byte = data[offset]
+            if byte & 0x80:
+                name, value = self._lookup(decode_integer(data, offset, 7)[0])
+                offset = decode_integer(data, offset, 7)[1]
+            elif byte & 0xe0 == 0x20:
+                if headers_seen:
+                    raise HPACKError("table size update after a header")
+                max_size, offset = decode_integer(data, offset, 5)
+                if max_size > self.max_table_size:
+                    raise HPACKError("table size update above the limit")
+                self.table.resize(max_size)
+                continue
+            else:
+                if byte & 0x40:
+                    prefix = 6
+                else:
+                    # without indexing (0000) or never indexed (0001)
+                    prefix = 4
+                index, offset = decode_integer(data, offset, prefix)
+                if index:
+                    name = self._lookup(index)[0]
+                else:
+                    name, offset = self._string(data, offset)
+                value, offset = self._string(data, offset)
+                if prefix == 6:
+                    self.table.add(name, value)
+            headers_seen = True
+            size += _entry_size(name, value)
+            if size > self.max_header_list_size:
+                raise HPACKError("header list too large")
+            headers.append((name, value))
+        return headers
+
+
+class Encoder(object):
+    """Header block encoder of one connection."""
+
+    # not worth a table entry, they change with every response
+    never_index = frozenset([b'content-length', b'date', b'etag', b'last-modified', b'expires', b'age',
+                             b'content-range', b'location'])
+    # kept out of every table, including intermediaries'
+    sensitive = frozenset([b'set-cookie', b'authorization', b'cookie'])
+    # larger values are sent as literals
+    max_indexed_size = 512
+
+    def __init__(self, max_table_size=4096):
+        self.table = _DynamicTable(max_table_size)
+        self.pending_size_update = None
+
+    def resize(self, max_size):
+        """Apply the peer's SETTINGS_HEADER_TABLE_SIZE, announced at the start of the next block."""
+        max_size = min(max_size, 4096)
+        if max_size != self.table.max_size:
+            self.table.resize(max_size)
+            self.pending_size_update = max_size
+
+    def _find(self, name, value):
+        index = _static_pairs.get((name, value))
+        if index:
+            return index, True
+        name_index = _static_names.get(name, 0)
+        for position, entry in enumerate(self.table.entries):
+            if entry[0] == name:
+                if entry[1] == value:
+                    return len(STATIC_TABLE) + 1 + position, True
+                if not name_index:
+                    name_index = len(STATIC_TABLE) + 1 + position
+        return name_index, False
+
+    @staticmethod
+    def _string(value):
+        if huffman_size(value) < len(value):
+            value = huffman_encode(value)
+            return encode_integer(len(value), 7, 0x80) + value
+        return encode_integer(len(value), 7) + value
+
+    def encode(self, headers):
+        """Encode ``[(name, value), ...]`` with lower case byte string names."""
+        out = bytearray()
+        if self.pending_size_update is not None:
+            out += encode_integer(self.pending_size_update, 5, 0x20)
+            self.pending_size_update = None
+        for name, value in headers:
+            index, exact = self._find(name, value)
+            if exact:
+                out += encode_integer(index, 7, 0x80)
+                continue
+            if name in self.sensitive:
+                out += encode_integer(index, 4, 0x10)
+            elif name in self.never_index or len(value) > self.max_indexed_size:
+                out += encode_integer(index, 4)
+            else:
+                out += encode_integer(index, 6, 0x40)
+                self.table.add(name, value)
+            if not index:
+                out += self._string(name)
+            out += self._string(value)
+        return bytes(out)
@@ -0,0 +1,1111 @@
+# -*- coding:utf8 -*-
+"""
+HTTP/2 over cleartext TCP (h2c, RFC 7540) for `msocket.wsgi.handlers`.
+
+A connection starts HTTP/2 either with the connection preface ("prior
+knowledge") or by upgrading a bodiless HTTP/1.1 request carrying
+``Upgrade: h2c``, which becomes stream 1. The request handler thread then
+reads the frames of the connection, while every stream is a WSGI call on a
+`msocket.server.WorkerPool` shared by the connections of the server, so
+one connection carries concurrent requests. Writers serialize whole frames
+on the socket and wait for the peer's flow-control windows; the request
+body windows are credited back as the application reads ``wsgi.input``.
+
+Server push and stream priorities are not implemented.
+"""
+from __future__ import absolute_import
+
+import sys
+import time
+import errno
+import base64
+import socket
+import struct
+import urllib
+import logging
+import threading
+import collections
+from wsgiref.handlers import SimpleHandler as _SimpleHandler, format_date_time
+
+from ..server import WorkerPool, make_poller, request_context
+from .handlers import SimpleHandler, RequestEntityTooLarge
+from .hpack import Decoder, Encoder, HPACKError
+from .timing import RequestTiming
+
+__author__ = 'fujie'
+
+logger = logging.getLogger("msocket.server.http2")
+
+PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+# frame types
+DATA = 0x0
+HEADERS = 0x1
+PRIORITY = 0x2
+RST_STREAM = 0x3
+SETTINGS = 0x4
+PUSH_PROMISE = 0x5
+PING = 0x6
+GOAWAY = 0x7
+WINDOW_UPDATE = 0x8
+CONTINUATION = 0x9
+
+# frame flags
+FLAG_END_STREAM = 0x1
+FLAG_ACK = 0x1
+FLAG_END_HEADERS = 0x4
+FLAG_PADDED = 0x8
+FLAG_PRIORITY = 0x20
+
+# error codes
+NO_ERROR = 0x0
+PROTOCOL_ERROR = 0x1
+INTERNAL_ERROR = 0x2
+FLOW_CONTROL_ERROR = 0x3
+STREAM_CLOSED = 0x5
+FRAME_SIZE_ERROR = 0x6
+REFUSED_STREAM = 0x7
+CANCEL = 0x8
+COMPRESSION_ERROR = 0x9
+ENHANCE_YOUR_CALM = 0xb
+
+# settings
+SETTINGS_HEADER_TABLE_SIZE = 0x1
+SETTINGS_ENABLE_PUSH = 0x2
+SETTINGS_MAX_CONCURRENT_STREAMS = 0x3
+SETTINGS_INITIAL_WINDOW_SIZE = 0x4
+SETTINGS_MAX_FRAME_SIZE = 0x5
+SETTINGS_MAX_HEADER_LIST_SIZE = 0x6
+
+DEFAULT_WINDOW_SIZE = 65535
+DEFAULT_MAX_FRAME_SIZE = 16384
+MAX_WINDOW_SIZE = 2 ** 31 - 1
+
+# 24 bit length, type, flags, stream id
+_frame_header = struct.Struct('!BHBBL')
+_setting = struct.Struct('!HL')
+_uint32 = struct.Struct('!L')
+_goaway = struct.Struct('!LL')
+
+# not allowed in HTTP/2 messages
+CONNECTION_HEADERS = frozenset([b'connection', b'keep-alive', b'proxy-connection', b'transfer-encoding',
+                                b'upgrade'])
+PSEUDO_HEADERS = frozenset([b':method', b':scheme', b':path', b':authority'])
+
+
+class ConnectionError(Exception):
+    """Connection error, ends the connection with GOAWAY."""
+
+    def __init__(self, code, message=''):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class StreamError(Exception):
+    """Stream error, resets the stream."""
+
+    def __init__(self, code, message=''):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class StreamClosed(IOError):
+    """Raised to writers of a stream reset by the peer or of a closed connection."""
+
+
+def frame(frame_type, flags, stream_id, payload=b''):
+    length = len(payload)
+    return _frame_header.pack(length >> 16, length & 0xffff, frame_type, flags, stream_id) + payload
+
+
+def take_buffered(rfile):
+    """Bytes ``rfile`` read ahead from the socket, removed from it."""
+    rbuf = getattr(rfile, '_rbuf', None)
+    if rbuf is None:
+        return b''
+    # socket._fileobject keeps only unread data in _rbuf
+    size = len(rbuf.getvalue())
+    return rfile.read(size) if size else b''
+
+
+def decode_settings(payload):
+    if len(payload) % _setting.size:
+        raise ConnectionError(FRAME_SIZE_ERROR, "SETTINGS of %d bytes" % len(payload))
+    return [_setting.unpack_from(payload, offset) for offset in range(0, len(payload), _setting.size)]
+
+
+class RequestBody(object):
+    """
+    ``wsgi.input`` of a stream, fed by the connection's reader thread.
+    Reads block until the DATA frames arrive, resetting the stream after
+    ``http2_stream_timeout`` seconds without any, and credit the
+    flow-control windows back as they consume them.
+    """
+
+    def __init__(self, connection, stream, max_size=None):
+        self.connection = connection
+        self.stream = stream
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.condition = threading.Condition(threading.Lock())
+        self.finished = False
+        self.error = None
+        self.bytes_read = 0
+
+    def feed(self, data):
+        with self.condition:
+            self.buffer += data
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        """End of the body; ``error`` fails reads once the buffer is drained."""
+        with self.condition:
+            self.finished = True
+            if error is not None and self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+    def discard(self):
+        """Drop the unread bytes, returns their number."""
+        with self.condition:
+            size = len(self.buffer)
+            del self.buffer[:]
+            return size
+
+    def _take(self, size, line=False):
+        deadline = time.time() + self.connection.stream_timeout
+        with self.condition:
+            while not self.buffer and not self.finished:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            if self.buffer:
+                if line:
+                    end = self.buffer.find(b'\n', 0, size) + 1 or size
+                else:
+                    end = size
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+            elif not self.finished:
+                data = None
+            elif self.error is not None:
+                raise IOError(self.error)
+            else:
+                return b''
+        if data is None:
+            # the peer stopped sending the body
+            self.connection.reset_stream(self.stream.id, CANCEL)
+            raise socket.timeout("stream %d: request body timed out" % self.stream.id)
+        if self.max_size is not None and self.bytes_read + len(data) > self.max_size:
+            raise RequestEntityTooLarge("request body exceeds %d bytes" % self.max_size)
+        self.bytes_read += len(data)
+        self.connection.consumed(self.stream, len(data))
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self._take(64 * 1024), b""))
+        return self._take(size) if size else b''
+
+    def readline(self, size=-1):
+        buf = []
+        while size is None or size < 0 or size > 0:
+            data = self._take(64 * 1024 if size is None or size < 0 else size, True)
+            if not data:
+                break
+            buf.append(data)
+            if size is not None and size > 0:
+                size -= len(data)
+            if data.endswith(b"\n"):
+                break
+        return b"".join(buf)
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+class Stream(object):
+    def __init__(self, connection, stream_id, send_window, recv_window, max_body_size=None):
+        self.id = stream_id
+        self.send_window = send_window
+        self.recv_window = recv_window
+        # bytes read by the application not credited to the peer yet
+        self.unacked = 0
+        self.input = RequestBody(connection, self, max_body_size)
+        self.remote_closed = False
+        self.local_closed = False
+        self.reset = False
+
+
+# noinspection PyClassHasNoInit
+class StreamHandler(SimpleHandler):
+    """Runs the WSGI application of one stream, writing HEADERS and DATA frames instead of HTTP/1.1."""
+    http_version = '2'
+    stream = None
+    connection = None
+    # the application failed after sending the headers
+    failed = False
+
+    def send_preamble(self):
+        pass
+
+    def send_headers(self):
+        self.cleanup_headers()
+        self.headers_sent = True
+        headers = self.headers
+        if 'Date' not in headers:
+            headers['Date'] = format_date_time(time.time())
+        if self.origin_server and self.server_software and 'Server' not in headers:
+            headers['Server'] = self.server_software
+        bodiless = self.environ['REQUEST_METHOD'] == 'HEAD' or self.status[:3] in ('204', '304') or \
+            headers.get('Content-Length') == '0'
+        self.connection.send_headers(self.stream, self.status, headers.items(), bodiless)
+
+    def _write(self, data):
+        # nothing follows the END_STREAM of bodiless responses (HEAD, 204, 304) or of a complete body
+        if not self.stream.local_closed:
+            # END_STREAM goes with the last frame of a body of known length
+            length = self.headers.get('Content-Length')
+            self.connection.send_data(self.stream, data, length is not None and self.bytes_sent >= int(length))
+
+    def _flush(self):
+        pass
+
+    def sendfile(self):
+        return False
+
+    def finish_chunked_response(self):
+        # DATA frames delimit the body
+        self.finish_normal_response()
+
+    def finish_normal_response(self):
+        # unlike wsgiref not closed when the body fails, that response is reset instead of ended
+        for data in self.result:
+            self.write(data)
+        self.finish_content()
+        self.close()
+
+    def handle_error(self):
+        if isinstance(sys.exc_info()[1], (StreamClosed, socket.error)):
+            return
+        if self.headers_sent:
+            self.failed = True
+        SimpleHandler.handle_error(self)
+
+    def close(self):
+        try:
+            stream = self.stream
+            if self.status and not self.failed and not stream.local_closed and not stream.reset:
+                try:
+                    self.connection.end_stream(stream)
+                except (StreamClosed, socket.error):
+                    pass
+            timing = self.environ.get('msocket.timing') if self.environ else None
+            if timing is not None:
+                self.mark_first_write()
+                timing.finished = time.time()
+            if self.status:
+                self.connection.log_request(self.environ, self.status.split(' ', 1)[0], self.bytes_sent)
+        finally:
+            # not SimpleHandler.close, which logs through the HTTP/1.1 request handler
+            _SimpleHandler.close(self)
+
+
+class H2Connection(object):
+    """
+    HTTP/2 connection served by a `msocket.wsgi.handlers.WSGIKeepAlivedMixIn`
+    request handler, whose class attributes ``http2_*`` configure it.
+    """
+    stream_handler = StreamHandler
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.server = handler.server
+        self.sock = handler.connection
+        self.client_address = handler.client_address
+        self.max_concurrent_streams = handler.http2_max_concurrent_streams
+        self.initial_window_size = handler.http2_initial_window_size
+        self.connection_window_size = handler.http2_connection_window_size
+        self.max_frame_size = handler.http2_max_frame_size
+        self.max_header_list_size = handler.http2_max_header_list_size
+        self.keepalive_timeout = handler.keepalive_timeout
+        self.stream_timeout = handler.http2_stream_timeout
+        self.max_running_streams = handler.http2_max_running_streams
+        self.pool = get_pool(self.server, handler.http2_workers)
+        self.pool_saturated = getattr(self.server, 'pool_saturated', None)
+
+        self.decoder = Decoder(max_header_list_size=self.max_header_list_size)
+        self.encoder = Encoder()
+        self.buffer = bytearray()
+        self.poller = None
+        # frames of a stream must not interleave, and encoded header blocks
+        # must reach the peer in the order of the encoder's table
+        self.write_lock = threading.Lock()
+        # streams, windows and counters
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.streams = {}
+        # streams whose application has not finished
+        self.active = 0
+        # streams on the pool, bounded by max_running_streams, and those waiting for their turn
+        self.running = 0
+        self.waiting = collections.deque()
+        self.last_stream_id = 0
+        self.closed = False
+        self.goaway_received = False
+        self.goaway_sent = False
+
+        self.peer_initial_window_size = DEFAULT_WINDOW_SIZE
+        self.peer_max_frame_size = DEFAULT_MAX_FRAME_SIZE
+        self.send_window = DEFAULT_WINDOW_SIZE
+        self.recv_window = self.connection_window_size
+        self.recv_unacked = 0
+        self._address_string = None
+        try:
+            # frames are written whole, Nagle would only delay the last one of a window
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            pass
+        # reads wait on the poller, this bounds a write to a peer that stopped reading
+        self.sock.settimeout(self.stream_timeout)
+
+    # writing
+
+    def _send(self, data):
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self.closed = True
+            raise
+
+    def send_frame(self, frame_type, flags, stream_id, payload=b''):
+        with self.write_lock:
+            self._send(frame(frame_type, flags, stream_id, payload))
+
+    def send_settings(self):
+        settings = [
+            (SETTINGS_MAX_CONCURRENT_STREAMS, self.max_concurrent_streams),
+            (SETTINGS_INITIAL_WINDOW_SIZE, self.initial_window_size),
+            (SETTINGS_MAX_FRAME_SIZE, self.max_frame_size),
+            (SETTINGS_MAX_HEADER_LIST_SIZE, self.max_header_list_size),
+            (SETTINGS_ENABLE_PUSH, 0),
+        ]
+        data = frame(SETTINGS, 0, 0, b''.join(_setting.pack(*setting) for setting in settings))
+        increment = self.connection_window_size - DEFAULT_WINDOW_SIZE
+        if increment > 0:
+            data += frame(WINDOW_UPDATE, 0, 0, _uint32.pack(increment))
+        with self.write_lock:
+            self._send(data)
+
+    def goaway(self, code=NO_ERROR, message=''):
+        if self.goaway_sent or self.closed:
+            return
+        self.goaway_sent = True
+        try:
+            self.send_frame(GOAWAY, 0, 0, _goaway.pack(self.last_stream_id, code) + message)
+        except socket.error:
+            pass
+
+    def send_headers(self, stream, status, headers, end_stream=False):
+        fields = [(b':status', status[:3])]
+        for name, value in headers:
+            name = name.lower()
+            if name not in CONNECTION_HEADERS:
+                fields.append((name, str(value)))
+        with self.write_lock:
+            if stream.reset or self.closed:
+                raise StreamClosed("stream %d closed" % stream.id)
+            block = self.encoder.encode(fields)
+            size = self.peer_max_frame_size
+            flags = FLAG_END_STREAM if end_stream else 0
+            if len(block) <= size:
+                data = frame(HEADERS, flags | FLAG_END_HEADERS, stream.id, block)
+            else:
+                chunks = [block[offset:offset + size] for offset in range(0, len(block), size)]
+                data = frame(HEADERS, flags, stream.id, chunks[0])
+                for chunk in chunks[1:-1]:
+                    data += frame(CONTINUATION, 0, stream.id, chunk)
+                data += frame(CONTINUATION, FLAG_END_HEADERS, stream.id, chunks[-1])
+            self._send(data)
+        if end_stream:
+            self.local_close(stream)
+
+    def send_data(self, stream, data, end_stream=False):
+        """
+        Send ``data`` as DATA frames, waiting for the flow-control windows;
+        the stream is reset when they stay closed for ``stream_timeout`` seconds.
+        """
+        offset = 0
+        total = len(data)
+        while True:
+            deadline = None
+            with self.condition:
+                while True:
+                    if stream.reset or stream.local_closed or self.closed:
+                        raise StreamClosed("stream %d closed" % stream.id)
+                    # a window can be negative after SETTINGS lowered the initial size
+                    n = max(0, min(total - offset, stream.send_window, self.send_window, self.peer_max_frame_size))
+                    if n > 0 or offset == total:
+                        break
+                    if deadline is None:
+                        deadline = time.time() + self.stream_timeout
+                    elif time.time() >= deadline:
+                        break
+                    self.condition.wait(deadline - time.time())
+                stream.send_window -= n
+                self.send_window -= n
+            if not n and offset < total:
+                # the peer does not read, do not hold a pool thread forever
+                self.reset_stream(stream.id, CANCEL)
+                raise StreamClosed("stream %d: flow-control window timed out" % stream.id)
+            offset += n
+            last = end_stream and offset == total
+            if n or last:
+                with self.write_lock:
+                    if stream.reset:
+                        raise StreamClosed("stream %d closed" % stream.id)
+                    self._send(frame(DATA, FLAG_END_STREAM if last else 0, stream.id, data[offset - n:offset]))
+            if offset == total:
+                break
+        if end_stream:
+            self.local_close(stream)
+
+    def end_stream(self, stream):
+        self.send_data(stream, b'', True)
+
+    def reset_stream(self, stream_id, code):
+        with self.condition:
+            stream = self.streams.pop(stream_id, None)
+            if stream is not None:
+                stream.reset = True
+                self.condition.notify_all()
+        if stream is not None:
+            self.recv_discarded(stream)
+            stream.input.finish("stream reset")
+        try:
+            self.send_frame(RST_STREAM, 0, stream_id, _uint32.pack(code))
+        except socket.error:
+            pass
+
+    def local_close(self, stream):
+        with self.condition:
+            stream.local_closed = True
+            if stream.remote_closed:
+                self.streams.pop(stream.id, None)
+
+    def remote_close(self, stream):
+        with self.condition:
+            stream.remote_closed = True
+            if stream.local_closed:
+                self.streams.pop(stream.id, None)
+        stream.input.finish()
+
+    # flow control of the request bodies
+
+    def consumed(self, stream, size):
+        """Credit ``size`` bytes read (or dropped) from ``stream`` back to the peer."""
+        updates = []
+        half = self.initial_window_size // 2
+        with self.lock:
+            self.recv_unacked += size
+            if self.recv_unacked >= self.connection_window_size // 2:
+                updates.append((0, self.recv_unacked))
+                self.recv_window += self.recv_unacked
+                self.recv_unacked = 0
+            if stream is not None and not stream.remote_closed and not stream.reset:
+                stream.unacked += size
+                if stream.unacked >= half:
+                    updates.append((stream.id, stream.unacked))
+                    stream.recv_window += stream.unacked
+                    stream.unacked = 0
+        if updates and not self.closed:
+            data = b''.join(frame(WINDOW_UPDATE, 0, stream_id, _uint32.pack(increment))
+                            for stream_id, increment in updates)
+            try:
+                with self.write_lock:
+                    self._send(data)
+            except socket.error:
+                pass
+
+    def recv_discarded(self, stream):
+        """Credit the unread body of a finished or reset stream to the connection window."""
+        size = stream.input.discard()
+        if size:
+            self.consumed(None, size)
+
+    # reading
+
+    def wait_readable(self):
+        """
+        Return False once the connection is idle for ``keepalive_timeout``
+        (or at all while the requests of a pooled server wait for a thread),
+        drained after a GOAWAY, or failed to write. Streams waiting for the
+        peer time out on their own (``stream_timeout``).
+        """
+        idle_since = time.time()
+        while True:
+            if self.closed:
+                return False
+            if list(self.poller.poll(poll_interval=1.0)):
+                return True
+            with self.lock:
+                active = self.active
+            if active:
+                idle_since = time.time()
+            elif self.goaway_received:
+                return False
+            elif self.pool_saturated is not None and self.pool_saturated():
+                # the reader holds a thread of a pooled server, give it to the waiting requests
+                return False
+            elif self.keepalive_timeout and time.time() - idle_since >= self.keepalive_timeout:
+                return False
+
+    def read_frame(self):
+        """Return ``(type, flags, stream id, payload)``, or None at the end of the connection."""
+        buf = self.buffer
+        while True:
+            if len(buf) >= _frame_header.size:
+                high, low, frame_type, flags, stream_id = _frame_header.unpack_from(buf)
+                length = high << 16 | low
+                if length > self.max_frame_size:
+                    raise ConnectionError(FRAME_SIZE_ERROR, "frame of %d bytes" % length)
+                end = _frame_header.size + length
+                if len(buf) >= end:
+                    payload = bytes(buf[_frame_header.size:end])
+                    del buf[:end]
+                    return frame_type, flags, stream_id & 0x7fffffff, payload
+            if not self.wait_readable():
+                return None
+            data = self.sock.recv(256 * 1024)
+            if not data:
+                return None
+            buf += data
+
+    def serve(self, data=b'', preface=PREFACE, upgrade_environ=None, upgrade_settings=None):
+        """
+        Serve the connection until it is closed. ``data`` was already read
+        from the socket, ``preface`` is the part of the client preface not
+        consumed yet. An upgraded request is passed as ``upgrade_environ``
+        with the decoded HTTP2-Settings.
+        """
+        self.buffer += data
+        self.poller = make_poller()
+        self.poller.register(self.sock.fileno())
+        try:
+            self.send_settings()
+            if upgrade_environ is not None:
+                self.apply_settings(upgrade_settings or ())
+                self.last_stream_id = 1
+                stream = self.open_stream(1, upgrade_environ)
+                self.remote_close(stream)
+                self.start_stream(stream, upgrade_environ)
+
+            while len(self.buffer) < len(preface):
+                if not self.wait_readable():
+                    return
+                received = self.sock.recv(4096)
+                if not received:
+                    return
+                self.buffer += received
+            if bytes(self.buffer[:len(preface)]) != preface:
+                raise ConnectionError(PROTOCOL_ERROR, "invalid connection preface")
+            del self.buffer[:len(preface)]
+
+            frame_type, flags, stream_id, payload = self.read_frame() or (None, 0, 0, b'')
+            if frame_type is None:
+                return
+            if frame_type != SETTINGS or flags & FLAG_ACK:
+                raise ConnectionError(PROTOCOL_ERROR, "connection preface without SETTINGS")
+            self.on_settings(flags, stream_id, payload)
+
+            while True:
+                f = self.read_frame()
+                if f is None:
+                    break
+                frame_type, flags, stream_id, payload = f
+                method = self.frame_handlers.get(frame_type)
+                if method is not None:
+                    getattr(self, method)(flags, stream_id, payload)
+            self.goaway()
+        except ConnectionError as e:
+            logger.info("%s: HTTP/2 connection error %d: %s", self.client_address[0], e.code, e)
+            self.goaway(e.code, str(e))
+        except socket.error as e:
+            self.closed = True
+            if e.args and e.args[0] in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED):
+                logger.debug("%s: HTTP/2 connection closed by the client: %r", self.client_address[0], e)
+            else:
+                self.handler.log_error("HTTP/2 connection error: %r", e)
+        finally:
+            self.poller.release()
+            self.shutdown()
+
+    def shutdown(self):
+        """Wait for the applications of the open streams, failing their reads and writes."""
+        with self.condition:
+            self.closed = True
+            streams = list(self.streams.values())
+            self.condition.notify_all()
+        for stream in streams:
+            stream.input.finish("connection closed")
+        with self.condition:
+            while self.active:
+                self.condition.wait()
+
+    frame_handlers = {
+        DATA: 'on_data',
+        HEADERS: 'on_headers',
+        PRIORITY: 'on_priority',
+        RST_STREAM: 'on_rst_stream',
+        SETTINGS: 'on_settings',
+        PUSH_PROMISE: 'on_push_promise',
+        PING: 'on_ping',
+        GOAWAY: 'on_goaway',
+        WINDOW_UPDATE: 'on_window_update',
+        CONTINUATION: 'on_continuation',
+    }
+
+    @staticmethod
+    def strip_padding(flags, payload):
+        if not flags & FLAG_PADDED:
+            return payload
+        if not payload or ord(payload[0]) >= len(payload):
+            raise ConnectionError(PROTOCOL_ERROR, "invalid padding")
+        return payload[1:len(payload) - ord(payload[0])]
+
+    def on_data(self, flags, stream_id, payload):
+        if stream_id == 0:
+            raise ConnectionError(PROTOCOL_ERROR, "DATA on stream 0")
+        if stream_id > self.last_stream_id:
+            raise ConnectionError(PROTOCOL_ERROR, "DATA on idle stream %d" % stream_id)
+        size = len(payload)
+        data = self.strip_padding(flags, payload)
+        with self.lock:
+            self.recv_window -= size
+            if self.recv_window < 0:
+                raise ConnectionError(FLOW_CONTROL_ERROR, "connection window exceeded")
+            stream = self.streams.get(stream_id)
+            if stream is not None and not stream.remote_closed:
+                stream.recv_window -= size
+                overflow = stream.recv_window < 0
+        if stream is None or stream.remote_closed:
+            # reset or completed streams, the data only counts against the connection
+            self.consumed(None, size)
+            if stream is not None:
+                self.reset_stream(stream_id, STREAM_CLOSED)
+            return
+        if overflow:
+            self.consumed(None, size)
+            self.reset_stream(stream_id, FLOW_CONTROL_ERROR)
+            return
+        if size != len(data):
+            self.consumed(stream, size - len(data))
+        if data:
+            stream.input.feed(data)
+        if flags & FLAG_END_STREAM:
+            self.remote_close(stream)
+
+    def read_header_block(self, flags, stream_id, block):
+        if flags & FLAG_END_HEADERS:
+            return block
+        blocks = [block]
+        size = len(block)
+        while True:
+            f = self.read_frame()
+            if f is None:
+                raise ConnectionError(PROTOCOL_ERROR, "connection closed in a header block")
+            frame_type, flags, continued_id, payload = f
+            if frame_type != CONTINUATION or continued_id != stream_id:
+                raise ConnectionError(PROTOCOL_ERROR, "header block interrupted")
+            size += len(payload)
+            if size > self.max_header_list_size * 2:
+                raise ConnectionError(ENHANCE_YOUR_CALM, "header block too large")
+            blocks.append(payload)
+            if flags & FLAG_END_HEADERS:
+                return b''.join(blocks)
+
+    def on_headers(self, flags, stream_id, payload):
+        if stream_id == 0 or not stream_id % 2:
+            raise ConnectionError(PROTOCOL_ERROR, "HEADERS on stream %d" % stream_id)
+        payload = self.strip_padding(flags, payload)
+        if flags & FLAG_PRIORITY:
+            if len(payload) < 5:
+                raise ConnectionError(FRAME_SIZE_ERROR, "HEADERS priority truncated")
+            payload = payload[5:]
+        block = self.read_header_block(flags, stream_id, payload)
+        try:
+            headers = self.decoder.decode(block)
+        except HPACKError as e:
+            raise ConnectionError(COMPRESSION_ERROR, str(e))
+
+        if stream_id <= self.last_stream_id:
+            stream = self.streams.get(stream_id)
+            if stream is None or stream.remote_closed:
+                raise ConnectionError(STREAM_CLOSED, "HEADERS on closed stream %d" % stream_id)
+            if not flags & FLAG_END_STREAM:
+                raise ConnectionError(PROTOCOL_ERROR, "trailers without END_STREAM")
+            # trailers are not passed to the application
+            self.remote_close(stream)
+            return
+
+        self.last_stream_id = stream_id
+        if self.goaway_sent:
+            return
+        with self.lock:
+            # streams reset by the peer leave applications running, those are bounded too
+            refused = len(self.streams) >= self.max_concurrent_streams or \
+                self.active >= 2 * self.max_concurrent_streams
+        if refused:
+            self.send_frame(RST_STREAM, 0, stream_id, _uint32.pack(REFUSED_STREAM))
+            return
+        try:
+            environ = self.make_environ(headers)
+        except StreamError as e:
+            logger.info("%s: HTTP/2 stream %d error: %s", self.client_address[0], stream_id, e)
+            self.send_frame(RST_STREAM, 0, stream_id, _uint32.pack(e.code))
+            return
+        stream = self.open_stream(stream_id, environ)
+        if flags & FLAG_END_STREAM:
+            self.remote_close(stream)
+        self.start_stream(stream, environ)
+
+    def on_priority(self, flags, stream_id, payload):
+        if stream_id == 0:
+            raise ConnectionError(PROTOCOL_ERROR, "PRIORITY on stream 0")
+        if len(payload) != 5:
+            raise ConnectionError(FRAME_SIZE_ERROR, "PRIORITY of %d bytes" % len(payload))
+
+    def on_rst_stream(self, flags, stream_id, payload):
+        if stream_id == 0 or stream_id > self.last_stream_id:
+            raise ConnectionError(PROTOCOL_ERROR, "RST_STREAM on stream %d" % stream_id)
+        if len(payload) != 4:
+            raise ConnectionError(FRAME_SIZE_ERROR, "RST_STREAM of %d bytes" % len(payload))
+        with self.condition:
+            stream = self.streams.pop(stream_id, None)
+            if stream is not None:
+                stream.reset = True
+                self.condition.notify_all()
+        if stream is not None:
+            self.recv_discarded(stream)
+            stream.input.finish("stream reset by peer")
+
+    def apply_settings(self, settings):
+        for identifier, value in settings:
+            if identifier == SETTINGS_HEADER_TABLE_SIZE:
+                with self.write_lock:
+                    self.encoder.resize(value)
+            elif identifier == SETTINGS_ENABLE_PUSH:
+                if value > 1:
+                    raise ConnectionError(PROTOCOL_ERROR, "invalid SETTINGS_ENABLE_PUSH")
+            elif identifier == SETTINGS_INITIAL_WINDOW_SIZE:
+                if value > MAX_WINDOW_SIZE:
+                    raise ConnectionError(FLOW_CONTROL_ERROR, "invalid SETTINGS_INITIAL_WINDOW_SIZE")
+                with self.condition:
+                    delta = value - self.peer_initial_window_size
+                    self.peer_initial_window_size = value
+                    for stream in self.streams.values():
+                        stream.send_window += delta
+                        if stream.send_window > MAX_WINDOW_SIZE:
+                            raise ConnectionError(FLOW_CONTROL_ERROR, "stream window overflow")
+                    self.condition.notify_all()
+            elif identifier == SETTINGS_MAX_FRAME_SIZE:
+                if not DEFAULT_MAX_FRAME_SIZE <= value <= 2 ** 24 - 1:
+                    raise ConnectionError(PROTOCOL_ERROR, "invalid SETTINGS_MAX_FRAME_SIZE")
+                self.peer_max_frame_size = value
+
+    def on_settings(self, flags, stream_id, payload):
+        if stream_id != 0:
+            raise ConnectionError(PROTOCOL_ERROR, "SETTINGS on stream %d" % stream_id)
+        if flags & FLAG_ACK:
+            if payload:
+                raise ConnectionError(FRAME_SIZE_ERROR, "SETTINGS ACK with payload")
+            return
+        self.apply_settings(decode_settings(payload))
+        self.send_frame(SETTINGS, FLAG_ACK, 0)
+
+    def on_push_promise(self, flags, stream_id, payload):
+        raise ConnectionError(PROTOCOL_ERROR, "PUSH_PROMISE from a client")
+
+    def on_ping(self, flags, stream_id, payload):
+        if stream_id != 0:
+            raise ConnectionError(PROTOCOL_ERROR, "PING on stream %d" % stream_id)
+        if len(payload) != 8:
+            raise ConnectionError(FRAME_SIZE_ERROR, "PING of %d bytes" % len(payload))
+        if not flags & FLAG_ACK:
+            self.send_frame(PING, FLAG_ACK, 0, payload)
+
+    def on_goaway(self, flags, stream_id, payload):
+        if stream_id != 0:
+            raise ConnectionError(PROTOCOL_ERROR, "GOAWAY on stream %d" % stream_id)
+        self.goaway_received = True
+
+    def on_window_update(self, flags, stream_id, payload):
+        if len(payload) != 4:
+            raise ConnectionError(FRAME_SIZE_ERROR, "WINDOW_UPDATE of %d bytes" % len(payload))
+        increment = _uint32.unpack(payload)[0] & 0x7fffffff
+        if stream_id == 0:
+            if not increment:
+                raise ConnectionError(PROTOCOL_ERROR, "WINDOW_UPDATE of 0")
+            with self.condition:
+                self.send_window += increment
+                if self.send_window > MAX_WINDOW_SIZE:
+                    raise ConnectionError(FLOW_CONTROL_ERROR, "connection window overflow")
+                self.condition.notify_all()
+            return
+        with self.condition:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                return
+            if increment:
+                stream.send_window += increment
+                self.condition.notify_all()
+            code = None
+            if not increment:
+                code = PROTOCOL_ERROR
+            elif stream.send_window > MAX_WINDOW_SIZE:
+                code = FLOW_CONTROL_ERROR
+        if code is not None:
+            self.reset_stream(stream_id, code)
+
+    def on_continuation(self, flags, stream_id, payload):
+        raise ConnectionError(PROTOCOL_ERROR, "CONTINUATION without HEADERS")
+
+    # streams
+
+    def address_string(self):
+        if self._address_string is None:
+            self._address_string = self.handler.address_string()
+        return self._address_string
+
+    def make_environ(self, headers):
+        """The WSGI environ of a request, like `wsgiref.simple_server.WSGIRequestHandler.get_environ`."""
+        pseudo = {}
+        env = self.server.base_environ.copy()
+        cookies = []
+        regular = False
+        for name, value in headers:
+            if name.startswith(b':'):
+                # pseudo-headers precede the regular ones
+                if name not in PSEUDO_HEADERS or name in pseudo or regular:
+                    raise StreamError(PROTOCOL_ERROR, "invalid pseudo-header %s" % name)
+                pseudo[name] = value
+                continue
+            regular = True
+            if name in CONNECTION_HEADERS or name != name.lower() or (name == b'te' and value != b'trailers'):
+                raise StreamError(PROTOCOL_ERROR, "invalid header %s" % name)
+            if name == b'cookie':
+                cookies.append(value)
+                continue
+            key = name.replace('-', '_').upper()
+            if key == 'CONTENT_TYPE' or key == 'CONTENT_LENGTH':
+                env[key] = value
+                continue
+            key = 'HTTP_' + key
+            if key in env:
+                env[key] += ',' + value
+            else:
+                env[key] = value
+
+        method = pseudo.get(b':method')
+        path = pseudo.get(b':path')
+        if not method or (method != b'CONNECT' and (not path or b':scheme' not in pseudo)):
+            raise StreamError(PROTOCOL_ERROR, "missing pseudo-header")
+        if cookies:
+            env['HTTP_COOKIE'] = '; '.join(cookies)
+        if b':authority' in pseudo and 'HTTP_HOST' not in env:
+            env['HTTP_HOST'] = pseudo[b':authority']
+
+        env['SERVER_PROTOCOL'] = 'HTTP/2'
+        env['REQUEST_METHOD'] = method
+        path = path or b''
+        if '?' in path:
+            path, query = path.split('?', 1)
+        else:
+            query = ''
+        env['PATH_INFO'] = urllib.unquote(path)
+        env['QUERY_STRING'] = query
+        env['msocket.http2.scheme'] = pseudo.get(b':scheme')
+        self.add_connection_environ(env)
+        return env
+
+    def add_connection_environ(self, env):
+        host = self.address_string()
+        if host != self.client_address[0]:
+            env['REMOTE_HOST'] = host
+        env['REMOTE_ADDR'] = self.client_address[0]
+        env['REMOTE_PORT'] = self.client_address[1]
+
+    def open_stream(self, stream_id, environ):
+        stream = Stream(self, stream_id, self.peer_initial_window_size, self.initial_window_size,
+                        self.handler.get_request_body_limit(environ['PATH_INFO']))
+        with self.condition:
+            self.streams[stream_id] = stream
+            self.active += 1
+        return stream
+
+    def start_stream(self, stream, environ):
+        timing = RequestTiming(None, time.time())
+        timing.first_byte = timing.headers_parsed = timing.started
+        environ['msocket.timing'] = timing
+        environ['msocket.http2.stream_id'] = stream.id
+        environ['wsgi.input_terminated'] = True
+        with self.lock:
+            # the pool is shared by every connection, one of them cannot take it all
+            queued = self.running >= self.max_running_streams
+            if queued:
+                self.waiting.append((stream, environ))
+            else:
+                self.running += 1
+        if queued:
+            return
+        try:
+            self.pool.submit(self.run_stream, stream, environ)
+        except Exception:
+            with self.lock:
+                self.running -= 1
+            self.finish_stream(stream)
+            raise
+
+    def run_stream(self, stream, environ):
+        try:
+            if not stream.reset and not self.closed:
+                self.call_application(stream, environ)
+        finally:
+            self.finish_stream(stream)
+            with self.lock:
+                if self.waiting:
+                    stream, environ = self.waiting.popleft()
+                else:
+                    self.running -= 1
+                    stream = None
+            if stream is not None:
+                # the next stream of this connection goes behind those of the others
+                self.pool.submit(self.run_stream, stream, environ)
+
+    def call_application(self, stream, environ):
+        request_context.reactor = getattr(self.server, 'get_reactor', lambda: None)()
+        request_context.server = self.server
+        request_context.socket = self.handler.request
+        handler = self.stream_handler(stream.input, None, self.handler.get_stderr(), environ)
+        handler.request_handler = self.handler
+        handler.connection = self
+        handler.stream = stream
+        timing = environ['msocket.timing']
+        app = self.server.get_app()
+
+        def application(environ, start_response):
+            timing.app_called = time.time()
+            return app(environ, start_response)
+
+        try:
+            handler.run(application)
+            if handler.environ is not None:
+                # not closed by run after a failure
+                handler.close()
+        except (StreamClosed, socket.error):
+            # reset by the peer or connection lost while sending an error response
+            pass
+
+    def finish_stream(self, stream):
+        if not stream.reset and not self.closed:
+            if not stream.local_closed:
+                # the application failed after sending the headers
+                self.reset_stream(stream.id, INTERNAL_ERROR)
+            elif not stream.remote_closed:
+                # the response does not depend on the rest of the body
+                self.reset_stream(stream.id, NO_ERROR)
+        self.recv_discarded(stream)
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def log_request(self, environ, code, size):
+        handler = self.handler
+        requestline = '%s %s HTTP/2' % (environ['REQUEST_METHOD'], environ.get('PATH_INFO', ''))
+        if environ.get('QUERY_STRING'):
+            requestline += '?' + environ['QUERY_STRING']
+        timing = environ.get('msocket.timing')
+        if timing is not None:
+            stats = getattr(self.server, 'timing_stats', None)
+            if stats is not None and timing.finished is not None:
+                stats.record(timing)
+            if handler.log_timing:
+                handler.log_message('"%s" %s %s %s', requestline, code, size, timing)
+                return
+        handler.log_message('"%s" %s %s', requestline, code, size)
+
+
+_pool_lock = threading.Lock()
+
+
+def get_pool(server, size):
+    """The `WorkerPool` running the streams of every HTTP/2 connection of ``server``."""
+    pool = getattr(server, 'http2_pool', None)
+    if pool is None:
+        with _pool_lock:
+            pool = getattr(server, 'http2_pool', None)
+            if pool is None:
+                pool = server.http2_pool = WorkerPool(size, name='http2')
+    return pool
+
+
+def is_upgrade(handler):
+    """Whether the parsed HTTP/1.1 request of ``handler`` asks for h2c and can be upgraded."""
+    headers = handler.headers
+    if handler.request_version != 'HTTP/1.1' or getattr(handler.connection, 'tls', False):
+        return False
+    if 'h2c' not in [t.strip().lower() for t in headers.get('Upgrade', '').split(',')]:
+        return False
+    connection = [t.strip().lower() for t in headers.get('Connection', '').split(',')]
+    if 'upgrade' not in connection or 'http2-settings' not in connection:
+        return False
+    if len(headers.getheaders('HTTP2-Settings')) != 1:
+        return False
+    # the body would have to be read before switching, clients upgrade with bodiless requests
+    if 'Transfer-Encoding' in headers:
+        return False
+    return headers.get('Content-Length', '0').strip() in ('', '0')
+
+
+def upgrade_settings(value):
+    """Decode the base64url SETTINGS payload of a HTTP2-Settings header."""
+    value = value.strip()
+    try:
+        payload = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+    except (TypeError, ValueError):
+        raise ConnectionError(PROTOCOL_ERROR, "invalid HTTP2-Settings")
+    return decode_settings(payload)
+
+
+def serve_prior_knowledge(handler):
+    """Serve HTTP/2 on a connection whose first line was the start of the preface."""
+    data = take_buffered(handler.rfile)
+    H2Connection(handler).serve(data, PREFACE[len(handler.raw_requestline):])
+
+
+def serve_upgrade(handler):
+    """Switch the connection of a h2c upgrade request to HTTP/2, the request becomes stream 1."""
+    try:
+        settings = upgrade_settings(handler.headers.get('HTTP2-Settings'))
+    except ConnectionError:
+        return False
+    environ = handler.get_environ()
+    environ['SERVER_PROTOCOL'] = 'HTTP/2'
+    for key in ('HTTP_CONNECTION', 'HTTP_UPGRADE', 'HTTP_HTTP2_SETTINGS'):
+        environ.pop(key, None)
+    handler.wfile.write(b"HTTP/1.1 101 Switching Protocols\r\nConnection: Upgrade\r\nUpgrade: h2c\r\n\r\n")
+    handler.wfile.flush()
+    data = take_buffered(handler.rfile)
+    H2Connection(handler).serve(data, PREFACE, environ, settings)
+    return True
@@ -8,9 +8,10 @@ from wsgiref.simple_server import WSGIServer as _WSGIServer
 
 from ..compat import string_class, socketserver, address_type
 from ..server import (ExternalReactorMixIn, SocketWrapper, StreamSocket, AcceptedStreamSocket, MultiSocketServer,
-                      request_context)
+                      ThreadPoolMixIn, Prefork, Reactor, request_context, make_tls_context)
 
 from .handlers import WSGIRequestHandler
+from .timing import TimingStats
 
 
 # noinspection PyClassHasNoInit
@@ -39,15 +40,18 @@ class SocketWrapperWSGIServer(StreamSocketWrappingMixIn, _WSGIServer):
 
 
 class INETSocketWSGIServer(SocketWrapperWSGIServer):
+    socket_options = ()
+
     # noinspection PyPep8Naming
     def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
         SocketWrapperWSGIServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate=False)
+        self.timing_stats = TimingStats()
         self.socket.close()
         if self.address_family == socket.AF_INET or self.address_family == socket.AF_INET6:
             info = socket.getaddrinfo(server_address[0], None)[0]
             self.address_family = info[0]
         self.socket = StreamSocket(server_address, self.address_family, self.request_queue_size,
-                                   self.allow_reuse_address)
+                                   self.allow_reuse_address, self.socket_options)
 
         if bind_and_activate:
             self.server_bind()
@@ -100,7 +104,16 @@ class MultiSocketWSGIServer(MultiSocketServer):
         super(MultiSocketWSGIServer, self).add_server(server)
 
     def wsgi_server(self, server_address, address_family=None, app=None, handler_cls=None,
-                    thread=True):
+                    thread=True, threads=None, request_queue_size=None, socket_options=None, tls_context=None):
+        """
+        Create, bind and register a WSGI server.
+
+        ``thread`` runs every connection in its own thread, ``threads`` runs
+        their requests on a pool of that many threads instead, see
+        `msocket.server.ThreadPoolMixIn`. ``socket_options`` is a
+        list of ``(level, option, value)`` applied to the listening socket.
+        ``tls_context`` serves HTTPS, see `msocket.server.make_tls_context`.
+        """
         if app is None:
             app = self.application
         if handler_cls is None:
@@ -114,13 +127,33 @@ class MultiSocketWSGIServer(MultiSocketServer):
         if not server_cls:
             return
 
-        if thread and not issubclass(server_cls, socketserver.ThreadingMixIn):
+        if threads:
+            class Server(ThreadPoolMixIn, server_cls):
+                pool_size = threads
+
+            Server.__name__ = server_cls.__name__
+            server_cls = Server
+
+        elif thread and not issubclass(server_cls, socketserver.ThreadingMixIn):
             class Server(socketserver.ThreadingMixIn, server_cls):
                 daemon_threads = True
 
             Server.__name__ = server_cls.__name__
             server_cls = Server
 
+        if request_queue_size or socket_options or tls_context:
+            class Server(server_cls):
+                pass
+
+            if request_queue_size:
+                Server.request_queue_size = request_queue_size
+            if socket_options:
+                Server.socket_options = tuple(socket_options)
+            if tls_context:
+                Server.tls_context = tls_context
+            Server.__name__ = server_cls.__name__
+            server_cls = Server
+
         server = server_cls(server_address, handler_cls)
         self.add_server(server, app)
         return server
@@ -147,27 +180,150 @@ def load(target, **namespace):
     return eval('%s.%s' % (mod, target), namespace)
 
 
+def parse_bind(value, default_port=8080):
+    """
+    Parse a ``--bind`` value.
+
+    ``host``, ``host:port``, ``[ipv6]:port``, ``:port`` or ``port`` for TCP,
+    ``unix:/path`` or ``unix:@name`` (abstract namespace) for Unix sockets.
+    """
+    if value.startswith('unix:'):
+        path = value[5:]
+        if path.startswith('@'):
+            path = '\0' + path[1:]
+        return path
+
+    host, port = value, default_port
+    if value.isdigit():
+        host, port = '', value
+    elif ':' in host and host.rfind(']') < host.rfind(':'):
+        host, port = host.rsplit(':', 1)
+    host = host.strip('[]') or '0.0.0.0'
+    return host, int(port)
+
+
+def parse_socket_option(value):
+    """Parse ``NAME=VALUE`` (e.g. ``TCP_NODELAY=1``, ``SO_RCVBUF=262144``) into a setsockopt tuple."""
+    name, _, option_value = value.partition('=')
+    name = name.strip().upper()
+    option = getattr(socket, name, None)
+    if option is None:
+        raise ValueError("unknown socket option %s" % name)
+    level = socket.IPPROTO_TCP if name.startswith('TCP_') else socket.SOL_SOCKET
+    return level, option, int(option_value or 1)
+
+
 def main():
+    import gc
+    import signal
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--address", dest="bind", help="bind socket to address")
+    parser.add_argument("-b", "--bind", "--address", dest="bind", action="append",
+                        help="bind socket to address (host:port, [ipv6]:port, unix:/path or unix:@abstract); "
+                             "may be repeated")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("-t", "--threads", type=int, default=0,
+                        help="size of the request thread pool per worker (default: a thread per connection); "
+                             "idle keep-alive connections wait on the reactor, not on a thread")
+    parser.add_argument("--backlog", type=int, default=128, help="listen backlog")
+    parser.add_argument("--keepalive", type=float, default=WSGIRequestHandler.keepalive_timeout,
+                        help="keep-alive timeout in seconds")
+    parser.add_argument("--sockopt", action="append", type=parse_socket_option, default=[],
+                        metavar="NAME=VALUE", help="listening socket option, e.g. TCP_NODELAY=1; may be repeated")
+    parser.add_argument("--tls-bind", action="append", default=[], metavar="ADDRESS",
+                        help="bind a HTTPS socket to address, like --bind; may be repeated")
+    parser.add_argument("--certfile", help="PEM certificate chain of --tls-bind")
+    parser.add_argument("--keyfile", help="PEM private key of --tls-bind (default: in --certfile)")
+    parser.add_argument("--no-session-tickets", dest="session_tickets", action="store_false",
+                        help="resume TLS sessions from the server session cache only")
+    parser.add_argument("--no-ktls", dest="ktls", action="store_false",
+                        help="do not offload TLS records to the kernel")
+    parser.add_argument("--no-http2", dest="http2", action="store_false",
+                        help="do not serve HTTP/2 cleartext (h2c) connections")
+    parser.add_argument("--websocket-bus", metavar="unix:PATH",
+                        help="host a broadcast hub for msocket.wsgi.bus.WebSocketBus on this Unix socket "
+                             "(unix:@name for the abstract namespace)")
+    parser.add_argument("--preload", action="store_true",
+                        help="load the application before forking workers")
     parser.add_argument("application", metavar="package.module:app")
     args = parser.parse_args()
-
-    host, port = (args.bind or 'localhost'), 8080
-    if ':' in host and host.rfind(']') < host.rfind(':'):
-        host, port = host.rsplit(':', 1)
-    host = host.strip('[]')
-
-    app = load(args.application)
-    server = MultiSocketWSGIServer()
-    server.wsgi_server((host, int(port)), app=app)
-
-    try:
-        server.run()
-    except KeyboardInterrupt:
+    if args.tls_bind and not args.certfile:
+        parser.error("--tls-bind requires --certfile")
+    if args.websocket_bus:
+        from .bus import ENVIRON_KEY
+
+        # read by WebSocketBus in the application
+        os.environ[ENVIRON_KEY] = args.websocket_bus
+
+    app = None
+    if args.preload:
+        app = load(args.application)
+        if hasattr(gc, 'freeze'):
+            # move everything allocated so far to the permanent generation, so
+            # the collector does not touch (and unshare) those pages in workers
+            gc.collect()
+            gc.freeze()
+
+    class RequestHandler(WSGIRequestHandler):
+        keepalive_timeout = args.keepalive
+        http2 = args.http2
+
+    server = MultiSocketWSGIServer(app, handler_cls=RequestHandler)
+    for value in args.bind or ([] if args.tls_bind else ['localhost']):
+        server.wsgi_server(parse_bind(value), threads=args.threads, request_queue_size=args.backlog,
+                           socket_options=args.sockopt)
+    if args.tls_bind:
+        # created before forking, so the workers share the session ticket keys
+        tls_context = make_tls_context(args.certfile, args.keyfile, session_tickets=args.session_tickets,
+                                       ktls=args.ktls)
+        for value in args.tls_bind:
+            server.wsgi_server(parse_bind(value, 8443), threads=args.threads, request_queue_size=args.backlog,
+                               socket_options=args.sockopt, tls_context=tls_context)
+
+    hub = None
+    if args.websocket_bus:
+        from .bus import BroadcastHub
+
+        if args.workers > 1:
+            # the master process relays between the workers
+            hub_reactor = Reactor()
+            hub = BroadcastHub(args.websocket_bus, hub_reactor)
+        else:
+            hub = BroadcastHub(args.websocket_bus, server.reactor)
+
+    def serve():
+        if server.application is None:
+            server.application = load(args.application)
+            for s in server.servers:
+                s.set_app(server.application)
+
+        def stop():
+            if hub is not None and args.workers <= 1:
+                hub.server_close()
+            server.shutdown()
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop())
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            stop()
+
+    if args.workers > 1:
+        def worker():
+            if hub is not None:
+                hub.detach()
+            server.reset_reactor()
+            serve()
+
+        # the hub is served on the master's main thread between forks
+        Prefork(args.workers, worker, hub_reactor if hub is not None else None).run()
+        if hub is not None:
+            hub.server_close()
+            hub_reactor.shutdown()
         server.shutdown()
+    else:
+        serve()
 
 if __name__ == '__main__':
     main()
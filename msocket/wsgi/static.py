@@ -0,0 +1,383 @@
+# -*- coding:utf8 -*-
+from __future__ import absolute_import
+
+import os
+import stat
+import mmap
+import time
+import threading
+import mimetypes
+import collections
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from wsgiref.util import FileWrapper
+
+from .compression import negotiate
+
+__author__ = 'fujie'
+
+
+class FileRangeWrapper(FileWrapper):
+    """
+    FileWrapper limited to ``length`` bytes starting at ``offset``.
+
+    `SimpleHandler.sendfile` recognizes this wrapper and pushes the range with
+    ``sendfile(2)`` when it is available.
+    """
+
+    def __init__(self, filelike, offset=0, length=None, blksize=8192):
+        FileWrapper.__init__(self, filelike, blksize)
+        self.offset = offset
+        self.length = length
+        self.remaining = length
+        if offset:
+            filelike.seek(offset)
+
+    def __getitem__(self, key):
+        data = self.next()
+        if data:
+            return data
+        raise IndexError
+
+    def next(self):
+        size = self.blksize
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                raise StopIteration
+            size = min(size, self.remaining)
+        data = self.filelike.read(size)
+        if not data:
+            raise StopIteration
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    __next__ = next
+
+
+class MMapIterator(object):
+    """Iterate over a slice of a shared read-only mmap in ``blksize`` chunks."""
+
+    def __init__(self, buf, start, end, blksize=64 * 1024):
+        self.buf = buf
+        self.pos = start
+        self.end = end
+        self.blksize = blksize
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.pos >= self.end:
+            raise StopIteration
+        end = min(self.pos + self.blksize, self.end)
+        data = self.buf[self.pos:end]
+        self.pos = end
+        return data
+
+    __next__ = next
+
+
+class StaticFile(object):
+    __slots__ = ('path', 'size', 'mtime', 'ino', 'etag', 'last_modified', 'content_type',
+                 'data', 'mmap', 'checked', 'gzip')
+
+    def __init__(self, path, st, content_type):
+        self.path = path
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.ino = st.st_ino
+        self.etag = '"%x-%x-%x"' % (st.st_ino, self.mtime, st.st_size)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.content_type = content_type
+        self.data = None
+        self.mmap = None
+        self.checked = time.time()
+        self.gzip = None
+
+    def changed(self, st):
+        return st.st_ino != self.ino or int(st.st_mtime) != self.mtime or st.st_size != self.size
+
+    def release(self):
+        # in-flight responses may still iterate over the mmap, so it is left
+        # to be unmapped when the last reference goes away
+        self.data = None
+        self.mmap = None
+        self.gzip = None
+
+
+class StaticFiles(object):
+    """
+    WSGI application serving files below ``root``.
+
+    - Stat results are cached and revalidated by mtime every ``check_interval``
+      seconds (0 to stat on every request).
+    - Files up to ``small_file_size`` are kept in memory, files up to
+      ``mmap_file_size`` are memory-mapped, larger ones are returned through
+      ``wsgi.file_wrapper`` so `SimpleHandler` can use ``sendfile(2)``.
+    - Single byte ranges, If-Modified-Since / If-None-Match and precompressed
+      ``.gz`` siblings are supported.
+
+    Mount under a prefix with ``prefix='/static'``; requests outside of it
+    are passed to ``fallback`` (or answered with 404).
+    """
+
+    small_file_size = 64 * 1024
+    mmap_file_size = 8 * 1024 ** 2
+    memory_limit = 64 * 1024 ** 2
+    max_entries = 4096
+    check_interval = 1.0
+    blksize = 64 * 1024
+    index_file = 'index.html'
+    default_content_type = 'application/octet-stream'
+    cache_control = None
+
+    def __init__(self, root, prefix='', fallback=None, **options):
+        self.root = os.path.realpath(root)
+        self.prefix = prefix.rstrip('/')
+        self.fallback = fallback
+        for k, v in options.items():
+            if not hasattr(self, k):
+                raise TypeError("unexpected option %r" % k)
+            setattr(self, k, v)
+
+        self.lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._memory = 0
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ.get('PATH_INFO', '')
+        if self.prefix:
+            if path != self.prefix and not path.startswith(self.prefix + '/'):
+                return self.not_found(environ, start_response)
+            path = path[len(self.prefix):]
+
+        if method not in ('GET', 'HEAD'):
+            return self.error(start_response, '405 Method Not Allowed', [('Allow', 'GET, HEAD')])
+
+        filename = self.resolve(path)
+        if filename is None:
+            return self.not_found(environ, start_response)
+
+        entry = self.lookup(filename)
+        if entry is None:
+            return self.not_found(environ, start_response)
+
+        encoding = None
+        if entry.gzip and negotiate(environ.get('HTTP_ACCEPT_ENCODING'), ('gzip',)):
+            entry, encoding = entry.gzip, 'gzip'
+
+        return self.serve(environ, start_response, entry, encoding, method == 'HEAD')
+
+    def resolve(self, path):
+        if '\0' in path:
+            return None
+        filename = os.path.realpath(os.path.join(self.root, path.lstrip('/')))
+        if filename != self.root and not filename.startswith(self.root + os.sep):
+            return None
+        if os.path.isdir(filename):
+            if not self.index_file:
+                return None
+            filename = os.path.join(filename, self.index_file)
+        return filename
+
+    def lookup(self, filename):
+        now = time.time()
+        with self.lock:
+            entry = self._cache.get(filename)
+            if entry is not None:
+                self._cache.pop(filename)
+                self._cache[filename] = entry
+                if now - entry.checked < self.check_interval:
+                    return entry
+
+        try:
+            st = os.stat(filename)
+        except OSError:
+            st = None
+
+        if entry is not None:
+            if st is not None and not entry.changed(st) and not self._gzip_changed(entry):
+                entry.checked = now
+                return entry
+            with self.lock:
+                if self._cache.get(filename) is entry:
+                    self._evict(filename)
+
+        if st is None or not stat.S_ISREG(st.st_mode):
+            return None
+
+        # read or mapped without the lock, a concurrent load of the same file replaces this one
+        entry = self.load(filename, st)
+        if entry is None:
+            return None
+        with self.lock:
+            current = self._cache.get(filename)
+            if current is not None and not current.changed(st):
+                # loaded by another thread meanwhile
+                entry.release()
+                return current
+            self._evict(filename)
+            self._cache[filename] = entry
+            self._memory += len(entry.data or '') + len((entry.gzip and entry.gzip.data) or '')
+            while len(self._cache) > 1 and (len(self._cache) > self.max_entries or
+                                            self._memory > self.memory_limit):
+                self._evict(next(iter(self._cache)))
+            return entry
+
+    def _gzip_changed(self, entry):
+        try:
+            st = os.stat(entry.path + '.gz')
+        except OSError:
+            return entry.gzip is not None
+        if entry.gzip is None:
+            return int(st.st_mtime) >= entry.mtime
+        return entry.gzip.changed(st)
+
+    def _evict(self, filename):
+        entry = self._cache.pop(filename, None)
+        if entry is not None:
+            self._memory -= len(entry.data or '') + len((entry.gzip and entry.gzip.data) or '')
+            entry.release()
+
+    def load(self, filename, st, content_type=None):
+        if content_type is None:
+            content_type = mimetypes.guess_type(filename)[0] or self.default_content_type
+        entry = StaticFile(filename, st, content_type)
+        try:
+            if st.st_size <= self.small_file_size:
+                with open(filename, 'rb') as f:
+                    entry.data = f.read()
+                entry.size = len(entry.data)
+            elif st.st_size <= self.mmap_file_size:
+                with open(filename, 'rb') as f:
+                    entry.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            return None
+
+        if not filename.endswith('.gz'):
+            try:
+                gz_st = os.stat(filename + '.gz')
+            except OSError:
+                pass
+            else:
+                # a stale .gz is ignored rather than served
+                if stat.S_ISREG(gz_st.st_mode) and int(gz_st.st_mtime) >= entry.mtime:
+                    entry.gzip = self.load(filename + '.gz', gz_st, content_type)
+        return entry
+
+    def serve(self, environ, start_response, entry, encoding, head):
+        headers = [
+            ('Content-Type', entry.content_type),
+            ('Last-Modified', entry.last_modified),
+            ('ETag', entry.etag),
+            ('Accept-Ranges', 'bytes'),
+        ]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        if encoding or (entry.gzip is not None):
+            headers.append(('Vary', 'Accept-Encoding'))
+        if self.cache_control:
+            headers.append(('Cache-Control', self.cache_control))
+
+        if self.not_modified(environ, entry):
+            start_response('304 Not Modified', [h for h in headers if h[0] != 'Content-Type'])
+            return []
+
+        size = entry.size
+        start, end = 0, size
+        status = '200 OK'
+        byte_range = environ.get('HTTP_RANGE')
+        if byte_range and self.if_range(environ, entry):
+            byte_range = self.parse_range(byte_range, size)
+            if byte_range == ():
+                return self.error(start_response, '416 Requested Range Not Satisfiable',
+                                  [('Content-Range', 'bytes */%d' % size)])
+            if byte_range:
+                start, end = byte_range
+                status = '206 Partial Content'
+                headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size)))
+
+        headers.append(('Content-Length', str(end - start)))
+        start_response(status, headers)
+
+        if head:
+            return []
+        if entry.data is not None:
+            return [entry.data[start:end]]
+        if entry.mmap is not None:
+            return MMapIterator(entry.mmap, start, end, self.blksize)
+
+        try:
+            f = open(entry.path, 'rb')
+        except IOError:
+            return []
+        return FileRangeWrapper(f, start, end - start, self.blksize)
+
+    @staticmethod
+    def not_modified(environ, entry):
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or entry.etag in tags or ('W/' + entry.etag) in tags
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            t = parsedate_tz(if_modified_since.split(';', 1)[0])
+            if t is not None:
+                return entry.mtime <= mktime_tz(t)
+        return False
+
+    @staticmethod
+    def if_range(environ, entry):
+        value = environ.get('HTTP_IF_RANGE')
+        if not value:
+            return True
+        if value.startswith('"') or value.startswith('W/'):
+            return value == entry.etag
+        return value == entry.last_modified
+
+    @staticmethod
+    def parse_range(value, size):
+        """
+        Return ``(start, end)`` for a single satisfiable byte range, ``()`` if
+        unsatisfiable and None when the header should be ignored (including
+        multiple ranges, which are answered with the whole entity).
+        """
+        unit, _, spec = value.partition('=')
+        if unit.strip().lower() != 'bytes' or ',' in spec:
+            return None
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                length = int(last)
+                if length <= 0:
+                    return ()
+                return max(size - length, 0), size
+            start = int(first)
+            end = int(last) + 1 if last else size
+        except ValueError:
+            return None
+        if start >= size:
+            return ()
+        if end <= start:
+            return None
+        return start, min(end, size)
+
+    def not_found(self, environ, start_response):
+        if self.fallback is not None:
+            return self.fallback(environ, start_response)
+        return self.error(start_response, '404 Not Found')
+
+    @staticmethod
+    def error(start_response, status, headers=None):
+        body = status.encode('ascii')
+        headers = list(headers or []) + [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))]
+        start_response(status, headers)
+        return [body]
+
+    def clear(self):
+        with self.lock:
+            for filename in list(self._cache):
+                self._evict(filename)
@@ -0,0 +1,120 @@
+# -*- coding:utf8 -*-
+from __future__ import absolute_import
+
+import bisect
+import threading
+
+__author__ = 'fujie'
+
+
+class RequestTiming(object):
+    """
+    Timestamps of one request, exposed as ``environ['msocket.timing']``.
+
+    ``accepted`` is only set for the first request of a connection, later
+    keep-alive requests start when the connection became readable again.
+    """
+    __slots__ = ('accepted', 'started', 'first_byte', 'headers_parsed', 'app_called', 'first_write', 'finished')
+
+    # (name, from, to)
+    phases = (
+        ('queue', 'accepted', 'started'),
+        ('read', 'started', 'first_byte'),
+        ('parse', 'first_byte', 'headers_parsed'),
+        ('dispatch', 'headers_parsed', 'app_called'),
+        ('app', 'app_called', 'first_write'),
+        ('send', 'first_write', 'finished'),
+    )
+
+    def __init__(self, accepted=None, started=None):
+        self.accepted = accepted
+        self.started = started
+        self.first_byte = None
+        self.headers_parsed = None
+        self.app_called = None
+        self.first_write = None
+        self.finished = None
+
+    def durations(self):
+        """Return ``[(phase, seconds), ...]`` for every phase with both ends recorded."""
+        result = []
+        for name, start, end in self.phases:
+            start, end = getattr(self, start), getattr(self, end)
+            if start is not None and end is not None:
+                result.append((name, end - start))
+        start = self.accepted if self.accepted is not None else self.started
+        if start is not None and self.finished is not None:
+            result.append(('total', self.finished - start))
+        return result
+
+    def __str__(self):
+        return " ".join("%s=%.2f" % (name, d * 1000) for name, d in self.durations())
+
+
+class Histogram(object):
+    """Log-scale latency histogram, bucket bounds double from 50us up to ~100s."""
+
+    bounds = tuple(0.00005 * 2 ** i for i in range(22))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        """Upper bucket bound containing the ``p`` th percentile (0-100)."""
+        with self.lock:
+            counts, count, _max = list(self.counts), self.count, self.max
+        if not count:
+            return 0.0
+        rank = count * p / 100.0
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= rank and c:
+                return min(self.bounds[i], _max) if i < len(self.bounds) else _max
+        return _max
+
+    def snapshot(self):
+        count = self.count
+        return {
+            'count': count,
+            'mean': self.sum / count if count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class TimingStats(object):
+    """Per listener histograms of every `RequestTiming` phase."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def record(self, timing):
+        histograms = self.histograms
+        for name, duration in timing.durations():
+            histogram = histograms.get(name)
+            if histogram is None:
+                with self.lock:
+                    histogram = histograms.setdefault(name, Histogram())
+            histogram.add(duration)
+
+    def snapshot(self):
+        with self.lock:
+            items = list(self.histograms.items())
+        return dict((name, h.snapshot()) for name, h in items)
@@ -1,12 +1,30 @@
 # -*- coding:utf8 -*-
 from __future__ import absolute_import
 
+import time
+import errno
+import random
+import socket
+import logging
+import struct
 import threading
-from ..server import AcceptedStreamSocket, request_context
+import functools
+import collections
+from ..server import AcceptedStreamSocket, WorkerPool, request_context, MSG_DONTWAIT
 from ..compat import py3k
 from .handlers import SimpleHandler as _SimpleHandler, WSGIRequestHandler as _WSGIRequestHandler
+from .framing import (encode_close, is_control_frame, frame_header, split_frame, message_payload,
+                      FrameParser, ProtocolError, Message, OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE, OPCODE_PING,
+                      OPCODE_PONG)
+from .deflate import PerMessageDeflate
 import wsgiref.util
 
+try:
+    from ws4py.messaging import TextMessage, BinaryMessage, PongControlMessage, CloseControlMessage
+except ImportError:
+    TextMessage = BinaryMessage = PongControlMessage = CloseControlMessage = None
+
+logger = logging.getLogger("msocket.server.websocket")
 wsgiref.util._hoppish = {}.__contains__
 
 
@@ -21,23 +39,285 @@ class AcceptedWebSocket(AcceptedStreamSocket):
         super(AcceptedWebSocket, self).__init__(request, client_address)
         self.websocket = True
         self.ws = None
+        # fd registered by WebSocketManager.add_ws, still known once the socket is closed
+        self.fd = None
         self.lock = threading.Lock()
+        # outbound frames not yet accepted by the kernel, see WebSocketManager.write
+        self.write_lock = threading.Lock()
+        self.outbound = collections.deque()
+        self.outbound_offset = 0
+        self.queued_bytes = 0
+        self.dropped_frames = 0
+        # inbound state of the built-in frame parser
+        self.parser = None
+        self.read_buffer = None
+        # negotiated PerMessageDeflate, if any
+        self.deflate = None
+        # heartbeat state, see WebSocketManager.heartbeat
+        self.last_activity = self.last_message = time.time()
+        self.ping_sent = None
+        self.heartbeat_timer = None
+        # decoded frames waiting for a handler thread, see WebSocketManager.deliver
+        self.inbox = collections.deque()
+        self.inbox_lock = threading.Lock()
+        self.inbox_scheduled = False
+
+    @property
+    def queued_frames(self):
+        return len(self.outbound)
 
 
 class WebSocketManager(object):
-    def __init__(self):
+    """
+    Owns the accepted websockets of a server.
+
+    Every frame written to a websocket goes through `write`. It is sent right
+    away when the socket accepts it, otherwise it is queued and flushed by the
+    reactor on write readiness, so a slow peer never blocks the caller. When
+    more than ``high_water`` bytes are queued for one connection the
+    ``overflow_policy`` applies:
+
+    - ``'drop_oldest'``: drop the oldest unsent data frames
+    - ``'coalesce'``: keep only the newest frame (for state snapshots)
+    - ``'close'``: close the connection with 1008 (policy violation)
+    """
+    high_water = 4 * 1024 ** 2
+    overflow_policy = 'drop_oldest'
+    overflow_policies = ('drop_oldest', 'coalesce', 'close')
+    # parse frames with FrameParser instead of ws4py's ws.once()
+    builtin_parser = True
+    recv_size = 64 * 1024
+    max_message_size = 16 * 1024 ** 2
+    # permessage-deflate (RFC 7692) negotiation, see negotiate_extensions
+    permessage_deflate = True
+    deflate_level = 6
+    deflate_mem_level = 8
+    deflate_server_no_context_takeover = True
+    # budget for zlib contexts kept between messages, over it new
+    # connections are negotiated without context takeover
+    deflate_max_memory = 64 * 1024 ** 2
+    # run the ws4py callbacks on a pool of this many threads, 0 runs them on the reactor thread
+    handler_threads = 0
+    # frames handled per pool task before yielding to other connections
+    handler_batch = 32
+    # seconds of inbound silence before a ping is sent, None disables heartbeats
+    ping_interval = 30
+    # seconds to wait for any inbound data after a ping before the peer is dropped
+    ping_timeout = 10
+    # close connections without inbound data messages for that long, None to keep them
+    idle_timeout = None
+    # heartbeat delays are spread by +/- this fraction
+    heartbeat_jitter = 0.1
+    # a subscription to "a.b.*" receives "a.b.c" and "a.b.c.d", "*" receives everything
+    topic_separator = '.'
+    # msocket.wsgi.bus.WebSocketBus sharing broadcasts with other processes
+    bus = None
+
+    def __init__(self, high_water=None, overflow_policy=None, handler_threads=None):
         self.lock = threading.Lock()
         self.closed = False
+        self.reactor = None
+        if handler_threads is not None:
+            self.handler_threads = handler_threads
+        self.pool = WorkerPool(self.handler_threads, name='websocket') if self.handler_threads else None
         self._socks = {}
+        self.socks_lock = threading.Lock()
+        # topic -> set of sockets, wildcard prefix -> set of sockets, socket -> set of subscriptions
+        self._topics = {}
+        self._prefixes = {}
+        self._subscriptions = {}
+        self.deflate_memory = 0
+        if high_water is not None:
+            self.high_water = high_water
+        if overflow_policy is not None:
+            if overflow_policy not in self.overflow_policies:
+                raise ValueError("unknown overflow policy %r" % overflow_policy)
+            self.overflow_policy = overflow_policy
 
     def add_ws(self, sock):
-        fd = sock.fileno()
+        fd = sock.fd = sock.fileno()
         self._socks[fd] = sock
+        if sock.ws is not None:
+            sock.ws._write = functools.partial(self.write_ws4py, sock)
+        self.reactor = request_context.reactor
         request_context.reactor.add_listener(self, sock)
+        if self.bus is not None:
+            self.bus.start(self.reactor)
+        if self.ping_interval or self.idle_timeout:
+            # the first check is spread over a whole interval
+            delay = min(t for t in (self.ping_interval, self.idle_timeout) if t)
+            self.schedule_heartbeat(sock, delay * random.random())
 
     def del_ws(self, sock):
-        request_context.reactor.del_listener(sock)
-        self._socks.pop(sock.fileno(), None)
+        """Forget ``sock``; only the first call does something, the socket may be closed already."""
+        fd = sock.fd
+        with self.socks_lock:
+            if fd is None or self._socks.get(fd) is not sock:
+                return
+            del self._socks[fd]
+        reactor = getattr(request_context, 'reactor', None) or self.reactor
+        reactor.del_listener(sock, fd)
+        self.unsubscribe(sock)
+        timer, sock.heartbeat_timer = sock.heartbeat_timer, None
+        reactor.cancel_timer(timer)
+        self.release_deflate(sock)
+
+    def release_deflate(self, sock):
+        deflate, sock.deflate = sock.deflate, None
+        if deflate is not None:
+            with self.lock:
+                self.deflate_memory -= deflate.memory
+
+    def schedule_heartbeat(self, sock, delay):
+        jitter = self.heartbeat_jitter
+        if jitter:
+            delay *= 1 + random.uniform(-jitter, jitter)
+        sock.heartbeat_timer = self.reactor.call_later(max(delay, 0), self.heartbeat, sock)
+
+    def heartbeat(self, sock):
+        """
+        Reactor timer of one connection: ping it after ``ping_interval`` of
+        silence, drop it when nothing arrives within ``ping_timeout`` and
+        close it after ``idle_timeout`` without data messages.
+        """
+        sock.heartbeat_timer = None
+        if self._socks.get(sock.fd) is not sock:
+            return
+        now = time.time()
+        silence = now - sock.last_activity
+
+        if sock.ping_sent is not None:
+            if sock.last_activity >= sock.ping_sent:
+                sock.ping_sent = None
+            elif now - sock.ping_sent >= self.ping_timeout:
+                logger.info("Dropping unresponsive websocket %s", sock)
+                self.evict(sock, None)
+                return
+
+        idle_timeout = self.idle_timeout
+        if idle_timeout and now - sock.last_message >= idle_timeout:
+            self.evict(sock, 1000, 'Idle timeout')
+            return
+
+        ping_interval = self.ping_interval
+        if sock.ping_sent is None and ping_interval and silence >= ping_interval:
+            try:
+                self.write(sock, frame_header(4, OPCODE_PING) + struct.pack('!I', int(now) & 0xffffffff))
+            except socket.error:
+                self.evict(sock, None)
+                return
+            sock.ping_sent = now
+
+        delays = []
+        if sock.ping_sent is not None:
+            delays.append(sock.ping_sent + self.ping_timeout - now)
+        elif ping_interval:
+            delays.append(sock.last_activity + ping_interval - now)
+        if idle_timeout:
+            delays.append(sock.last_message + idle_timeout - now)
+        self.schedule_heartbeat(sock, min(delays))
+
+    def negotiate_extensions(self, sock, environ, headers):
+        """Negotiate permessage-deflate for an accepted upgrade and add the response header."""
+        if not self.permessage_deflate or 'Sec-WebSocket-Extensions' in headers:
+            return
+        if not self.builtin_parser:
+            # ws4py's own parser rejects RSV1 frames
+            return
+        offer = environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
+        if not offer:
+            return
+        with self.lock:
+            over_budget = self.deflate_memory >= self.deflate_max_memory
+            deflate = PerMessageDeflate.negotiate(
+                offer, self.deflate_server_no_context_takeover or over_budget, over_budget,
+                self.deflate_level, self.deflate_mem_level)
+            if deflate is None:
+                return
+            self.deflate_memory += deflate.memory
+        sock.deflate = deflate
+        headers['Sec-WebSocket-Extensions'] = deflate.response_header()
+
+    def get_socket(self, ws):
+        """Return the `AcceptedWebSocket` of ``ws``, which may be the socket itself or a ws4py WebSocket."""
+        if isinstance(ws, AcceptedWebSocket):
+            return ws
+        try:
+            return self._socks.get(ws.sock.fileno())
+        except (AttributeError, socket.error):
+            return None
+
+    def _index(self, topic):
+        if topic == '*':
+            return self._prefixes, ''
+        suffix = self.topic_separator + '*'
+        if topic.endswith(suffix):
+            return self._prefixes, topic[:-1]
+        return self._topics, topic
+
+    def subscribe(self, ws, *topics):
+        sock = self.get_socket(ws)
+        if sock is None:
+            return False
+        with self.lock:
+            subscriptions = self._subscriptions.setdefault(sock, set())
+            for topic in topics:
+                index, key = self._index(topic)
+                index.setdefault(key, set()).add(sock)
+                subscriptions.add(topic)
+        return True
+
+    def unsubscribe(self, ws, *topics):
+        """Remove the given subscriptions of ``ws``, or all of them when no topic is given."""
+        sock = self.get_socket(ws)
+        if sock is None:
+            return
+        with self.lock:
+            subscriptions = self._subscriptions.get(sock)
+            if not subscriptions:
+                return
+            for topic in (topics or list(subscriptions)):
+                subscriptions.discard(topic)
+                index, key = self._index(topic)
+                subscribers = index.get(key)
+                if subscribers is not None:
+                    subscribers.discard(sock)
+                    if not subscribers:
+                        del index[key]
+            if not subscriptions:
+                del self._subscriptions[sock]
+
+    def topics(self, ws):
+        sock = self.get_socket(ws)
+        with self.lock:
+            return set(self._subscriptions.get(sock, ()))
+
+    def subscribers(self, topic):
+        """Sockets subscribed to ``topic`` directly or through a wildcard."""
+        with self.lock:
+            result = set(self._topics.get(topic, ()))
+            prefixes = self._prefixes
+            if prefixes:
+                separator = self.topic_separator
+                result.update(prefixes.get('', ()))
+                end = topic.find(separator)
+                while end >= 0:
+                    result.update(prefixes.get(topic[:end + 1], ()))
+                    end = topic.find(separator, end + 1)
+        return result
+
+    def publish(self, topic, message, binary=False, local=False):
+        """
+        Send ``message`` to the subscribers of ``topic``, returns the number of
+        local recipients. Unless ``local`` is set the message is also handed
+        to the `bus`.
+        """
+        if self.bus is not None and not local:
+            self.bus.forward(topic, message, binary)
+        subscribers = self.subscribers(topic)
+        if not subscribers:
+            return 0
+        return self.send_many(subscribers, message, binary)
 
     def dispatch(self, request):
         """
@@ -49,16 +329,155 @@ class WebSocketManager(object):
         with request.lock:
             if ws and not ws.terminated:
                 try:
-                    if not ws.once():
+                    if not self.builtin_parser:
+                        request.last_activity = request.last_message = time.time()
+                    if not (self.receive(request) if self.builtin_parser else ws.once()):
                         self.del_ws(request)
 
-                        if not ws.terminated:
+                        if self.builtin_parser and self.pool is not None:
+                            # terminate after the messages still waiting in the inbox
+                            self.deliver(request, [(None, None)])
+                        elif not ws.terminated:
                             ws.terminate()
                 except:
                     import traceback
                     traceback.print_exc()
                     pass
 
+    def receive(self, sock):
+        """
+        Read what is available on ``sock`` into its reusable buffer and hand
+        every complete message to the ws4py WebSocket callbacks.
+        Returns False once the connection is finished.
+        """
+        ws = sock.ws
+        if sock.parser is None:
+            sock.parser = FrameParser(self.max_message_size, allow_rsv1=sock.deflate is not None)
+            sock.read_buffer = bytearray(self.recv_size)
+        buf = sock.read_buffer
+        try:
+            n = sock.socket.recv_into(buf)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+            logger.debug("Failed to read from %s: %r", sock, e)
+            return False
+        if not n:
+            return False
+        sock.last_activity = time.time()
+
+        try:
+            frames = sock.parser.feed(memoryview(buf)[:n])
+        except ProtocolError as e:
+            ws.close(e.code, str(e))
+            return False
+
+        messages = []
+        for opcode, data, rsv1 in frames:
+            if rsv1:
+                try:
+                    data = sock.deflate.decompress(data, self.max_message_size)
+                except ProtocolError as e:
+                    ws.close(e.code, str(e))
+                    return False
+            if opcode == OPCODE_PING:
+                # answered right away, it does not involve the application
+                self.handle_frame(sock, opcode, data)
+            else:
+                messages.append((opcode, data))
+        return self.deliver(sock, messages)
+
+    def deliver(self, sock, messages):
+        """
+        Hand decoded ``(opcode, payload)`` messages to the application.
+
+        Without a pool they are handled inline and False is returned once the
+        connection is finished. With a pool they are appended to the socket's
+        inbox, which is drained by at most one handler thread at a time, so
+        messages of one connection stay in order while connections are handled
+        in parallel.
+        """
+        if self.pool is None:
+            for opcode, data in messages:
+                if not self.handle_frame(sock, opcode, data):
+                    return False
+            return True
+
+        if not messages:
+            return True
+        with sock.inbox_lock:
+            sock.inbox.extend(messages)
+            if sock.inbox_scheduled:
+                return True
+            sock.inbox_scheduled = True
+        self.pool.submit(self.drain_inbox, sock)
+        return True
+
+    def drain_inbox(self, sock):
+        ws = sock.ws
+        inbox = sock.inbox
+        for _ in range(self.handler_batch):
+            with sock.inbox_lock:
+                if not inbox:
+                    sock.inbox_scheduled = False
+                    return
+                opcode, data = inbox.popleft()
+
+            if opcode is None:
+                finished = True
+            else:
+                try:
+                    finished = not self.handle_frame(sock, opcode, data)
+                except Exception:
+                    logger.exception("Error while handling a message of %s", sock)
+                    finished = False
+            if finished:
+                with sock.inbox_lock:
+                    inbox.clear()
+                    sock.inbox_scheduled = False
+                self.del_ws(sock)
+                if not ws.terminated:
+                    ws.terminate()
+                return
+
+        # give other connections a turn
+        self.pool.submit(self.drain_inbox, sock)
+
+    def handle_frame(self, sock, opcode, data):
+        ws = sock.ws
+        if opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            sock.last_message = sock.last_activity
+        if opcode == OPCODE_TEXT:
+            try:
+                data.decode('utf-8')
+            except UnicodeDecodeError:
+                ws.close(1007, 'Invalid UTF-8')
+                return False
+            ws.received_message(TextMessage(data) if TextMessage else Message(opcode, data))
+        elif opcode == OPCODE_BINARY:
+            ws.received_message(BinaryMessage(data) if BinaryMessage else Message(opcode, data))
+        elif opcode == OPCODE_PING:
+            self.write(sock, frame_header(len(data), OPCODE_PONG) + data)
+        elif opcode == OPCODE_PONG:
+            ponged = getattr(ws, 'ponged', None)
+            if ponged is not None:
+                ponged(PongControlMessage(data) if PongControlMessage else Message(opcode, data))
+        elif opcode == OPCODE_CLOSE:
+            code, reason = 1005, ''
+            if len(data) >= 2:
+                code = (bytearray(data[:2])[0] << 8) | bytearray(data[:2])[1]
+                reason = data[2:]
+            stream = getattr(ws, 'stream', None)
+            if stream is not None and CloseControlMessage is not None:
+                # ws4py reports the peer's close code from stream.closing
+                stream.closing = CloseControlMessage(code=code, reason=reason)
+            if not getattr(ws, 'server_terminated', False):
+                ws.close(code if code != 1005 else 1000, reason)
+            else:
+                ws.client_terminated = True
+            return False
+        return True
+
     def websockets(self):
         return (s for s in self._socks.values())
 
@@ -67,21 +486,180 @@ class WebSocketManager(object):
             for ws in (s.ws for s in self.websockets()):
                 ws.close(code=code, reason=message)
 
-    def broadcast(self, message, binary=False):
+    def broadcast(self, message, binary=False, local=False):
+        """
+        Send ``message`` to every connection. The frame is encoded once and
+        the same buffer is written to each socket. Unless ``local`` is set the
+        message is also handed to the `bus`.
+        """
+        if self.bus is not None and not local:
+            self.bus.forward(None, message, binary)
         with self.lock:
-            websockets = self.websockets()
+            websockets = list(self.websockets())
+        self.send_many(websockets, message, binary)
+
+    def send_many(self, websockets, message, binary=False):
+        """
+        Send ``message`` to each of ``websockets``, encoding it as few times as
+        possible: once uncompressed, once per set of deflate parameters
+        without context takeover, and per connection only for connections
+        with context takeover. Returns the number of recipients.
+        """
+        opcode, payload = message_payload(message, binary)
+        frame = None
+        compressed = {}
+        sent = 0
+        for sock in websockets:
+            deflate = sock.deflate
+            if deflate is None:
+                if frame is None:
+                    frame = frame_header(len(payload), opcode) + payload
+                sent += self.send_frame(sock, frame)
+                continue
+            key = deflate.key
+            if key is None:
+                with deflate.lock:
+                    sent += self.send_frame(sock, deflate.encode_frame(opcode, payload))
+                continue
+            data = compressed.get(key)
+            if data is None:
+                data = compressed[key] = deflate.encode_frame(opcode, payload)
+            sent += self.send_frame(sock, data)
+        return sent
 
-        for ws in (s.ws for s in websockets):
-            if not ws.terminated:
+    def send(self, sock, message, binary=False):
+        return bool(self.send_many([sock], message, binary))
+
+    def send_frame(self, sock, frame):
+        """Write an already encoded frame to ``sock``, returns False if the peer is gone."""
+        ws = sock.ws
+        if ws is None or ws.terminated:
+            return False
+        try:
+            self.write(sock, frame)
+        except (socket.error, RuntimeError) as e:
+            logger.debug("Failed to send to %s: %r", sock, e)
+            return False
+        return True
+
+    @staticmethod
+    def _send(sock, data):
+        try:
+            return sock.socket.send(data, MSG_DONTWAIT)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def _flush(self, sock):
+        """Send queued frames until the socket would block. Called with ``sock.write_lock`` held."""
+        outbound = sock.outbound
+        while outbound:
+            data = outbound[0]
+            offset = sock.outbound_offset
+            sent = self._send(sock, memoryview(data)[offset:] if offset else data)
+            sock.queued_bytes -= sent
+            if offset + sent < len(data):
+                sock.outbound_offset = offset + sent
+                return False
+            outbound.popleft()
+            sock.outbound_offset = 0
+        return True
+
+    def write_ws4py(self, sock, data):
+        """Replacement of ws4py's ``WebSocket._write``, compresses single-frame messages when negotiated."""
+        deflate = sock.deflate
+        if deflate is not None:
+            frame = split_frame(data)
+            if frame is not None and frame[0] and frame[1] in (OPCODE_TEXT, OPCODE_BINARY):
+                with deflate.lock:
+                    return self.write(sock, deflate.encode_frame(frame[1], frame[2]))
+        return self.write(sock, data)
+
+    def write(self, sock, data):
+        """Queue ``data`` (one complete frame) for ``sock`` without blocking."""
+        overflow = False
+        with sock.write_lock:
+            sock.outbound.append(data)
+            sock.queued_bytes += len(data)
+            if len(sock.outbound) > 1 or not self._flush(sock):
+                if sock.queued_bytes > self.high_water:
+                    overflow = self.overflow(sock)
+                self.reactor.set_writable(self, sock, True)
+        if overflow:
+            self.evict(sock)
+
+    def overflow(self, sock):
+        """
+        Apply the overflow policy, returns True when ``sock`` must be closed.
+        The partially sent head frame and control frames are never dropped.
+        """
+        policy = self.overflow_policy
+        if policy == 'close' or (sock.deflate is not None and sock.deflate.key is None):
+            # frames compressed with context takeover can not be dropped
+            # without corrupting the peer's decompression context
+            return True
+
+        outbound = sock.outbound
+        if len(outbound) <= (2 if sock.outbound_offset else 1):
+            return False
+        head = outbound.popleft() if sock.outbound_offset else None
+        newest = outbound.pop()
+        kept = collections.deque()
+        while outbound:
+            frame = outbound.popleft()
+            if is_control_frame(frame):
+                kept.append(frame)
+            elif policy == 'coalesce' or sock.queued_bytes > self.high_water:
+                sock.queued_bytes -= len(frame)
+                sock.dropped_frames += 1
+            else:
+                kept.append(frame)
+        if head is not None:
+            kept.appendleft(head)
+        kept.append(newest)
+        sock.outbound = kept
+        return False
+
+    def dispatch_write(self, sock):
+        try:
+            with sock.write_lock:
+                if self._flush(sock):
+                    self.reactor.set_writable(self, sock, False)
+        except socket.error as e:
+            logger.debug("Failed to flush %s: %r", sock, e)
+            self.evict(sock, None)
+
+    def evict(self, sock, code=1008, reason='Slow consumer'):
+        """Drop pending output and close ``sock``, sending a close frame when possible."""
+        with sock.write_lock:
+            partial = sock.outbound_offset > 0
+            sock.outbound.clear()
+            sock.outbound_offset = 0
+            sock.queued_bytes = 0
+            if code is not None and not partial:
                 try:
-                    ws.send(message, binary)
-                except:
+                    self._send(sock, encode_close(code, reason))
+                except socket.error:
                     pass
+        self.del_ws(sock)
+        ws = sock.ws
+        if ws is not None and not ws.terminated:
+            ws.terminate()
+
+    def queue_depths(self):
+        with self.lock:
+            websockets = list(self.websockets())
+        return dict((s.fd, s.queued_bytes) for s in websockets)
 
     def server_close(self):
         if self.closed:
             return
         self.close_all()
+        if self.bus is not None:
+            self.bus.close()
+        if self.pool is not None:
+            self.pool.shutdown()
 
 
 class SimpleHandler(_SimpleHandler):
@@ -110,17 +688,21 @@ class SimpleHandler(_SimpleHandler):
         - Attach the returned websocket, if any, to the WSGI server
           using its ``link_websocket_to_server`` method.
         """
-        ws = None
+        ws = sock = None
         if self.environ:
             sock = self.environ.pop('ws4py.socket', None)
             if sock:
                 ws = self.environ.get('ws4py.websocket')
                 sock.ws = ws
+                if ws and self.status and self.status.startswith('101'):
+                    self.websocket_manager.negotiate_extensions(sock, self.environ, self.headers)
 
         try:
             _SimpleHandler.finish_response(self)
 
         except:
+            if sock:
+                self.websocket_manager.release_deflate(sock)
             if ws:
                 ws.close(1011, reason='Something broke')
             raise
@@ -0,0 +1,147 @@
+# -*- coding:utf8 -*-
+from __future__ import absolute_import
+
+import binascii
+import unittest
+
+from msocket.wsgi.hpack import Decoder, Encoder, HPACKError, huffman_decode, huffman_encode
+
+__author__ = 'fujie'
+
+DATE_1 = b'Mon, 21 Oct 2013 20:13:21 GMT'
+DATE_2 = b'Mon, 21 Oct 2013 20:13:22 GMT'
+LOCATION = b'https://www.example.com'
+COOKIE = b'foo=ASDJKHQKBZXOQWEOPIUAXQWEOIU; max-age=3600; version=1'
+
+# RFC 7541 Appendix C.3 / C.4: (block without Huffman, block with Huffman, headers, table size)
+REQUESTS = (
+    ('828684410f7777772e6578616d706c652e636f6d',
+     '828684418cf1e3c2e5f23a6ba0ab90f4ff',
+     [(b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'), (b':authority', b'www.example.com')],
+     57),
+    ('828684be58086e6f2d6361636865',
+     '828684be5886a8eb10649cbf',
+     [(b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'), (b':authority', b'www.example.com'),
+      (b'cache-control', b'no-cache')],
+     110),
+    ('828785bf400a637573746f6d2d6b65790c637573746f6d2d76616c7565',
+     '828785bf408825a849e95ba97d7f8925a849e95bb8e8b4bf',
+     [(b':method', b'GET'), (b':scheme', b'https'), (b':path', b'/index.html'), (b':authority', b'www.example.com'),
+      (b'custom-key', b'custom-value')],
+     164),
+)
+
+# RFC 7541 Appendix C.5 / C.6, decoded with SETTINGS_HEADER_TABLE_SIZE 256
+RESPONSES = (
+    ('4803333032580770726976617465611d4d6f6e2c203231204f637420323031332032303a31333a323120474d54'
+     '6e1768747470733a2f2f7777772e6578616d706c652e636f6d',
+     '488264025885aec3771a4b6196d07abe941054d444a8200595040b8166e082a62d1bff6e919d29ad171863c78f0b97c8e9ae82ae43d3',
+     [(b':status', b'302'), (b'cache-control', b'private'), (b'date', DATE_1), (b'location', LOCATION)],
+     222),
+    ('4803333037c1c0bf',
+     '4883640effc1c0bf',
+     [(b':status', b'307'), (b'cache-control', b'private'), (b'date', DATE_1), (b'location', LOCATION)],
+     222),
+    ('88c1611d4d6f6e2c203231204f637420323031332032303a31333a323220474d54c05a04677a69707738666f6f3d'
+     '4153444a4b48514b425a584f5157454f50495541585157454f49553b206d61782d6167653d333630303b207665'
+     '7273696f6e3d31',
+     '88c16196d07abe941054d444a8200595040b8166e084a62d1bffc05a839bd9ab77ad94e7821dd7f2e6c7b335dfdfcd5b3960d5af'
+     '27087f3672c1ab270fb5291f9587316065c003ed4ee5b1063d5007',
+     [(b':status', b'200'), (b'cache-control', b'private'), (b'date', DATE_2), (b'location', LOCATION),
+      (b'content-encoding', b'gzip'), (b'set-cookie', COOKIE)],
+     215),
+)
+
+
+def unhex(value):
+    return binascii.unhexlify(value)
+
+
+class DecoderTest(unittest.TestCase):
+
+    def test_literal_representations(self):
+        # C.2.1 - C.2.4
+        decoder = Decoder()
+        self.assertEqual(decoder.decode(unhex('400a637573746f6d2d6b65790d637573746f6d2d686561646572')),
+                         [(b'custom-key', b'custom-header')])
+        self.assertEqual(decoder.table.size, 55)
+        decoder = Decoder()
+        self.assertEqual(decoder.decode(unhex('040c2f73616d706c652f70617468')), [(b':path', b'/sample/path')])
+        self.assertEqual(decoder.decode(unhex('100870617373776f726406736563726574')), [(b'password', b'secret')])
+        self.assertEqual(decoder.decode(unhex('82')), [(b':method', b'GET')])
+        self.assertEqual(decoder.table.entries, [])
+
+    def check_sequence(self, examples, huffman, max_table_size=4096):
+        decoder = Decoder(max_table_size)
+        for plain, encoded, headers, table_size in examples:
+            self.assertEqual(decoder.decode(unhex(encoded if huffman else plain)), headers)
+            self.assertEqual(decoder.table.size, table_size)
+
+    def test_requests(self):
+        self.check_sequence(REQUESTS, False)
+
+    def test_requests_huffman(self):
+        self.check_sequence(REQUESTS, True)
+
+    def test_responses(self):
+        self.check_sequence(RESPONSES, False, 256)
+
+    def test_responses_huffman(self):
+        self.check_sequence(RESPONSES, True, 256)
+
+    def test_responses_evict(self):
+        decoder = Decoder(256)
+        for plain, encoded, headers, table_size in RESPONSES:
+            decoder.decode(unhex(plain))
+        self.assertEqual(decoder.table.entries, [(b'set-cookie', COOKIE), (b'content-encoding', b'gzip'),
+                                                 (b'date', DATE_2)])
+
+    def test_errors(self):
+        decoder = Decoder()
+        self.assertRaises(HPACKError, decoder.decode, unhex('80'))
+        self.assertRaises(HPACKError, decoder.decode, unhex('be'))
+        self.assertRaises(HPACKError, decoder.decode, unhex('400a6375'))
+        self.assertRaises(HPACKError, decoder.decode, unhex('82' + '3fe11f'))
+
+
+class EncoderTest(unittest.TestCase):
+
+    def test_huffman(self):
+        for value in (b'', b'www.example.com', b'no-cache', COOKIE, bytes(bytearray(range(256)))):
+            self.assertEqual(huffman_decode(huffman_encode(value)), value)
+        self.assertEqual(huffman_encode(b'www.example.com'), unhex('f1e3c2e5f23a6ba0ab90f4ff'))
+
+    def test_round_trip(self):
+        encoder, decoder = Encoder(), Decoder()
+        blocks = [
+            [(b':status', b'200'), (b'content-type', b'text/html; charset=utf-8'), (b'content-length', b'42'),
+             (b'server', b'msocket'), (b'set-cookie', COOKIE)],
+            [(b':status', b'404'), (b'content-type', b'text/html; charset=utf-8'), (b'content-length', b'7'),
+             (b'server', b'msocket'), (b'x-large', b'x' * 1000)],
+            [(b':status', b'200'), (b'content-type', b'text/html; charset=utf-8'), (b'server', b'msocket'),
+             (b'date', DATE_1), (b'authorization', b'secret')],
+        ]
+        sizes = []
+        for headers in blocks:
+            block = encoder.encode(headers)
+            sizes.append(len(block))
+            self.assertEqual(decoder.decode(block), headers)
+            self.assertEqual(decoder.table.entries, encoder.table.entries)
+        # indexed on the first response, so the repeated headers cost one byte each afterwards
+        self.assertNotIn((b'set-cookie', COOKIE), encoder.table.entries)
+        self.assertNotIn((b'x-large', b'x' * 1000), encoder.table.entries)
+        self.assertLess(sizes[2], 40)
+
+    def test_table_size_update(self):
+        encoder, decoder = Encoder(), Decoder()
+        headers = [(b'server', b'msocket'), (b'content-type', b'text/plain')]
+        decoder.decode(encoder.encode(headers))
+        encoder.resize(0)
+        block = encoder.encode(headers)
+        self.assertEqual(block[:1], b'\x20')
+        self.assertEqual(decoder.decode(block), headers)
+        self.assertEqual(decoder.table.entries, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
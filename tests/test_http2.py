@@ -0,0 +1,155 @@
+# -*- coding:utf8 -*-
+from __future__ import absolute_import
+
+import socket
+import struct
+import threading
+import unittest
+
+from msocket.wsgi import http2
+from msocket.wsgi.handlers import WSGIRequestHandler
+from msocket.wsgi.hpack import Decoder, Encoder
+from msocket.wsgi.server import MultiSocketWSGIServer
+
+__author__ = 'fujie'
+
+_uint32 = struct.Struct('!L')
+_setting = struct.Struct('!HL')
+MAX_WINDOW = 2 ** 31 - 1
+
+
+def echo(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'application/octet-stream'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class SmallWindowHandler(WSGIRequestHandler):
+    http2_initial_window_size = 16384
+    http2_connection_window_size = 65535
+
+
+class Client(object):
+    """Prior knowledge h2c client sending one request body within the server's windows."""
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address, 5)
+        self.buffer = b''
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self.settings_received = False
+        self.send_window = http2.DEFAULT_WINDOW_SIZE
+        self.stream_window = http2.DEFAULT_WINDOW_SIZE
+        self.window_updates = []
+
+    def send(self, frame_type, flags, stream_id, payload=b''):
+        self.sock.sendall(http2.frame(frame_type, flags, stream_id, payload))
+
+    def read_frame(self):
+        while True:
+            if len(self.buffer) >= 9:
+                length = _uint32.unpack(b'\0' + self.buffer[:3])[0]
+                if len(self.buffer) >= 9 + length:
+                    frame_type, flags, stream_id = struct.unpack('!BBL', self.buffer[3:9])
+                    payload, self.buffer = self.buffer[9:9 + length], self.buffer[9 + length:]
+                    return frame_type, flags, stream_id & 0x7fffffff, payload
+            data = self.sock.recv(65536)
+            if not data:
+                raise AssertionError('connection closed by the server')
+            self.buffer += data
+
+    def process(self):
+        """Read a frame, applying SETTINGS and WINDOW_UPDATE; return the others."""
+        frame_type, flags, stream_id, payload = f = self.read_frame()
+        if frame_type == http2.SETTINGS and not flags & http2.FLAG_ACK:
+            for offset in range(0, len(payload), _setting.size):
+                identifier, value = _setting.unpack_from(payload, offset)
+                if identifier == http2.SETTINGS_INITIAL_WINDOW_SIZE:
+                    self.stream_window += value - http2.DEFAULT_WINDOW_SIZE
+            self.settings_received = True
+            self.send(http2.SETTINGS, http2.FLAG_ACK, 0)
+        elif frame_type == http2.WINDOW_UPDATE:
+            increment = _uint32.unpack(payload)[0]
+            self.window_updates.append((stream_id, increment))
+            if stream_id:
+                self.stream_window += increment
+            else:
+                self.send_window += increment
+        elif frame_type == http2.GOAWAY:
+            raise AssertionError('GOAWAY %r' % payload)
+        else:
+            return f
+
+    def post(self, path, body):
+        self.sock.sendall(http2.PREFACE)
+        self.send(http2.SETTINGS, 0, 0, _setting.pack(http2.SETTINGS_INITIAL_WINDOW_SIZE, MAX_WINDOW))
+        self.send(http2.WINDOW_UPDATE, 0, 0, _uint32.pack(MAX_WINDOW - http2.DEFAULT_WINDOW_SIZE))
+        headers = [(b':method', b'POST'), (b':scheme', b'http'), (b':path', path), (b':authority', b'localhost'),
+                   (b'content-length', str(len(body)).encode('ascii'))]
+        self.send(http2.HEADERS, http2.FLAG_END_HEADERS, 1, self.encoder.encode(headers))
+        while not self.settings_received:
+            self.process()
+        offset = 0
+        while offset < len(body):
+            size = min(16384, self.send_window, self.stream_window, len(body) - offset)
+            if size <= 0:
+                self.process()
+                continue
+            end = offset + size == len(body)
+            self.send(http2.DATA, http2.FLAG_END_STREAM if end else 0, 1, body[offset:offset + size])
+            self.send_window -= size
+            self.stream_window -= size
+            offset += size
+
+        response_headers, data = None, []
+        while True:
+            f = self.process()
+            if f is None:
+                continue
+            frame_type, flags, stream_id, payload = f
+            if stream_id != 1:
+                continue
+            if frame_type == http2.HEADERS:
+                response_headers = dict(self.decoder.decode(payload))
+            elif frame_type == http2.DATA:
+                data.append(payload)
+            elif frame_type == http2.RST_STREAM:
+                raise AssertionError('stream reset: %d' % _uint32.unpack(payload)[0])
+            if flags & http2.FLAG_END_STREAM:
+                return response_headers, b''.join(data)
+
+    def close(self):
+        self.sock.close()
+
+
+class H2CTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = MultiSocketWSGIServer(echo, handler_cls=SmallWindowHandler, log_stdout=False)
+        server = self.servers.wsgi_server(('127.0.0.1', 0))
+        self.address = server.socket.getsockname()
+        self.thread = threading.Thread(target=self.servers.run, args=(0.1,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.servers.shutdown()
+        self.thread.join(5)
+
+    def test_body_larger_than_window(self):
+        body = bytes(bytearray(i % 251 for i in range(300000)))
+        client = Client(self.address)
+        try:
+            headers, data = client.post(b'/echo', body)
+        finally:
+            client.close()
+        self.assertEqual(headers[b':status'], b'200')
+        self.assertEqual(headers[b'content-length'], b'300000')
+        self.assertEqual(data, body)
+        # the body only fits the windows the server credited while reading it
+        self.assertTrue(any(stream_id == 1 for stream_id, _ in client.window_updates))
+        self.assertTrue(any(stream_id == 0 for stream_id, _ in client.window_updates))
+
+
+if __name__ == '__main__':
+    unittest.main()
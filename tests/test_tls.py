@@ -0,0 +1,115 @@
+# -*- coding:utf8 -*-
+from __future__ import absolute_import
+
+import os
+import time
+import shutil
+import socket
+import ssl
+import httplib
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from msocket.server import make_tls_context
+from msocket.wsgi.server import MultiSocketWSGIServer
+
+__author__ = 'fujie'
+
+REQUEST = b'GET / HTTP/1.0\r\nHost: localhost\r\n\r\n'
+
+
+def app(environ, start_response):
+    body = '%s %s' % (environ.get('SSL_SESSION_RESUMED'), environ.get('msocket.alpn_protocol'))
+    start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+    return [body.encode('ascii')]
+
+
+def openssl(*args, **kwargs):
+    process = subprocess.Popen(('openssl',) + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate(kwargs.get('input'))
+    if process.returncode and kwargs.get('check', True):
+        raise AssertionError('openssl %s failed: %s' % (args[0], err))
+    return out
+
+
+class TLSServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.certfile = os.path.join(cls.directory, 'cert.pem')
+        keyfile = os.path.join(cls.directory, 'key.pem')
+        try:
+            openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', keyfile, '-out', cls.certfile)
+        except OSError:
+            shutil.rmtree(cls.directory)
+            raise unittest.SkipTest('openssl command not found')
+        with open(keyfile) as f:
+            key = f.read()
+        with open(cls.certfile, 'a') as f:
+            f.write(key)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.servers = MultiSocketWSGIServer(app, log_stdout=False)
+        server = self.servers.wsgi_server(('127.0.0.1', 0), threads=2,
+                                          tls_context=make_tls_context(self.certfile, ktls=False))
+        server.tls_handshake_timeout = 0.5
+        self.address = server.socket.getsockname()
+        self.thread = threading.Thread(target=self.servers.run, args=(0.1,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.servers.shutdown()
+        self.thread.join(5)
+
+    def s_client(self, *args):
+        # the connection ends without close_notify, which s_client reports as an error
+        out = openssl('s_client', '-connect', '%s:%d' % self.address, '-servername', 'localhost',
+                      '-alpn', 'http/1.1', '-quiet', *args, input=REQUEST, check=False)
+        self.assertTrue(out.startswith(b'HTTP/1.1 200'), out)
+        return out.split(b'\r\n\r\n', 1)[1]
+
+    def test_full_and_resumed_handshake(self):
+        session = os.path.join(self.directory, 'session.pem')
+        self.assertEqual(self.s_client('-sess_out', session), b'Initial http/1.1')
+        self.assertEqual(self.s_client('-sess_in', session), b'Resumed http/1.1')
+
+    @unittest.skipUnless(getattr(ssl, 'HAS_ALPN', False), 'ALPN not supported')
+    def test_alpn(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.set_alpn_protocols(['h2', 'http/1.1'])
+        connection = httplib.HTTPSConnection(*self.address, timeout=5, context=context)
+        try:
+            connection.connect()
+            self.assertEqual(connection.sock.selected_alpn_protocol(), 'http/1.1')
+            connection.request('GET', '/')
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read(), b'Initial http/1.1')
+        finally:
+            connection.close()
+
+    def test_handshake_timeout(self):
+        sock = socket.create_connection(self.address, 5)
+        try:
+            started = time.time()
+            # never sends a ClientHello, the server gives up after tls_handshake_timeout
+            self.assertEqual(sock.recv(1), b'')
+            elapsed = time.time() - started
+        finally:
+            sock.close()
+        self.assertGreaterEqual(elapsed, 0.4)
+        self.assertLess(elapsed, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()